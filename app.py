@@ -1,5 +1,6 @@
 import os
-import io
+import time
+_APP_IMPORT_START = time.perf_counter()
 from dotenv import load_dotenv
 load_dotenv()
 # ★★★ 设置 Hugging Face 镜像源 (防止下载模型超时) ★★★
@@ -7,22 +8,23 @@ os.environ['HF_ENDPOINT'] = 'https://hf-mirror.com'
 
 import streamlit as st
 import numpy as np
-import matplotlib.pyplot as plt
 from scipy.integrate import odeint
 
 
 from langchain_ollama import ChatOllama
 from langchain_classic.agents import create_tool_calling_agent, AgentExecutor
-from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.tools import tool
 from langchain_community.callbacks.streamlit import StreamlitCallbackHandler
 from router import init_router_chain,get_route_category
 # === 导入我们自己写的模块 ===
 from router import init_router_chain, get_route_category
-from rag_engine import get_retriever_tool, advanced_rerank_search
+from rag_engine import advanced_rerank_search, lookup_cached_answer, store_cached_answer
+from rag_engine import start_speculative_retrieval, consume_speculative_retrieval, cancel_speculative_retrieval
+import rag_engine
 import tools 
-import re
 import history_utils
+import pipeline
+from tracing import start_trace, span, recent_traces, histogram_snapshot
 # ==========================================
 # 🔌 核心升级：导入后端引擎
 # ==========================================
@@ -36,6 +38,15 @@ import history_utils
 # ================= 2. 页面配置与初始化 =================
 st.set_page_config(page_title="Chaos Agent Pro", page_icon="🌪️", layout="wide")
 
+# 记录 app.py 依赖的导入耗时 (Streamlit 每次 rerun 都会重新执行本文件，只记第一次)
+if "import app.py dependencies" not in rag_engine.STARTUP_TIMINGS:
+    rag_engine.record_timing("import app.py dependencies", time.perf_counter() - _APP_IMPORT_START)
+
+# 模型改为懒加载后，UI 可以立即响应；后台线程同时把 RAG 模型预热好 (CHAOS_WARMUP=0 可关闭)
+if os.getenv("CHAOS_WARMUP", "1") != "0":
+    rag_engine.start_background_warmup()
+    tools.warm_render_pool()
+
 # 初始化 Session State (用于存储当前会话信息)
 if "session_id" not in st.session_state:
     st.session_state.session_id = history_utils.generate_session_id()
@@ -99,6 +110,19 @@ with st.sidebar:
                 st.rerun()
 
     st.divider()
+    with st.expander("⏱️ 启动耗时"):
+        st.text(rag_engine.startup_report())
+    # [诊断面板] 最近 N 轮对话各阶段耗时 (数据来自 tracing 模块)
+    with st.expander("🩺 诊断: 最近请求耗时"):
+        traces = recent_traces(10)
+        if not traces:
+            st.caption("暂无请求")
+        for t in traces:
+            stage_ms = " | ".join(f"{sp['name']} {sp['duration_ms']:.0f}ms" for sp in t["spans"])
+            st.caption(f"**{t['attrs'].get('category', '?')}** {t['duration_ms']:.0f}ms — {stage_ms}")
+        hist = histogram_snapshot()
+        if hist:
+            st.json({name: {"count": h["count"], "mean_ms": round(h["mean_ms"], 1)} for name, h in hist.items()}, expanded=False)
     st.info("💡 **工作模式:**\n1. 🧮 数学 -> Python 引擎\n2. 📄 专业 -> 本地知识库\n3. 🧠 通用 -> Llama3")
 
 # ================= 4. 主界面显示区域 =================
@@ -117,109 +141,128 @@ if user_input := st.chat_input("请输入问题 (例如: 计算r=3.2的状态 /
     with st.chat_message("user"):
         st.markdown(user_input)
 
-    # [意图识别与路由]
-    with st.status("🧠 正在思考...", expanded=True) as status:
-        category = get_route_category(user_input, st.session_state.router_chain)
-        status.write(f"🏷️ 识别意图: **{category}**")
+    # [链路追踪] 本轮对话的 route / rewrite / recall / rerank / generate / save 耗时都记在同一个 trace 里
+    with start_trace("chat_turn", session=st.session_state.session_id) as trace:
+        # [意图识别与路由]
+        with st.status("🧠 正在思考...", expanded=True) as status:
+            # 投机检索：路由的同时后台已经开始检索，路由不是 RAG 时再取消
+            speculative_job = start_speculative_retrieval(user_input)
+            # 向量路由只在后台预热完成后使用，不为路由在主线程加载 Embedding 模型
+            category = get_route_category(user_input, st.session_state.router_chain, rag_engine.peek_embedding_router())
+            cached_answer = None
+            if category == "RAG":
+                # 路由为 RAG 后再查语义答案缓存 (需要 Embedding 模型)：改述过的同一问题直接返回，跳过检索/生成
+                # CHAT / COMPUTE 轮次不为它加载 RAG 模型
+                cached_answer = lookup_cached_answer(user_input)
+                if cached_answer:
+                    category = "CACHED"
+            if category != "RAG":
+                cancel_speculative_retrieval(speculative_job)
+            trace["attrs"]["category"] = category
+            status.write(f"🏷️ 识别意图: **{category}**")
         
-        response_text = ""
-        fig = None #用于存储可能生成的图片
-
-        # ➤ 分支 A: 数学计算 (调用 tools.py)
-        if category == "COMPUTE":
-            status.update(label="🧮 正在调用 Python 计算引擎...", state="running")
-            try:
-                # 正则提取 r 值
-                match = re.search(r"r\s*[=:]\s*(\d+\.?\d*)", user_input)
-                r_val = float(match.group(1)) if match else 3.5 # 默认值
-                
-                if "logistic" in user_input.lower() or "映射" in user_input or "方程" in user_input:
-                    response_text, fig = tools.simulate_logistic_map(r_val)
-                elif "lorenz" in user_input.lower() or "洛伦兹" in user_input:
-                    response_text, fig = tools.simulate_lorenz()
-                else:
-                    response_text = "⚠️ 未识别具体计算模型，默认计算 Logistic 映射..."
-                    response_text_extra, fig = tools.simulate_logistic_map(r_val)
-                    response_text += "\n" + response_text_extra
-                
-                # ★★★ 核心修复：将 Matplotlib Figure 转为内存图片 ★★★
-                # 这能防止 Streamlit 报 MediaFileHandler Error
-                if fig:
-                    # 1. 创建内存缓冲区
-                    buf = io.BytesIO()
-                    # 2. 把图保存到缓冲区
-                    fig.savefig(buf, format="png", bbox_inches='tight', dpi=100)
-                    # 3. 指针归零
-                    buf.seek(0)
-                    # 4. 显示图片 (使用 st.image 而不是 st.pyplot)
-                    st.image(buf, caption="Simulation Result", use_container_width=True)
-                    # 5. 显式关闭图表，释放内存
-                    plt.close(fig) 
-                    
-                    # (可选) 如果你想把图存进历史记录，这里需要把 buf 转为 base64 存入 session_state
+            response_text = ""
+            image = None  # 计算分支生成的 PNG 字节
+            # 需要 LLM 生成的分支只在这里准备好流，真正的生成放到下面的聊天气泡里逐字渲染
+            answer_stream = None
+            answer_prefix, answer_suffix = "", ""
+            cache_sources = None  # 非 None 时回答生成完后写入语义缓存
+
+            # ➤ 分支 0: 语义缓存命中
+            if category == "CACHED":
+                status.write(f"⚡ 命中语义缓存 (相似度 {cached_answer['similarity']:.2f})")
+                response_text = cached_answer["answer"]
+                if cached_answer["sources"]:
+                    response_text += f"\n\n*(来源: {', '.join(cached_answer['sources'])} · 语义缓存)*"
+
+            # ➤ 分支 A: 数学计算 (调用 tools.py)
+            elif category == "COMPUTE":
+                status.update(label="🧮 正在调用 Python 计算引擎...", state="running")
+                try:
+                    # 参数提取与模型分发见 pipeline.run_compute (benchmark.py 共用)
+                    # 返回的已经是编码好的 PNG 字节 (重复参数直接取自 tools.run_tool 的缓存)，
+                    # 直接交给 st.image，不会再触发 Streamlit 的 MediaFileHandler Error
+                    with span("compute") as compute_span:
+                        response_text, image = pipeline.run_compute(user_input)
+                    status.write(f"⏱️ 计算与绘图耗时 {compute_span['duration_ms']:.0f} ms")
+                    # (可选) 如果你想把图存进历史记录，这里需要把 PNG 字节转为 base64 存入 session_state
                     # 但为了简单稳定，目前历史记录只存文字，图只显示一次。
 
-            except Exception as e:
-                response_text = f"❌ 计算模块出错: {str(e)}"
+                except Exception as e:
+                    response_text = f"❌ 计算模块出错: {str(e)}"
 
-        # ➤ 分支 B: RAG + 智能回退
-        elif category == "RAG":
-            status.update(label="🔍 正在检索本地知识库...", state="running")
+            # ➤ 分支 B: RAG + 智能回退
+            elif category == "RAG":
+                status.update(label="🔍 正在检索本地知识库...", state="running")
             
-            # 1. 检索
-            retriever = get_retriever_tool()
-            rag_result = retriever.func(user_input)
+                # 1. 检索 (投机检索已在路由时开始，这里只等剩余部分)
+                if speculative_job is not None:
+                    rag_result, rag_stats = consume_speculative_retrieval(speculative_job)
+                    saved_s = rag_stats.get("speculative", {}).get("saved_s", 0.0)
+                    trace["attrs"]["speculative_saved_ms"] = saved_s * 1000
+                    status.write(f"⚡ 检索与意图识别并行，节省 {saved_s * 1000:.0f} ms")
+                else:
+                    rag_result, rag_stats = advanced_rerank_search(user_input, return_stats=True)
             
-            # 2. 判别是否需要回退 (Fallback)
-            # 假设 rag_engine 在没搜到时会返回包含"资料不足"的字符串，或者我们可以检查字符串长度
-            is_fallback = False
-            if "资料不足" in rag_result or "未找到相关文档" in rag_result:
-                is_fallback = True
-                status.write("⚠️ 本地库未收录，**切换至通用模式**...")
+                # 2. 判别是否需要回退 (Fallback)
+                # 假设 rag_engine 在没搜到时会返回包含"资料不足"的字符串，或者我们可以检查字符串长度
+                is_fallback = pipeline.is_rag_fallback(rag_result)
+                if is_fallback:
+                    status.write("⚠️ 本地库未收录，**切换至通用模式**...")
+                else:
+                    status.write("✅ 本地库命中！正在阅读文献...")
+                    packing = rag_stats.get("packing")
+                    if packing:
+                        status.write(f"📦 上下文压缩: {packing['original_tokens']} → {packing['packed_tokens']} tokens (节省 {packing['saved_tokens']})")
+
+                # 3. 准备生成回答
+                if is_fallback:
+                    chain = pipeline.build_answer_chain(llm, "fallback")
+                    answer_stream = pipeline.AnswerStream(chain, {"question": user_input}, "fallback")
+                    answer_suffix = pipeline.FALLBACK_ANSWER_SUFFIX
+                else:
+                    chain = pipeline.build_answer_chain(llm, "rag")
+                    answer_stream = pipeline.AnswerStream(chain, {"context": rag_result, "question": user_input}, "rag")
+                    # 可以在这里加个前缀，让 UI 更好看
+                    answer_prefix = pipeline.RAG_ANSWER_PREFIX
+                    # 写入语义缓存，后续改述的同一问题可以直接命中
+                    cache_sources = rag_stats.get("sources", [])
+            # ➤ 分支 C: 闲聊
             else:
-                status.write("✅ 本地库命中！正在阅读文献...")
-
-            # 3. 生成回答
-            if is_fallback:
-                prompt = ChatPromptTemplate.from_template(
-                    "用户问题: {question}\n请利用你的通用知识回答。如果不知道就直说。"
-                )
-                chain = prompt | llm
-                response_text = chain.invoke({"question": user_input}).content
-                response_text += "\n\n*(注: 此回答基于通用知识，非本地文献)*"
+                chain = pipeline.build_answer_chain(llm, "chat")
+                answer_stream = pipeline.AnswerStream(chain, {"question": user_input}, "chat")
+
+            status.update(label="✅ 完成", state="complete", expanded=False)
+
+        # [显示助手回复]
+        with st.chat_message("assistant"):
+            if answer_stream is not None:
+                # 逐 token 渲染，write_stream 返回拼接好的完整文本
+                def _answer_chunks():
+                    if answer_prefix:
+                        yield answer_prefix
+                    yield from answer_stream
+                    if answer_suffix:
+                        yield answer_suffix
+                st.write_stream(_answer_chunks())
+                response_text = answer_prefix + answer_stream.text + answer_suffix
+                metrics = answer_stream.metrics
+                trace["attrs"].update(ttft_ms=metrics["ttft_ms"], tokens_per_s=metrics["tokens_per_s"])
+                st.caption(f"⚡ 首字 {metrics['ttft_ms']:.0f} ms · {metrics['tokens_per_s']:.1f} tokens/s · 共 {metrics['total_ms'] / 1000:.1f} s")
+                if cache_sources is not None:
+                    store_cached_answer(user_input, response_text, cache_sources)
             else:
-                prompt = ChatPromptTemplate.from_template(
-                    "你是一个严谨的研究助手。请仅基于以下文献回答问题：\n\n文献内容:\n{context}\n\n用户问题: {question}"
-                    "在回答用户问题时，如果涉及到输出内容有公式，请严格按照Latex进行公式输出"
-                    "在回答用户问题时，如果段落过长需要分点回答，请分点回答，并按照一级标题-内容进行输出"
-                )
-                chain = prompt | llm
-                response_text = chain.invoke({"context": rag_result, "question": user_input}).content
-                # 可以在这里加个前缀，让 UI 更好看
-                response_text = "📚 **基于本地文献的回答：**\n\n" + response_text
-        # ➤ 分支 C: 闲聊
-        else:
-            status.update(label="💬 正在生成回复...", state="running")
-            prompt = ChatPromptTemplate.from_template("用户说: {question}\n请用简练、友好的语气回复。"
-                                                      "在回答数值计算问题时，严格根据工具返回的结果进行判断，自己别乱说"
-                                                      )
-            chain = prompt | llm
-            response_text = chain.invoke({"question": user_input}).content
-
-        status.update(label="✅ 完成", state="complete", expanded=False)
-
-    # [显示助手回复]
-    with st.chat_message("assistant"):
-        st.markdown(response_text)
-        if fig:
-            st.pyplot(fig) # ★★★ 如果有图，在这里显示 ★★★
-
-    # [保存消息到 Session]
-    st.session_state.messages.append({"role": "assistant", "content": response_text})
+                st.markdown(response_text)
+            if image:
+                st.image(image, caption="Simulation Result", use_container_width=True)  # ★★★ 如果有图，在这里显示 ★★★
+
+        # [保存消息到 Session]
+        st.session_state.messages.append({"role": "assistant", "content": response_text})
     
-    # [自动持久化保存]
-    # 调用 history_utils 把当前完整对话存入 JSON
-    history_utils.save_conversation(st.session_state.session_id, st.session_state.messages)
+        # [自动持久化保存]
+        # 调用 history_utils 把当前完整对话存入 JSON
+        with span("save"):
+            history_utils.save_conversation(st.session_state.session_id, st.session_state.messages)
     
     # 如果是新对话（第一轮交互），刷新一下让侧边栏出现标题
     if len(st.session_state.messages) <= 2:
@@ -0,0 +1,310 @@
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+from dotenv import load_dotenv
+
+load_dotenv()
+os.environ['HF_ENDPOINT'] = 'https://hf-mirror.com'
+
+from router import init_router_chain, get_route_category
+import rag_engine
+import pipeline
+
+# ==========================================
+# 端到端分阶段延迟压测 (不依赖 Streamlit)
+# 用法：
+#   python benchmark.py                          # 回放 question.txt，真实 Ollama
+#   python benchmark.py --stub-llm --limit 50    # 本地桩 LLM，只压测检索与重排
+#   python benchmark.py --compare bench_results/上次.json
+#   python benchmark.py --render-bench           # 只测 Lorenz 轨迹渲染 (全量 / 降采样 / 渲染进程池)
+# ==========================================
+
+STAGES = ["cache_lookup", "route", "recall", "rerank", "compute", "ttft", "generate", "total"]
+
+def percentile(values, q: float) -> float:
+    """线性插值百分位 (q 取 0~100)"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    pos = (len(ordered) - 1) * q / 100
+    lower = int(pos)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (pos - lower)
+
+def summarize(values):
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values) if values else 0.0,
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": max(values) if values else 0.0,
+    }
+
+def build_llms(stub: bool):
+    """返回 (路由 LLM, 回答 LLM)；stub=True 时用本地桩模型代替 Ollama"""
+    if stub:
+        from langchain_core.language_models.fake_chat_models import FakeListChatModel
+        # 桩路由一律判为 RAG (关键词规则仍然生效，向量路由在 main 中关闭)，这样检索与重排能被充分压测
+        return FakeListChatModel(responses=["RAG"]), FakeListChatModel(responses=["(stub answer)"])
+    from langchain_ollama import ChatOllama
+    router_llm = ChatOllama(model="llama3.1", temperature=0, base_url="http://127.0.0.1:11434")
+    answer_llm = ChatOllama(model="llama3.1", temperature=0.3, keep_alive="1h")
+    return router_llm, answer_llm
+
+def stream_answer(answer_llm, mode: str, inputs: dict, timings: dict, record: dict):
+    """与 app.py 一样流式生成，额外记录首字延迟 (ttft) 与解码速度"""
+    stream = pipeline.AnswerStream(pipeline.build_answer_chain(answer_llm, mode), inputs, mode)
+    for _ in stream:
+        pass
+    timings["ttft"] = stream.metrics["ttft_ms"] / 1000
+    record["tokens_per_s"] = stream.metrics["tokens_per_s"]
+    return stream.text
+
+def run_question(question: str, router_chain, answer_llm, use_answer_cache: bool, speculative: str = "off"):
+    """
+    按 app.py 的流程处理一个问题，返回每个阶段的耗时 (秒)
+    注意：压测只读语义答案缓存，不会写入，避免桩回答污染真实缓存
+    """
+    timings = {}
+    record = {"question": question}
+    started = time.perf_counter()
+
+    speculative_job = rag_engine.start_speculative_retrieval(question, mode=speculative)
+    t = time.perf_counter()
+    # 与 app.py 一样，向量路由只在后台预热加载完成后使用
+    category = get_route_category(question, router_chain, rag_engine.peek_embedding_router())
+    timings["route"] = time.perf_counter() - t
+    record["category"] = category
+
+    # 与 app.py 一样，路由为 RAG 后才查语义答案缓存
+    if category == "RAG" and use_answer_cache:
+        t = time.perf_counter()
+        hit = rag_engine.lookup_cached_answer(question)
+        timings["cache_lookup"] = time.perf_counter() - t
+        if hit:
+            rag_engine.cancel_speculative_retrieval(speculative_job)
+            record["category"] = "CACHED"
+            timings["total"] = time.perf_counter() - started
+            record["timings"] = timings
+            return record
+    if category != "RAG":
+        rag_engine.cancel_speculative_retrieval(speculative_job)
+
+    if category == "COMPUTE":
+        t = time.perf_counter()
+        try:
+            pipeline.run_compute(question)
+        except Exception as e:
+            record["error"] = str(e)
+        timings["compute"] = time.perf_counter() - t
+
+    elif category == "RAG":
+        if speculative_job is not None:
+            rag_result, stats = rag_engine.consume_speculative_retrieval(speculative_job)
+            record["speculative_saved_s"] = stats.get("speculative", {}).get("saved_s", 0.0)
+        else:
+            rag_result, stats = rag_engine.advanced_rerank_search(question, return_stats=True)
+        timings.update(stats.get("timings", {}))
+        record["scored"] = stats.get("scored", 0)
+        record["accepted"] = stats.get("accepted", 0)
+        if stats.get("packing"):
+            record["context_tokens"] = stats["packing"]["packed_tokens"]
+            record["saved_tokens"] = stats["packing"]["saved_tokens"]
+
+        t = time.perf_counter()
+        if pipeline.is_rag_fallback(rag_result):
+            record["fallback"] = True
+            stream_answer(answer_llm, "fallback", {"question": question}, timings, record)
+        else:
+            stream_answer(answer_llm, "rag", {"context": rag_result, "question": question}, timings, record)
+        timings["generate"] = time.perf_counter() - t
+
+    else:
+        t = time.perf_counter()
+        stream_answer(answer_llm, "chat", {"question": question}, timings, record)
+        timings["generate"] = time.perf_counter() - t
+
+    timings["total"] = time.perf_counter() - started
+    record["timings"] = timings
+    return record
+
+def run_pass(name: str, questions, router_chain, answer_llm, use_answer_cache: bool, speculative: str = "off"):
+    print(f"\n🏁 [{name}] 回放 {len(questions)} 个问题...")
+    records = []
+    started = time.perf_counter()
+    for i, q in enumerate(questions):
+        record = run_question(q, router_chain, answer_llm, use_answer_cache, speculative)
+        records.append(record)
+        print(f"  [{i+1}/{len(questions)}] {record['category']:<8} {record['timings']['total']*1000:8.1f} ms | {q[:30]}")
+    wall = time.perf_counter() - started
+
+    stages = {}
+    for stage in STAGES:
+        values = [r["timings"][stage] for r in records if stage in r["timings"]]
+        if values:
+            stages[stage] = summarize(values)
+    saved = [r["saved_tokens"] for r in records if "saved_tokens" in r]
+    speculative_saved = [r["speculative_saved_s"] for r in records if "speculative_saved_s" in r]
+    return {
+        "wall_s": wall,
+        "speculative_saved_mean_s": sum(speculative_saved) / len(speculative_saved) if speculative_saved else 0.0,
+        "saved_tokens_mean": sum(saved) / len(saved) if saved else 0.0,
+        "throughput_qps": len(records) / wall if wall > 0 else 0.0,
+        "first_query_s": records[0]["timings"]["total"] if records else 0.0,
+        "stages": stages,
+        "records": records,
+    }
+
+def print_summary(results):
+    for pass_name, data in results["passes"].items():
+        print(f"\n====== {pass_name}: {data['throughput_qps']:.2f} q/s | 首个问题 {data['first_query_s']*1000:.0f} ms | 平均节省上下文 {data.get('saved_tokens_mean', 0):.0f} tokens ======")
+        if data.get("speculative_saved_mean_s"):
+            print(f"⚡ 投机检索平均每个 RAG 问题节省 {data['speculative_saved_mean_s']*1000:.0f} ms")
+        print(f"{'stage':<14}{'n':>5}{'p50(ms)':>10}{'p95(ms)':>10}{'p99(ms)':>10}")
+        for stage, s in data["stages"].items():
+            print(f"{stage:<14}{s['count']:>5}{s['p50']*1000:>10.1f}{s['p95']*1000:>10.1f}{s['p99']*1000:>10.1f}")
+    print("\n" + rag_engine.startup_report())
+
+def print_comparison(results, baseline_path: str):
+    """与之前的结果文件逐阶段对比 p50 / p95"""
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    print(f"\n====== 对比基线: {baseline_path} ======")
+    for pass_name, data in results["passes"].items():
+        old_pass = baseline.get("passes", {}).get(pass_name)
+        if not old_pass:
+            continue
+        print(f"[{pass_name}]")
+        for stage, s in data["stages"].items():
+            old = old_pass["stages"].get(stage)
+            if not old:
+                continue
+            for key in ("p50", "p95"):
+                delta = (s[key] - old[key]) / old[key] * 100 if old[key] else 0.0
+                print(f"  {stage:<14}{key}: {old[key]*1000:8.1f} -> {s[key]*1000:8.1f} ms ({delta:+.1f}%)")
+
+RENDER_BENCH_DURATIONS = [40, 400, 1000, 4000]
+
+def run_render_benchmark(durations=RENDER_BENCH_DURATIONS, repeats: int = 3):
+    """
+    Lorenz 轨迹渲染耗时：全部点直接绘制 vs LTTB 降采样，以及经渲染进程池的端到端耗时 (含结果传输)
+    每组取 repeats 次的最小值；数值积分不计入
+    """
+    import tools
+    tools.warm_render_pool()
+    rows = []
+    for duration in durations:
+        result = tools.compute_lorenz(duration=duration)
+        timings = {}
+        for label, render in (
+            ("full", lambda: tools.encode_figure(tools.render_lorenz(result, max_points=0))),
+            ("decimated", lambda: tools.encode_figure(tools.render_lorenz(result))),
+            ("pool", lambda: tools.render_png("lorenz", result)),
+        ):
+            best = float("inf")
+            for _ in range(repeats):
+                t = time.perf_counter()
+                render()
+                best = min(best, time.perf_counter() - t)
+            timings[label] = best
+        rows.append({"duration": duration, "points": len(result["states"]), **timings})
+        print(f"  duration={duration:<6} {len(result['states']):>7} 点 | 全量 {timings['full']*1000:8.1f} ms"
+              f" | 降采样 {timings['decimated']*1000:8.1f} ms | 进程池 {timings['pool']*1000:8.1f} ms"
+              f" | 节省 {(timings['full'] - timings['decimated'])*1000:8.1f} ms")
+    return rows
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except Exception:
+        return "unknown"
+
+def main():
+    parser = argparse.ArgumentParser(description="Chaos Agent 分阶段延迟压测")
+    parser.add_argument("--questions", default="question.txt", help="问题文件，每行一个问题")
+    parser.add_argument("--limit", type=int, default=0, help="只回放前 N 个问题 (0 表示全部)")
+    parser.add_argument("--stub-llm", action="store_true", help="用本地桩模型代替 Ollama，只压测检索与重排")
+    parser.add_argument("--warm-passes", type=int, default=1, help="冷启动之后再回放几轮热缓存测试")
+    parser.add_argument("--answer-cache", action="store_true", help="包含语义答案缓存查询 (只读)")
+    parser.add_argument("--no-rewrite", action="store_true", help="关闭投机并行改写")
+    parser.add_argument("--speculative-retrieval", default="off", choices=["off", "recall", "full"],
+                        help="检索与路由并行 (与 app.py 的 CHAOS_SPECULATIVE_RETRIEVAL 相同)")
+    parser.add_argument("--output", default="", help="结果 JSON 路径，默认 bench_results/<时间戳>.json")
+    parser.add_argument("--compare", default="", help="与之前的结果 JSON 对比")
+    parser.add_argument("--render-bench", action="store_true", help="只测 Lorenz 轨迹渲染耗时 (全量 vs 降采样 vs 渲染进程池)")
+    args = parser.parse_args()
+
+    if args.render_bench:
+        print("\n🎨 Lorenz 轨迹渲染耗时 (不含数值积分)")
+        results = {
+            "meta": {"timestamp": time.strftime("%Y-%m-%d %H:%M:%S"), "git": git_revision()},
+            "render": run_render_benchmark(),
+        }
+        output = args.output or os.path.join("bench_results", "render_" + time.strftime("%Y%m%d_%H%M%S") + ".json")
+        if os.path.dirname(output):
+            os.makedirs(os.path.dirname(output), exist_ok=True)
+        with open(output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"\n📂 结果已写入: {output}")
+        return 0
+
+    with open(args.questions, "r", encoding="utf-8") as f:
+        questions = [line.strip() for line in f if line.strip()]
+    if args.limit:
+        questions = questions[:args.limit]
+    if not questions:
+        print(f"❌ {args.questions} 中没有问题")
+        return 1
+
+    if args.stub_llm or args.no_rewrite:
+        # 桩模型的改写结果没有意义，直接关闭改写
+        rag_engine.SPECULATIVE_REWRITE = False
+    if args.stub_llm:
+        # 向量路由会在桩 LLM 之前把问题分到 COMPUTE / CHAT，且是否已预热加载好取决于时机；
+        # 桩模式关闭它，路由只由关键词规则 + 桩 LLM 决定，每次运行结果一致
+        rag_engine.EMBEDDING_ROUTER = False
+
+    router_llm, answer_llm = build_llms(args.stub_llm)
+    router_chain = init_router_chain(router_llm)
+    # 与 app.py 一样启动后台预热 (CHAOS_WARMUP=0 关闭)，冷启动轮次包含与预热争用模型加载的等待
+    if os.getenv("CHAOS_WARMUP", "1") != "0":
+        rag_engine.start_background_warmup()
+
+    results = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "git": git_revision(),
+            "questions": args.questions,
+            "count": len(questions),
+            "stub_llm": args.stub_llm,
+            "answer_cache": args.answer_cache,
+            "speculative_rewrite": rag_engine.SPECULATIVE_REWRITE,
+            "adaptive_rerank": rag_engine.ADAPTIVE_RERANK,
+            "speculative_retrieval": args.speculative_retrieval,
+        },
+        "passes": {},
+    }
+    # 第一轮是冷启动：模型加载、各级缓存均为空
+    results["passes"]["cold"] = run_pass("cold", questions, router_chain, answer_llm, args.answer_cache, args.speculative_retrieval)
+    for i in range(args.warm_passes):
+        results["passes"][f"warm{i+1}"] = run_pass(f"warm{i+1}", questions, router_chain, answer_llm, args.answer_cache, args.speculative_retrieval)
+    results["startup"] = dict(rag_engine.STARTUP_TIMINGS)
+
+    print_summary(results)
+    if args.compare:
+        print_comparison(results, args.compare)
+
+    output = args.output or os.path.join("bench_results", time.strftime("%Y%m%d_%H%M%S") + ".json")
+    if os.path.dirname(output):
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"\n📂 结果已写入: {output}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
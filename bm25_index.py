@@ -0,0 +1,90 @@
+import re
+import json
+import math
+from collections import Counter, defaultdict
+from langchain_core.documents import Document
+
+# ==========================================
+# BM25 倒排索引 (词法检索)
+# 弥补稠密检索对专有名词 (Gierer-Meinhardt / OGY) 不敏感的问题
+# ==========================================
+
+_ASCII_TERM = re.compile(r"[a-z0-9]+(?:[-_][a-z0-9]+)*")
+_CJK_RUN = re.compile(r"[一-鿿]+")
+
+def tokenize(text: str):
+    """
+    中英混合分词 (不依赖 jieba)：
+    - 英文/数字：整词 + 连字符拆分后的子词，例如 gierer-meinhardt -> [gierer-meinhardt, gierer, meinhardt]
+    - 中文：单字 + 相邻双字 (bigram)
+    """
+    text = text.lower()
+    tokens = []
+    for term in _ASCII_TERM.findall(text):
+        tokens.append(term)
+        if "-" in term or "_" in term:
+            tokens.extend(p for p in re.split(r"[-_]", term) if p)
+    for run in _CJK_RUN.findall(text):
+        tokens.extend(run)
+        tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+class BM25Index:
+    def __init__(self, documents=None, postings=None, doc_lens=None, k1: float = 1.5, b: float = 0.75):
+        self.documents = documents or []     # [{"page_content": ..., "metadata": {...}}]
+        self.postings = postings or {}       # term -> [[doc_idx, tf], ...]
+        self.doc_lens = doc_lens or []
+        self.k1 = k1
+        self.b = b
+        self.avg_len = (sum(self.doc_lens) / len(self.doc_lens)) if self.doc_lens else 0.0
+
+    @classmethod
+    def build(cls, chunks):
+        """由 build_db.intelligent_chunking 产出的 chunk 列表构建索引"""
+        documents, doc_lens = [], []
+        postings = defaultdict(list)
+        for idx, chunk in enumerate(chunks):
+            tokens = tokenize(chunk.page_content)
+            documents.append({"page_content": chunk.page_content, "metadata": dict(chunk.metadata)})
+            doc_lens.append(len(tokens))
+            for term, tf in Counter(tokens).items():
+                postings[term].append([idx, tf])
+        return cls(documents, dict(postings), doc_lens)
+
+    def save(self, path: str):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({
+                "k1": self.k1,
+                "b": self.b,
+                "documents": self.documents,
+                "postings": self.postings,
+                "doc_lens": self.doc_lens,
+            }, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path: str):
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return cls(data["documents"], data["postings"], data["doc_lens"], data.get("k1", 1.5), data.get("b", 0.75))
+
+    def search(self, query: str, k: int = 20):
+        """返回 [(Document, bm25_score), ...]，按分数降序"""
+        n_docs = len(self.documents)
+        if n_docs == 0:
+            return []
+
+        scores = defaultdict(float)
+        for term in set(tokenize(query)):
+            plist = self.postings.get(term)
+            if not plist:
+                continue
+            idf = math.log(1 + (n_docs - len(plist) + 0.5) / (len(plist) + 0.5))
+            for doc_idx, tf in plist:
+                norm = self.k1 * (1 - self.b + self.b * self.doc_lens[doc_idx] / self.avg_len)
+                scores[doc_idx] += idf * tf * (self.k1 + 1) / (tf + norm)
+
+        top = sorted(scores.items(), key=lambda x: x[1], reverse=True)[:k]
+        return [
+            (Document(page_content=self.documents[i]["page_content"], metadata=self.documents[i]["metadata"]), score)
+            for i, score in top
+        ]
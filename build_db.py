@@ -2,12 +2,25 @@ import os
 import glob
 import shutil
 import time
+import sys
+import json
+import uuid
+import queue
+import hashlib
+import threading
+import multiprocessing
+from collections import deque
 from langchain_chroma import Chroma
-from langchain_ollama import OllamaEmbeddings
 from langchain_community.document_loaders import TextLoader
+from langchain_core.documents import Document
 # 核心组件：结构化切分器
 from langchain_text_splitters import MarkdownHeaderTextSplitter, RecursiveCharacterTextSplitter
 from langchain_community.embeddings import HuggingFaceBgeEmbeddings
+from bm25_index import BM25Index
+from parent_store import ParentStore, make_parent_id
+from cache_utils import KB_VERSION_FILE
+from flat_index import export_flat_index, quantize_flat_index
+from near_dup import NearDupIndex
 
 # =================配置区域=================
 PERSIST_DIRECTORY = "./chroma_db"
@@ -16,16 +29,40 @@ DATA_DIRECTORY = "./data"
 BATCH_SIZE = 30
 # EMBEDDING_MODEL = "nomic-embed-text"
 EMBEDDING_MODEL = "BAAI/bge-m3"
+BM25_INDEX_FILE = "bm25_index.json"  # 词法索引，与 Chroma 数据存放在同一目录
+PARENT_STORE_FILE = "parents.sqlite" # 父段落存储，与 Chroma 数据存放在同一目录
+FLAT_INDEX_DIR = "flat_index"        # 内存映射 flat 索引 (rag_engine 可选后端)
+FLAT_INDEX_DTYPE = "float16"         # 导出向量精度：float16 体积减半，float32 为全精度
+FLAT_INDEX_QUANTIZATION = "none"     # 压缩码: "none" / "int8" (4x) / "pq" (64 段，约 32x)，精确重打分用上面的全精度向量
+# 并行构建：N 个子进程各自加载一份 BGE-M3 计算向量，主进程作为唯一写入者批量写 Chroma
+# 0 = 单进程 (原流程)；-1 = 按 CPU 核数自动决定 (核数 // 每进程线程数)
+EMBED_WORKERS = int(os.getenv("CHAOS_EMBED_WORKERS", "0"))
+EMBED_THREADS_PER_WORKER = int(os.getenv("CHAOS_EMBED_THREADS", "4"))  # 每个子进程的 torch 线程数，防止超额订阅
+EMBED_BATCH_SIZE = 64                # 每个子进程任务的片段数
+EMBED_MAX_INFLIGHT = 2               # 每个子进程最多排队的批次数 (背压)
+PIPELINE_QUEUE_SIZE = 64             # 切分线程与向量化之间的有界队列 (单位：Markdown 结构片段)
+NEAR_DUP_ENABLED = True              # MinHash/LSH 近重复片段剔除 (重复摘要、多篇论文的相同段落)
+NEAR_DUP_FILE = "near_dup.sqlite"    # 规范片段签名 + LSH 桶 + 别名表
+BUILD_REPORT_FILE = "build_report.json"
+MANIFEST_FILE = "manifest.json"      # 增量构建清单：每个文件的内容哈希 + 它产生的片段 ID
+# 切分参数 (修改后所有文件会重新切分，但内容没变的片段仍复用已有向量)
+CHUNK_SIZE = 600
+CHUNK_OVERLAP = 50
+MIN_SPLIT_LENGTH = 800               # 结构切分后短于该长度的片段不再细切
 # =========================================
 
-def intelligent_chunking(documents):
+def build_breadcrumb(metadata):
     """
-    【核心升级】结构化语义切分 + 上下文注入
-    实现面试中提到的 "Structure-aware Semantic Chunking"
+    构造上下文前缀 (面包屑导航)
+    格式示例：【文档：混沌理论】【章节：Logistic映射】
     """
-    print(f"🔪 [Chunking] 开始对 {len(documents)} 份文档进行智能切分...")
-    final_chunks = []
-    
+    context_prefix = ""
+    if metadata.get("Title"): context_prefix += f"【主题: {metadata['Title']}】"
+    if metadata.get("Section"): context_prefix += f"【章节: {metadata['Section']}】"
+    if metadata.get("Subsection"): context_prefix += f"【小节: {metadata['Subsection']}】"
+    return context_prefix
+
+def make_splitters():
     # 1. 定义 Markdown 标题层级 (DeepSeek 清洗后的数据通常包含这些)
     headers_to_split_on = [
         ("#", "Title"),      # 一级标题
@@ -38,60 +75,321 @@ def intelligent_chunking(documents):
     markdown_splitter = MarkdownHeaderTextSplitter(headers_to_split_on=headers_to_split_on)
     # 物理层：处理超长段落的兜底方案 (窗口大小略大于 Embedding 限制)
     text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=600,       
-        chunk_overlap=50,     
+        chunk_size=CHUNK_SIZE,
+        chunk_overlap=CHUNK_OVERLAP,
         separators=["\n\n", "\n", "。", "！", "？", " ", ""] 
     )
+    return markdown_splitter, text_splitter
 
-    for doc in documents:
-        # 获取原始内容和源文件名
-        content = doc.page_content
-        source = doc.metadata.get("source", "unknown")
+def iter_sections(doc, markdown_splitter, text_splitter):
+    """
+    对单个文档逐个 Markdown 结构片段产出 (父段落, 子片段列表)，
+    流式构建时一次只需要持有一个结构片段
+    """
+    # 获取原始内容和源文件名
+    content = doc.page_content
+    source = doc.metadata.get("source", "unknown")
+    
+    # Step 1: 按 Markdown 结构粗切
+    # 这一步出来的 chunk 会自动带有 metadata={'Section': '...', 'Title': '...'}
+    md_header_splits = markdown_splitter.split_text(content)
+
+    # Step 2: 遍历粗切后的片段，进行细切和上下文注入
+    for split in md_header_splits:
+        # 继承源文件名
+        split.metadata["source"] = source
+
+        # 父段落 = 面包屑 + Markdown 结构切出来的完整片段
+        context_prefix = build_breadcrumb(split.metadata)
+        parent_content = f"{context_prefix}\n{split.page_content}" if context_prefix else split.page_content
+        parent_id = make_parent_id(source, context_prefix, split.page_content)
         
-        # Step 1: 按 Markdown 结构粗切
-        # 这一步出来的 chunk 会自动带有 metadata={'Section': '...', 'Title': '...'}
-        md_header_splits = markdown_splitter.split_text(content)
-
-        # Step 2: 遍历粗切后的片段，进行细切和上下文注入
-        for split in md_header_splits:
-            # 继承源文件名
-            split.metadata["source"] = source
-            
-            # 如果片段本身就很小 (比如 < 800 字符)，不用再切，保持逻辑完整性
-            if len(split.page_content) < 800:
-                sub_splits = [split]
-            else:
-                # 超长片段，进行滑动窗口细切
-                sub_splits = text_splitter.split_documents([split])
+        # 如果片段本身就很小 (比如 < 800 字符)，不用再切，保持逻辑完整性
+        if len(split.page_content) < MIN_SPLIT_LENGTH:
+            sub_splits = [split]
+        else:
+            # 超长片段，进行滑动窗口细切
+            sub_splits = text_splitter.split_documents([split])
+        
+        # Step 3: ★★★ 元数据注入 (Metadata Injection) ★★★
+        for sub_split in sub_splits:
+            sub_split.metadata["parent_id"] = parent_id
             
-            # Step 3: ★★★ 元数据注入 (Metadata Injection) ★★★
-            for sub_split in sub_splits:
-                # 从 metadata 提取标题结构
-                title = sub_split.metadata.get("Title", "")
-                section = sub_split.metadata.get("Section", "")
-                subsection = sub_split.metadata.get("Subsection", "")
-                
-                # 构造上下文前缀 (面包屑导航)
-                # 格式示例：【文档：混沌理论】【章节：Logistic映射】
-                context_prefix = ""
-                if title: context_prefix += f"【主题: {title}】"
-                if section: context_prefix += f"【章节: {section}】"
-                if subsection: context_prefix += f"【小节: {subsection}】"
-                
-                # 将上下文拼接到正文头部
-                # 这样 Embedding 向量就会包含这些层级信息，检索准确率大幅提升
-                if context_prefix:
-                    sub_split.page_content = f"{context_prefix}\n{sub_split.page_content}"
-                
-                final_chunks.append(sub_split)
-
-    print(f"✅ [Chunking] 切分完成，生成 {len(final_chunks)} 个语义片段 (已注入上下文元数据)。")
-    return final_chunks
-
-def build_vector_db():
-    print("🚀 开始构建向量数据库 ...")
-    
-    # 1. 强制清空旧数据库 (防止旧的垃圾切片残留)
+            # 将上下文拼接到正文头部
+            # 这样 Embedding 向量就会包含这些层级信息，检索准确率大幅提升
+            if context_prefix:
+                sub_split.page_content = f"{context_prefix}\n{sub_split.page_content}"
+
+        yield (parent_id, source, parent_content), sub_splits
+
+def drop_near_duplicates(items, near_dup):
+    """
+    items: [(片段ID, 片段), ...]
+    返回 (保留的 items, 被当作近重复命中的规范片段 ID 列表)
+    比较时去掉面包屑前缀，不同论文里相同的摘要/段落也能识别出来
+    """
+    kept, canonical_ids = [], []
+    for chunk_id, chunk in items:
+        prefix = build_breadcrumb(chunk.metadata)
+        text = chunk.page_content[len(prefix) + 1:] if prefix else chunk.page_content
+        canonical_id = near_dup.find_or_add(chunk_id, chunk.metadata["source"], text)
+        if canonical_id is None:
+            kept.append((chunk_id, chunk))
+        else:
+            canonical_ids.append(canonical_id)
+    return kept, canonical_ids
+
+def intelligent_chunking(documents, near_dup=None):
+    """
+    【核心升级】结构化语义切分 + 上下文注入
+    实现面试中提到的 "Structure-aware Semantic Chunking"
+    返回 (子片段列表, 父段落列表)：
+    - 子片段写入向量库，metadata 中带 parent_id
+    - 父段落 [(parent_id, source, 面包屑+完整内容)] 写入 ParentStore，检索命中后返回父段落
+    - 传入 near_dup (NearDupIndex) 时剔除近重复片段，只保留第一次出现的规范片段
+    """
+    print(f"🔪 [Chunking] 开始对 {len(documents)} 份文档进行智能切分...")
+    final_chunks = []
+    parents = []
+    dropped = 0
+    markdown_splitter, text_splitter = make_splitters()
+
+    for doc in documents:
+        for parent, sub_splits in iter_sections(doc, markdown_splitter, text_splitter):
+            parents.append(parent)
+            if near_dup is not None:
+                items = [(make_chunk_id(c.metadata["source"], c.page_content), c) for c in sub_splits]
+                kept, canonical_ids = drop_near_duplicates(items, near_dup)
+                sub_splits = [c for _, c in kept]
+                dropped += len(canonical_ids)
+            final_chunks.extend(sub_splits)
+
+    print(f"✅ [Chunking] 切分完成，生成 {len(final_chunks)} 个语义片段 / {len(parents)} 个父段落 (已注入上下文元数据)。")
+    if near_dup is not None:
+        print(f"🧹 [Chunking] 剔除近重复片段 {dropped} 个")
+    return final_chunks, parents
+
+def load_embeddings():
+    # 显式指定 device='cpu' 以节省显存
+    # 开启 normalize_embeddings 以优化余弦相似度检索
+    return HuggingFaceBgeEmbeddings(
+        model_name=EMBEDDING_MODEL,
+        model_kwargs={'device': 'cpu'},
+        encode_kwargs={'normalize_embeddings': True}
+    )
+
+# ==========================================
+# 并行向量化 (子进程)
+# ==========================================
+_worker_embeddings = None
+
+def _init_embed_worker(num_threads: int):
+    """子进程初始化：先钉住各类 BLAS / torch 线程数，再加载模型"""
+    global _worker_embeddings
+    for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "TOKENIZERS_PARALLELISM"):
+        os.environ[var] = "false" if var == "TOKENIZERS_PARALLELISM" else str(num_threads)
+    import torch
+    torch.set_num_threads(num_threads)
+    torch.set_num_interop_threads(1)
+    _worker_embeddings = load_embeddings()
+
+def _embed_batch(task):
+    """task: (起始下标, 文本列表) -> (起始下标, 向量列表)"""
+    start, texts = task
+    return start, _worker_embeddings.embed_documents(texts)
+
+def resolve_embed_workers() -> int:
+    if EMBED_WORKERS >= 0:
+        return EMBED_WORKERS
+    return max(1, (os.cpu_count() or 1) // EMBED_THREADS_PER_WORKER)
+
+class EmbedWriter:
+    """
+    向量化 + 写入阶段 (主进程是 Chroma 的唯一写入者)
+    - 已在集合中的片段 ID 不再计算向量，只更新元数据 (断点续跑 / 内容未变的片段)
+    - num_workers > 0 时向量化交给进程池，最多 EMBED_MAX_INFLIGHT 个批次在途，超过就等任意一个批次完成并写入 (背压)
+    - 在途批次按完成顺序写入，某个批次较慢时不会挡住已经算完的批次
+    """
+    def __init__(self, vectorstore, embeddings, num_workers: int):
+        self.collection = vectorstore._collection
+        self.embeddings = embeddings
+        self.pool = None
+        self.max_inflight = max(1, num_workers) * EMBED_MAX_INFLIGHT
+        self.pending = deque()
+        self.embedded = 0
+        self.reused = 0
+        self.started = time.perf_counter()
+        if num_workers > 0:
+            # spawn：子进程不继承父进程已初始化的 torch 线程池
+            ctx = multiprocessing.get_context("spawn")
+            self.pool = ctx.Pool(num_workers, initializer=_init_embed_worker, initargs=(EMBED_THREADS_PER_WORKER,))
+
+    def submit(self, ids, chunks):
+        existing = set(self.collection.get(ids=ids, include=[])["ids"])
+        if existing:
+            reused = [(cid, c) for cid, c in zip(ids, chunks) if cid in existing]
+            self.collection.update(ids=[cid for cid, _ in reused], metadatas=[c.metadata for _, c in reused])
+            self.reused += len(reused)
+        new = [(cid, c) for cid, c in zip(ids, chunks) if cid not in existing]
+        if not new:
+            return
+        new_ids = [cid for cid, _ in new]
+        new_chunks = [c for _, c in new]
+        texts = [c.page_content for c in new_chunks]
+        if self.pool is None:
+            self._write(new_ids, new_chunks, self.embeddings.embed_documents(texts))
+            return
+        self.pending.append((new_ids, new_chunks, self.pool.apply_async(_embed_batch, ((0, texts),))))
+        while len(self.pending) > self.max_inflight:
+            self._drain_one()
+
+    def _drain_one(self):
+        """写入最先完成的在途批次"""
+        while True:
+            for i, (ids, chunks, result) in enumerate(self.pending):
+                if result.ready():
+                    del self.pending[i]
+                    _, vectors = result.get()
+                    self._write(ids, chunks, vectors)
+                    return
+            self.pending[0][2].wait(0.05)
+
+    def _write(self, ids, chunks, vectors):
+        self.collection.add(
+            ids=ids,
+            embeddings=vectors,
+            documents=[c.page_content for c in chunks],
+            metadatas=[c.metadata for c in chunks],
+        )
+        self.embedded += len(ids)
+        elapsed = time.perf_counter() - self.started
+        print(f"\r  - 已写入 {self.embedded} 个新片段 (复用 {self.reused}) | {self.embedded / elapsed:.1f} 片段/秒", end="")
+
+    def flush(self):
+        """等待所有在途批次写完 (一个文件结束、写清单之前调用)"""
+        while self.pending:
+            self._drain_one()
+
+    def close(self):
+        self.flush()
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+
+def write_kb_version(num_chunks: int):
+    """每次构建生成新的版本戳，app.py 的语义答案缓存会丢弃旧版本的答案"""
+    version = {
+        "version": uuid.uuid4().hex,
+        "built_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "chunks": num_chunks,
+        "embedding_model": EMBEDDING_MODEL,
+    }
+    with open(os.path.join(PERSIST_DIRECTORY, KB_VERSION_FILE), "w", encoding="utf-8") as f:
+        json.dump(version, f, ensure_ascii=False, indent=2)
+    print(f"🏷️ 知识库版本: {version['version']}")
+
+# ==========================================
+# 增量 + 流式构建
+# - 片段 ID = md5(源文件 + 片段内容)，内容不变则 ID 不变，向量直接复用
+# - manifest.json 记录每个文件的内容哈希与切分参数；每个文件写完立即更新清单，
+#   进程中途退出后再次运行会跳过已完成的文件，半途的文件中已写入的片段也不会重复计算向量
+# - 流水线：发现文件 -> 加载 -> Markdown 结构切分 -> 细切 (后台线程)
+#   ==有界队列==> 向量化 -> 写入 (主线程/进程池)，切分与向量化重叠执行，内存占用与 ./data 大小无关
+# - BM25 / 父段落 / flat 索引等旁路索引在向量库更新后重建 (不需要重新计算向量)
+# ==========================================
+
+def make_chunk_id(source: str, content: str) -> str:
+    return hashlib.md5(f"{source}\n{content}".encode("utf-8")).hexdigest()
+
+def file_hash(file_path: str) -> str:
+    with open(file_path, "rb") as f:
+        return hashlib.md5(f.read()).hexdigest()
+
+def chunking_signature() -> dict:
+    return {"chunk_size": CHUNK_SIZE, "chunk_overlap": CHUNK_OVERLAP, "min_split_length": MIN_SPLIT_LENGTH}
+
+def load_manifest() -> dict:
+    path = os.path.join(PERSIST_DIRECTORY, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def save_manifest(manifest: dict):
+    manifest["updated_at"] = time.strftime("%Y-%m-%d %H:%M:%S")
+    path = os.path.join(PERSIST_DIRECTORY, MANIFEST_FILE)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)  # 原子替换，中途崩溃不会留下半个清单
+
+def iter_data_files():
+    # 优先加载 .md，因为那是 DeepSeek 清洗后的精华
+    yield from glob.iglob(os.path.join(DATA_DIRECTORY, "*.md"))
+    yield from glob.iglob(os.path.join(DATA_DIRECTORY, "*.txt"))
+
+def load_data_file(file_path: str):
+    loader = TextLoader(file_path, encoding='utf-8')
+    loaded_docs = loader.load()
+    # 记录文件名元数据
+    for doc in loaded_docs:
+        doc.metadata["source"] = os.path.basename(file_path)
+    return loaded_docs
+
+def iter_all_chunks(vectorstore, page_size: int = 2000):
+    """从 Chroma 集合分页读回全部片段 (重建 BM25 用，不需要重新切分未改动的文件)"""
+    collection = vectorstore._collection
+    for offset in range(0, collection.count(), page_size):
+        page = collection.get(limit=page_size, offset=offset, include=["documents", "metadatas"])
+        for content, metadata in zip(page["documents"], page["metadatas"]):
+            yield Document(page_content=content, metadata=metadata or {})
+
+def chunk_producer(changed_files, out_queue: queue.Queue, near_dup=None):
+    """
+    后台切分线程：逐个文件 加载 -> 结构切分 -> 细切 -> 近重复剔除，按结构片段放入有界队列
+    队列满时 put 阻塞 (背压)，保证切分不会跑得比向量化快太多
+    队列消息：("section", 文件名, 父段落, [(片段ID, 片段), ...], [命中的规范片段ID, ...]) /
+             ("file_done", 文件名, 哈希) / ("file_error", 文件名, 异常) / ("end", None, None)
+    """
+    markdown_splitter, text_splitter = make_splitters()
+    try:
+        for name, path, digest in changed_files:
+            try:
+                docs = load_data_file(path)
+            except Exception as e:
+                out_queue.put(("file_error", name, e))
+                continue
+            for doc in docs:
+                for parent, sub_splits in iter_sections(doc, markdown_splitter, text_splitter):
+                    items = [(make_chunk_id(name, c.page_content), c) for c in sub_splits]
+                    canonical_ids = []
+                    if near_dup is not None:
+                        items, canonical_ids = drop_near_duplicates(items, near_dup)
+                    out_queue.put(("section", name, parent, items, canonical_ids))
+            out_queue.put(("file_done", name, digest))
+    except Exception as e:
+        out_queue.put(("file_error", None, e))
+    finally:
+        out_queue.put(("end", None, None))
+
+def refresh_alias_metadata(collection, near_dup, chunk_ids):
+    """把别名表同步到规范片段的 metadata["alias_sources"] ("a.md|b.md")，没有别名时删除该字段"""
+    existing = collection.get(ids=list(chunk_ids), include=[])["ids"] if chunk_ids else []
+    if not existing:
+        return
+    aliases = near_dup.aliases_of(existing)
+    collection.update(
+        ids=existing,
+        metadatas=[{"alias_sources": "|".join(aliases[cid]) or None} for cid in existing],
+    )
+
+def write_build_report(report: dict):
+    path = os.path.join(PERSIST_DIRECTORY, BUILD_REPORT_FILE)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"📝 构建报告: {path}")
+
+def reset_persist_directory():
     if os.path.exists(PERSIST_DIRECTORY):
         print(f"🗑️ 检测到旧数据库 {PERSIST_DIRECTORY}，正在删除重建...")
         try:
@@ -100,73 +398,199 @@ def build_vector_db():
         except Exception as e:
             print(f"⚠️ 删除失败: {e}，尝试继续...")
 
-    # 2. 连接 Embedding
-    print(f"🔌 连接 BGE-M3 模型: {EMBEDDING_MODEL}...")
-    try:
-        # 显式指定 device='cpu' 以节省显存
-        # 开启 normalize_embeddings 以优化余弦相似度检索
-        embeddings = HuggingFaceBgeEmbeddings(
-            model_name=EMBEDDING_MODEL,
-            model_kwargs={'device': 'cpu'}, 
-            encode_kwargs={'normalize_embeddings': True}
-        )
-        # 简单测试一下，触发模型下载（如果第一次运行）
-        embeddings.embed_query("test")
-        print("✅ BGE-M3 模型加载成功！")
-    except Exception as e:
-        print(f"❌ 连接失败，请检查sentence-transformers是否安装: {e}")
-        return
+def build_vector_db(full_rebuild: bool = False):
+    """
+    默认增量更新；full_rebuild=True、没有清单、或 Embedding 模型变了时清空重建
+    """
+    print("🚀 开始构建向量数据库 ...")
+    started = time.perf_counter()
 
-    # 3. 加载 Markdown 文件
-    # 优先加载 .md，因为那是 DeepSeek 清洗后的精华
-    docs = []
-    files = glob.glob(os.path.join(DATA_DIRECTORY, "*.md")) + glob.glob(os.path.join(DATA_DIRECTORY, "*.txt"))
-    
-    print(f"📂 发现 {len(files)} 个数据文件 (.md/.txt)")
-    if len(files) == 0:
+    # 1. 读取清单，决定增量还是全量
+    manifest = None if full_rebuild else load_manifest()
+    if manifest is not None and manifest.get("embedding_model") != EMBEDDING_MODEL:
+        print(f"⚠️ Embedding 模型由 {manifest.get('embedding_model')} 变为 {EMBEDDING_MODEL}，需要全量重建")
+        manifest = None
+    if manifest is None:
+        # 强制清空旧数据库 (防止旧的垃圾切片残留)
+        reset_persist_directory()
+        manifest = {"embedding_model": EMBEDDING_MODEL, "files": {}}
+    else:
+        print(f"📒 增量模式：清单中已有 {len(manifest['files'])} 个文件")
+    os.makedirs(PERSIST_DIRECTORY, exist_ok=True)
+
+    # 2. 发现数据文件，对比哈希与切分参数
+    signature = chunking_signature()
+    files = manifest["files"]
+    seen, changed = {}, []
+    for path in iter_data_files():
+        name = os.path.basename(path)
+        digest = file_hash(path)
+        seen[name] = (path, digest)
+        entry = files.get(name)
+        if entry is None or entry["hash"] != digest or entry.get("chunking") != signature:
+            changed.append((name, path, digest))
+    deleted = [name for name in files if name not in seen]
+    print(f"📂 发现 {len(seen)} 个数据文件 (.md/.txt)")
+    if not seen:
         print("❌ 错误：未找到数据文件！请确保 ./data 目录下有清洗好的 Markdown 文件。")
         return
+    print(f"🔍 新增/修改 {len(changed)} 个，删除 {len(deleted)} 个，未变 {len(seen) - len(changed)} 个")
+    if not changed and not deleted:
+        print("✅ 知识库已是最新，无需更新")
+        return
 
-    for file_path in files:
+    # 近重复索引：先移除要重新处理的文件的规范片段；别的文件若有片段是它们的别名，也要一起重新处理
+    near_dup = NearDupIndex(os.path.join(PERSIST_DIRECTORY, NEAR_DUP_FILE)) if NEAR_DUP_ENABLED else None
+    touched_canonicals = set()
+    if near_dup is not None:
+        pending = [name for name, _, _ in changed] + deleted
+        processed = set()
+        while pending:
+            dependents, touched = near_dup.remove_sources(pending)
+            processed.update(pending)
+            touched_canonicals |= touched
+            pending = [name for name in dependents if name in seen and name not in processed]
+            for name in pending:
+                changed.append((name, *seen[name]))
+                print(f"  - 🔗 {name} 中有片段是被修改文件的别名，一并重新处理")
+
+    # 3. 连接 Embedding
+    # 并行模式下主进程只负责写入，模型由各子进程自己加载
+    num_workers = resolve_embed_workers() if changed else 0
+    embeddings = None
+    if changed and num_workers == 0:
+        print(f"🔌 连接 BGE-M3 模型: {EMBEDDING_MODEL}...")
         try:
-            loader = TextLoader(file_path, encoding='utf-8')
-            loaded_docs = loader.load()
-            # 记录文件名元数据
-            for doc in loaded_docs:
-                doc.metadata["source"] = os.path.basename(file_path)
-            docs.extend(loaded_docs)
-            print(f"  - 已加载: {os.path.basename(file_path)}")
+            embeddings = load_embeddings()
+            # 简单测试一下，触发模型下载（如果第一次运行）
+            embeddings.embed_query("test")
+            print("✅ BGE-M3 模型加载成功！")
         except Exception as e:
-            print(f"  - ❌ 加载失败 {file_path}: {e}")
-
-    # 4. 执行智能切分 (替代原来的 TextSplitter)
-    if not docs:
-        return
-        
-    chunks = intelligent_chunking(docs)
+            print(f"❌ 连接失败，请检查sentence-transformers是否安装: {e}")
+            return
+    elif changed:
+        print(f"🔌 并行模式: {num_workers} 个子进程 x {EMBED_THREADS_PER_WORKER} 线程，各自加载 {EMBEDDING_MODEL}")
 
-    # 5. 写入数据库
-    print(f"💾 开始写入 Chroma (Batch Size = {BATCH_SIZE})...")
     vectorstore = Chroma(
         embedding_function=embeddings,
         persist_directory=PERSIST_DIRECTORY,
         collection_name="chaos_science_db"
     )
+    collection = vectorstore._collection
+    parent_store = ParentStore(os.path.join(PERSIST_DIRECTORY, PARENT_STORE_FILE))
+
+    # 4. 已删除的文件：移除片段与父段落
+    for name in deleted:
+        collection.delete(where={"source": name})
+        parent_store.delete_sources([name])
+        del files[name]
+        save_manifest(manifest)
+        print(f"  - 🗑️ 已移除: {name}")
 
-    # 分批写入，显示进度条效果
-    total_chunks = len(chunks)
-    for i in range(0, total_chunks, BATCH_SIZE):
-        batch = chunks[i : i + BATCH_SIZE]
+    # 5. 流式切分 -> 有界队列 -> 向量化写入
+    if changed:
+        batch_size = EMBED_BATCH_SIZE if num_workers > 0 else BATCH_SIZE
+        print(f"💾 开始流式写入 Chroma (Batch Size = {batch_size}，队列上限 {PIPELINE_QUEUE_SIZE} 个结构片段)...")
+        section_queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        producer = threading.Thread(target=chunk_producer, args=(changed, section_queue, near_dup), daemon=True)
+        producer.start()
+        writer = EmbedWriter(vectorstore, embeddings, num_workers)
+        buffer, file_ids, file_parents, file_dropped = [], {}, {}, {}
         try:
-            vectorstore.add_documents(batch)
-            # 简单的进度打印
-            progress = ((i + len(batch)) / total_chunks) * 100
-            print(f"\r  - 写入进度: {progress:.1f}% ({i + len(batch)}/{total_chunks})", end="")
-        except Exception as e:
-            print(f"\n  ⚠️ 批次写入失败: {e}")
+            while True:
+                kind, name, *payload = section_queue.get()
+                if kind == "end":
+                    break
+                if kind == "file_error":
+                    # 加载失败的文件保持原状 (旧片段不删，清单不更新)，下次构建再试
+                    print(f"\n  - ❌ 加载失败 {name}: {payload[0]}")
+                    file_ids.pop(name, None)
+                    file_parents.pop(name, None)
+                    continue
+                if kind == "section":
+                    parent, items, canonical_ids = payload
+                    file_parents.setdefault(name, []).append(parent)
+                    touched_canonicals.update(canonical_ids)
+                    file_dropped[name] = file_dropped.get(name, 0) + len(canonical_ids)
+                    ids = file_ids.setdefault(name, set())
+                    for chunk_id, chunk in items:
+                        if chunk_id not in ids:
+                            ids.add(chunk_id)
+                            buffer.append((chunk_id, chunk))
+                    while len(buffer) >= batch_size:
+                        batch, buffer = buffer[:batch_size], buffer[batch_size:]
+                        writer.submit([cid for cid, _ in batch], [c for _, c in batch])
+                    continue
+
+                # file_done：先把该文件剩余片段写完，再清理旧片段、更新父段落，最后记入清单 (断点)
+                digest = payload[0]
+                if buffer:
+                    writer.submit([cid for cid, _ in buffer], [c for _, c in buffer])
+                    buffer = []
+                writer.flush()
+                ids = file_ids.pop(name, set())
+                old_ids = collection.get(where={"source": name}, include=[])["ids"]
+                stale = [cid for cid in old_ids if cid not in ids]
+                if stale:
+                    collection.delete(ids=stale)
+                parent_store.delete_sources([name])
+                parent_store.put_many(file_parents.pop(name, []))
+                if near_dup is not None:
+                    near_dup.commit()
+                    refresh_alias_metadata(collection, near_dup, touched_canonicals)
+                    touched_canonicals.clear()
+                files[name] = {
+                    "hash": digest, "chunking": signature,
+                    "chunks": len(ids), "near_dup_dropped": file_dropped.get(name, 0),
+                }
+                save_manifest(manifest)
+        finally:
+            writer.close()
+        producer.join()
+        print(f"\n✅ 新计算向量 {writer.embedded} 个，复用 {writer.reused} 个")
+    if near_dup is not None and touched_canonicals:
+        # 只有删除、没有重新处理的文件时，别名变化要在这里同步
+        refresh_alias_metadata(collection, near_dup, touched_canonicals)
+
+    # 6. 重建 BM25 词法索引 (与向量库使用完全相同的 chunk)
+    print("📇 构建 BM25 词法索引...")
+    bm25_path = os.path.join(PERSIST_DIRECTORY, BM25_INDEX_FILE)
+    BM25Index.build(iter_all_chunks(vectorstore)).save(bm25_path)
+    print(f"✅ BM25 索引已保存: {bm25_path}")
+    print(f"✅ 父段落存储已更新 (共 {len(parent_store)} 个)")
+
+    # 7. 导出内存映射 flat 索引 (CHAOS_VECTOR_BACKEND=flat 时使用)
+    flat_dir = os.path.join(PERSIST_DIRECTORY, FLAT_INDEX_DIR)
+    exported = export_flat_index(vectorstore, flat_dir, dtype=FLAT_INDEX_DTYPE)
+    print(f"✅ flat 索引已导出: {flat_dir} ({exported} 条 {FLAT_INDEX_DTYPE} 向量)")
+    if FLAT_INDEX_QUANTIZATION != "none" and exported:
+        quantizer = quantize_flat_index(flat_dir, FLAT_INDEX_QUANTIZATION)
+        print(f"✅ {FLAT_INDEX_QUANTIZATION} 压缩码已生成 ({quantizer.nbytes / 2**20:.1f} MB)，检索时先近似召回再精确重打分")
+
+    # 8. 写入知识库版本戳 (语义答案缓存据此判断旧答案是否失效)
+    total_chunks = collection.count()
+    write_kb_version(total_chunks)
+
+    # 9. 构建报告：近重复剔除效果按全部文件统计 (来自清单)
+    dropped_total = sum(entry.get("near_dup_dropped", 0) for entry in files.values())
+    report = {
+        "built_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "elapsed_s": round(time.perf_counter() - started, 2),
+        "files": len(files),
+        "files_processed": len(changed),
+        "files_deleted": len(deleted),
+        "chunks": total_chunks,
+        "near_dup_dropped": dropped_total,
+        "near_dup_ratio": round(dropped_total / (total_chunks + dropped_total), 4) if total_chunks + dropped_total else 0.0,
+        "per_file": {name: {"chunks": e.get("chunks", 0), "near_dup_dropped": e.get("near_dup_dropped", 0)} for name, e in sorted(files.items())},
+    }
+    print(f"🧹 近重复片段：共剔除 {dropped_total} 个 ({report['near_dup_ratio']:.1%})，向量库保留 {total_chunks} 个")
+    write_build_report(report)
 
-    print("\n\n知识库构建完成！")
+    print(f"\n\n知识库构建完成！耗时 {time.perf_counter() - started:.1f} 秒")
     # print("👉 你的数据现在拥有了【结构化上下文】，快去 app.py 提问试试！")
 
 if __name__ == "__main__":
-    build_vector_db()
+    # python build_db.py          增量更新 (默认)
+    # python build_db.py --full   清空重建
+    build_vector_db(full_rebuild="--full" in sys.argv[1:])
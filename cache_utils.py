@@ -0,0 +1,308 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from array import array
+from collections import OrderedDict
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from tracing import get_logger
+
+logger = get_logger("cache_utils")
+
+# ==========================================
+# 通用缓存工具 (供 rag_engine 等模块复用)
+# ==========================================
+
+KB_VERSION_FILE = "kb_version.json"  # 知识库版本戳，由 build_db.py 写入 Chroma 目录
+
+def normalize_query(query: str) -> str:
+    """
+    查询归一化：去首尾空白、合并连续空白、转小写、去掉句尾标点
+    这样 "什么是混沌？" 和 "什么是混沌 ?" 会命中同一个缓存键
+    """
+    text = re.sub(r"\s+", " ", query.strip().lower())
+    return text.rstrip("?？。.!！ ")
+
+def content_hash(text: str) -> str:
+    """文本内容哈希，用作 chunk 的稳定 ID"""
+    return hashlib.md5(text.encode("utf-8")).hexdigest()
+
+class LRUCache:
+    """
+    线程安全的有界 LRU 缓存 (Streamlit 多会话共享同一进程，需要加锁)
+    """
+    def __init__(self, max_size: int = 4096):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            # 超出容量时淘汰最久未使用的条目
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+class CachedEmbeddings(Embeddings):
+    """
+    查询向量缓存层：内存 LRU + SQLite 磁盘持久化
+    - key = (模型名, 归一化查询)，Streamlit 重启后依然有效
+    - 多个进程 (app.py / auto_data_factory.py) 共用同一个 SQLite 文件
+    - 只缓存 embed_query；embed_documents 直接透传给底层模型
+    """
+    def __init__(self, embeddings: Embeddings, model_name: str, db_path: str, max_size: int = 4096):
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.db_path = db_path
+        self.memory = LRUCache(max_size=max_size)
+        self._lock = threading.Lock()
+
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        # WAL 模式：允许一个进程写的同时其他进程读
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS query_embeddings ("
+            "model TEXT NOT NULL, query TEXT NOT NULL, vector BLOB NOT NULL, "
+            "PRIMARY KEY (model, query))"
+        )
+        self._conn.commit()
+
+    def _load(self, norm_query: str):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT vector FROM query_embeddings WHERE model = ? AND query = ?",
+                (self.model_name, norm_query),
+            ).fetchone()
+        if row is None:
+            return None
+        vector = array("f")
+        vector.frombytes(row[0])
+        return vector.tolist()
+
+    def _store(self, norm_query: str, vector):
+        blob = array("f", vector).tobytes()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO query_embeddings (model, query, vector) VALUES (?, ?, ?)",
+                (self.model_name, norm_query, blob),
+            )
+            self._conn.commit()
+
+    def embed_query(self, text: str):
+        norm_query = normalize_query(text)
+        key = (self.model_name, norm_query)
+
+        vector = self.memory.get(key)
+        if vector is not None:
+            return vector
+
+        vector = self._load(norm_query)
+        if vector is None:
+            vector = self.embeddings.embed_query(text)
+            try:
+                self._store(norm_query, vector)
+            except sqlite3.Error as e:
+                # 磁盘缓存写失败不影响检索
+                logger.warning(f"⚠️ [Embedding Cache] 写入失败: {e}")
+        self.memory.put(key, vector)
+        return vector
+
+    def embed_documents(self, texts):
+        return self.embeddings.embed_documents(texts)
+
+def read_kb_version(persist_directory: str) -> str:
+    """读取 build_db.build_vector_db 写入的知识库版本戳；没有时返回 "unknown" """
+    path = os.path.join(persist_directory, KB_VERSION_FILE)
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f).get("version", "unknown")
+    except (OSError, ValueError):
+        return "unknown"
+
+class SemanticAnswerCache:
+    """
+    语义答案缓存：以查询向量为键，余弦相似度超过阈值即视为同一问题 (覆盖大量改述提问)
+    - TTL 过期 + 超出容量时淘汰最久未命中的条目 (LRU)
+    - 每条记录带知识库版本戳，build_db 重建后旧答案自动失效
+    - 多个进程 (多个 Streamlit worker、benchmark.py) 共用同一个 SQLite 文件：每次查询先比对行数与最大 id，
+      其他进程写入或淘汰过条目时重新载入向量矩阵
+    """
+    def __init__(self, db_path: str, threshold: float = 0.92, ttl: float = 7 * 24 * 3600, max_entries: int = 2000):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS answers ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, kb_version TEXT NOT NULL, query TEXT NOT NULL, "
+            "embedding BLOB NOT NULL, answer TEXT NOT NULL, sources TEXT NOT NULL, "
+            "created_at REAL NOT NULL, last_hit REAL NOT NULL)"
+        )
+        self._conn.commit()
+        # 内存中的向量矩阵，仅包含当前知识库版本的条目
+        self._version = None
+        self._ids = []
+        self._signature = None  # (行数, 最大 id)，与 SQLite 中不一致说明其他进程改动过
+        self._matrix = np.zeros((0, 0), dtype=np.float32)
+
+    def _db_signature(self):
+        count, max_id = self._conn.execute("SELECT COUNT(*), COALESCE(MAX(id), 0) FROM answers").fetchone()
+        return count, max_id
+
+    def _sync(self, kb_version: str):
+        """知识库版本变化，或其他进程增删过条目时重新载入"""
+        if self._version != kb_version or self._db_signature() != self._signature:
+            self._reload(kb_version)
+
+    def _reload(self, kb_version: str):
+        """切换知识库版本：删除旧版本与过期条目，重新载入向量矩阵"""
+        now = time.time()
+        self._conn.execute("DELETE FROM answers WHERE kb_version != ? OR created_at < ?", (kb_version, now - self.ttl))
+        self._conn.commit()
+        rows = self._conn.execute("SELECT id, embedding FROM answers").fetchall()
+        self._ids = [row[0] for row in rows]
+        self._matrix = np.array([np.frombuffer(row[1], dtype=np.float32) for row in rows], dtype=np.float32)
+        self._signature = (len(self._ids), max(self._ids, default=0))
+        self._version = kb_version
+
+    def lookup(self, embedding, kb_version: str):
+        """返回 {"query", "answer", "sources", "similarity"}；未命中返回 None"""
+        query_vec = np.asarray(embedding, dtype=np.float32)
+        with self._lock:
+            self._sync(kb_version)
+            if not self._ids:
+                return None
+
+            sims = self._matrix @ query_vec
+            best = int(np.argmax(sims))
+            if sims[best] < self.threshold:
+                return None
+
+            entry_id = self._ids[best]
+            row = self._conn.execute(
+                "SELECT query, answer, sources, created_at FROM answers WHERE id = ?", (entry_id,)
+            ).fetchone()
+            now = time.time()
+            if row is None or row[3] < now - self.ttl:
+                self._reload(kb_version)
+                return None
+            self._conn.execute("UPDATE answers SET last_hit = ? WHERE id = ?", (now, entry_id))
+            self._conn.commit()
+        return {"query": row[0], "answer": row[1], "sources": json.loads(row[2]), "similarity": float(sims[best])}
+
+    def store(self, query: str, embedding, answer: str, sources, kb_version: str):
+        vec = np.asarray(embedding, dtype=np.float32)
+        now = time.time()
+        with self._lock:
+            self._sync(kb_version)
+            cur = self._conn.execute(
+                "INSERT INTO answers (kb_version, query, embedding, answer, sources, created_at, last_hit) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (kb_version, query, vec.tobytes(), answer, json.dumps(list(sources), ensure_ascii=False), now, now),
+            )
+            # 超出容量：淘汰最久未命中的条目
+            overflow = len(self._ids) + 1 - self.max_entries
+            if overflow > 0:
+                self._conn.execute(
+                    "DELETE FROM answers WHERE id IN (SELECT id FROM answers ORDER BY last_hit ASC LIMIT ?)",
+                    (overflow,),
+                )
+                self._conn.commit()
+                self._reload(kb_version)
+                return
+            self._conn.commit()
+            self._ids.append(cur.lastrowid)
+            self._signature = (len(self._ids), cur.lastrowid)
+            self._matrix = vec[None, :] if self._matrix.size == 0 else np.vstack([self._matrix, vec])
+
+class FigureCache:
+    """
+    渲染结果磁盘缓存：key -> (状态描述文本, PNG 字节)
+    - key 由调用方按 (工具名, 参数, 代码版本) 做内容寻址，相同的计算永远对应同一张图，不需要失效逻辑
+    - 总字节数超过 max_bytes 时淘汰最久未命中的条目
+    """
+    def __init__(self, db_path: str, max_bytes: int = 200 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS figures ("
+            "key TEXT PRIMARY KEY, text TEXT NOT NULL, png BLOB NOT NULL, "
+            "size INTEGER NOT NULL, last_hit REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    def get(self, key: str):
+        with self._lock:
+            row = self._conn.execute("SELECT text, png FROM figures WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute("UPDATE figures SET last_hit = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+        return row[0], bytes(row[1])
+
+    def put(self, key: str, text: str, png: bytes):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO figures (key, text, png, size, last_hit) VALUES (?, ?, ?, ?, ?)",
+                (key, text, png, len(png), time.time()),
+            )
+            # 超出容量：按最久未命中的顺序淘汰，直到总大小回到上限以内
+            total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM figures").fetchone()[0]
+            if total > self.max_bytes:
+                for old_key, size in self._conn.execute("SELECT key, size FROM figures ORDER BY last_hit ASC").fetchall():
+                    if total <= self.max_bytes or old_key == key:
+                        break
+                    self._conn.execute("DELETE FROM figures WHERE key = ?", (old_key,))
+                    total -= size
+            self._conn.commit()
+
+    def total_bytes(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM figures").fetchone()[0]
@@ -0,0 +1,187 @@
+import math
+import os
+import re
+from bm25_index import tokenize
+
+# ==========================================
+# 按 token 预算压缩送给 LLM 的上下文
+# - 把重排通过的父段落拆成句子，按 (段落重排分 x 句子与问题的词重叠) 打分，贪心选句直到用完预算
+# - 相邻输出块的面包屑 (【主题】【章节】) 相同时只输出一次，兄弟段落之间 chunk_overlap 造成的重复句子只保留一句
+# - 每段带编号来源 [n] 文件名，回答仍可追溯到原文
+# - 原文本来就在预算内时原样返回，不加标注 (标注本身也占 token)
+# 6GB 显存机器上 llama3.1 的 prompt eval 占了首字延迟的大头，上下文越短首字越快
+# ==========================================
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CHAOS_CONTEXT_BUDGET", "1200"))
+MIN_SENTENCE_CHARS = 4      # 更短的句子 (如 "好的。") 并入相邻句子；不含文字的碎片 (孤立的编号、符号) 丢弃
+LEAD_SENTENCE_BONUS = 0.1   # 段落首句通常是总起句，略微加分
+
+_CJK_CHAR = re.compile(r"[一-鿿]")
+_ASCII_WORD = re.compile(r"[A-Za-z0-9]+")
+_BREADCRUMB = re.compile(r"^((?:【[^】\n]*】)+)\n?")
+# 英文句末标点后必须是空白 + 大写字母/中文/引号括号，"e.g. a test" 这类小写接续不切开；紧跟中文时不要求空白
+_SENTENCE_END = re.compile(r"(?<=[。！？；])|(?<=[.!?;])(?=[一-鿿])|(?<=[.!?;])\s+(?=[A-Z一-鿿\"'(\[])|\n+")
+# 以常见缩写结尾的片段与下一段合并 ("Fig. 3"、"Dr. Smith"、"et al. The")
+_ABBREVIATION = re.compile(r"(?:\b(?:e\.g|i\.e|etc|vs|cf|al|Fig|Figs|Eq|Eqs|Ref|No|Dr|Mr|Mrs|Ms|Prof|St)|\b[A-Z])\.$")
+_HAS_TEXT = re.compile(r"[一-鿿A-Za-z]")
+_CJK_END = re.compile(r"[。！？；]$")
+_ASCII_END = re.compile(r"[.!?;]$")
+
+def estimate_tokens(text: str) -> int:
+    """
+    粗略估计 llama3 tokenizer 的 token 数 (不加载分词器)：
+    中文约 1 token/字，英文/数字约 1.3 token/词，其余非空白符号各算 1 个
+    """
+    cjk = len(_CJK_CHAR.findall(text))
+    words = _ASCII_WORD.findall(text)
+    others = len(re.sub(r"[\s一-鿿A-Za-z0-9]", "", text))
+    # 向上取整：逐句估计之和不低于整段估计，按句累加预算时不会超支
+    return math.ceil(cjk + 1.3 * len(words) + others)
+
+def split_breadcrumb(text: str):
+    """'【主题: X】【章节: Y】\\n正文' -> ('【主题: X】【章节: Y】', '正文')"""
+    match = _BREADCRUMB.match(text)
+    if not match:
+        return "", text
+    return match.group(1), text[match.end():]
+
+def split_sentences(text: str):
+    """按中英文句末标点与换行切句；含 LaTeX 公式 ($...$) 的行不切开"""
+    sentences = []
+    for line in text.split("\n"):
+        line = line.strip()
+        if not line:
+            continue
+        if "$" in line:
+            sentences.append(line)
+            continue
+        sentences.extend(_merge_fragments(s.strip() for s in _SENTENCE_END.split(line) if s and s.strip()))
+    return sentences
+
+def _glue(left: str, right: str) -> str:
+    """中文之间直接相连，英文之间补一个空格"""
+    if _CJK_CHAR.search(left[-1:]) or _CJK_END.search(left) or _CJK_CHAR.search(right[:1]):
+        return left + right
+    return left + " " + right
+
+def _merge_fragments(pieces):
+    """同一行内：缩写处误切的片段、过短的句子并入相邻句子，不含文字的碎片丢弃"""
+    merged = []
+    carry = ""  # 以缩写结尾的片段、行首过短的句子，并入下一句
+    for piece in pieces:
+        if not _HAS_TEXT.search(piece):
+            continue
+        if carry:
+            piece, carry = _glue(carry, piece), ""
+        if _ABBREVIATION.search(piece) or (not merged and len(piece) < MIN_SENTENCE_CHARS):
+            carry = piece
+        elif merged and len(piece) < MIN_SENTENCE_CHARS:
+            merged[-1] = _glue(merged[-1], piece)
+        else:
+            merged.append(piece)
+    if carry:
+        merged.append(carry)  # 整行只有一句短句时原样保留
+    return merged
+
+def _normalize(sentence: str) -> str:
+    return re.sub(r"\s+", "", sentence)
+
+def _join_sentences(sentences) -> str:
+    """中文句末标点直接相连，英文句末补一个空格，其余 (标题、列表项) 换行"""
+    parts = []
+    for s in sentences:
+        if _CJK_END.search(s):
+            parts.append(s)
+        elif _ASCII_END.search(s):
+            parts.append(s + " ")
+        else:
+            parts.append(s + "\n")
+    return "".join(parts).rstrip()
+
+def pack_context(query: str, passages, budget: int = CONTEXT_TOKEN_BUDGET):
+    """
+    passages: [(段落文本, 重排分数, 来源文件名), ...]，按重排分数降序
+    返回 (压缩后的上下文, 统计)，统计包含 original_tokens / packed_tokens / saved_tokens 等
+    原文不超过预算、或压缩后反而不比原文短时直接返回原文
+    """
+    original = "\n\n".join(text for text, _, _ in passages)
+    original_tokens = estimate_tokens(original)
+    if original_tokens <= budget:
+        sentences_total = sum(len(split_sentences(split_breadcrumb(text)[1])) for text, _, _ in passages)
+        return original, {
+            "budget": budget,
+            "original_tokens": original_tokens,
+            "packed_tokens": original_tokens,
+            "saved_tokens": 0,
+            "sentences_total": sentences_total,
+            "sentences_kept": sentences_total,
+            "passages_kept": len(passages),
+        }
+    query_terms = set(tokenize(query))
+
+    candidates = []   # (得分, 段落序号, 句子序号, 句子, token 数)
+    seen = set()
+    grouped = []      # [(面包屑, 来源, [句子...])]
+    for p_idx, (text, score, source) in enumerate(passages):
+        breadcrumb, body = split_breadcrumb(text)
+        sentences = split_sentences(body)
+        grouped.append((breadcrumb, source, sentences))
+        for s_idx, sentence in enumerate(sentences):
+            key = _normalize(sentence)
+            if key in seen:
+                continue  # 兄弟段落的重叠部分 / 重复句子
+            seen.add(key)
+            terms = set(tokenize(sentence))
+            overlap = len(terms & query_terms) / len(query_terms) if query_terms else 0.0
+            sentence_score = score * (0.5 + overlap) + (LEAD_SENTENCE_BONUS if s_idx == 0 else 0.0)
+            candidates.append((sentence_score, p_idx, s_idx, sentence, estimate_tokens(sentence)))
+
+    # 面包屑与来源标注也占预算，按段落估计一次
+    header_tokens = {
+        p_idx: estimate_tokens(f"[{p_idx + 1}] {source} {breadcrumb}")
+        for p_idx, (breadcrumb, source, _) in enumerate(grouped)
+    }
+
+    selected = set()
+    used = 0
+    opened = set()
+    for sentence_score, p_idx, s_idx, sentence, tokens in sorted(candidates, key=lambda c: -c[0]):
+        cost = tokens + (header_tokens[p_idx] if p_idx not in opened else 0)
+        if used + cost > budget:
+            continue
+        selected.add((p_idx, s_idx))
+        opened.add(p_idx)
+        used += cost
+    if not selected and candidates:
+        # 预算小于任何一句话时，至少保留得分最高的一句
+        _, p_idx, s_idx, _, _ = max(candidates, key=lambda c: c[0])
+        selected.add((p_idx, s_idx))
+        opened.add(p_idx)
+
+    # 按原文顺序还原，与上一个输出块面包屑相同的段落不再重复面包屑
+    blocks = []
+    prev_breadcrumb = None
+    for p_idx, (breadcrumb, source, sentences) in enumerate(grouped):
+        kept = [s for s_idx, s in enumerate(sentences) if (p_idx, s_idx) in selected]
+        if not kept:
+            continue
+        header = f"[{p_idx + 1}] {source}"
+        if breadcrumb and breadcrumb != prev_breadcrumb:
+            header += f" {breadcrumb}"
+        prev_breadcrumb = breadcrumb
+        blocks.append(header + "\n" + _join_sentences(kept))
+    packed = "\n\n".join(blocks)
+
+    packed_tokens = estimate_tokens(packed)
+    if packed_tokens >= original_tokens:
+        packed, packed_tokens = original, original_tokens
+    report = {
+        "budget": budget,
+        "original_tokens": original_tokens,
+        "packed_tokens": packed_tokens,
+        "saved_tokens": max(0, original_tokens - packed_tokens),
+        "sentences_total": sum(len(s) for _, _, s in grouped),
+        "sentences_kept": len(selected),
+        "passages_kept": len(opened),
+    }
+    return packed, report
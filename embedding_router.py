@@ -0,0 +1,251 @@
+import os
+import re
+import json
+import numpy as np
+from tracing import get_logger
+
+logger = get_logger("embedding_router")
+
+# ==========================================
+# 向量意图路由 (COMPUTE / RAG / CHAT)
+# - 用 BGE-M3 编码标注好的示例问句，按类别求质心；新问题取与各质心的余弦相似度
+# - 相似度经温度缩放 softmax 变成置信度，温度在示例上做留一法校准 (最小化负对数似然)
+# - 置信度低于 ROUTER_CONFIDENCE 时才回退到 router.init_router_chain 的 LLM 分类
+# - 查询向量走 rag_engine 的 CachedEmbeddings，RAG 检索时同一问题不会再编码一次
+# ==========================================
+
+ROUTER_CONFIDENCE = float(os.getenv("CHAOS_ROUTER_CONFIDENCE", "0.7"))
+ROUTER_KNN = 5              # 质心分 + kNN 分 各占一半，兼顾类别整体与个别相近示例
+TEMPERATURE_GRID = np.linspace(0.005, 0.2, 40)
+EVAL_EXEMPLAR_OVERLAP = 0.5  # 离线评估时与任一示例字符二元组 Jaccard ≥ 此值的问题视为示例改写，剔除
+LABELS = ["COMPUTE", "RAG", "CHAT"]
+
+EXEMPLARS = {
+    "COMPUTE": [
+        "计算r=3.5时的Logistic映射",
+        "r=3.2 是混沌吗",
+        "请用Logistic映射计算当r=3.7，初始值x0=0.4时迭代20次的值",
+        "画出Lorenz吸引子",
+        "帮我仿真一下这个方程",
+        "绘制Logistic映射在r从2.8到4之间的分岔图",
+        "计算r=3.9时Logistic映射的Lyapunov指数",
+        "画出Lorenz系统在ρ=28，σ=10，β=8/3时的相空间轨迹",
+        "模拟洛伦兹方程并画出时间序列",
+        "计算r=3.1时Logistic映射的稳定不动点",
+        "r=4 的时候迭代100次给我看看结果",
+        "把Lorenz系统两个相近初始条件的轨迹画出来对比",
+        "计算指标：r=3.83",
+        "用数值方法求解Lorenz方程，σ=10",
+        "simulate the logistic map with r=3.6",
+        "plot the Lorenz attractor",
+        "compute the Lyapunov exponent for r=3.8",
+        "给定r=2.9，计算Logistic映射收敛到的值",
+    ],
+    "RAG": [
+        "Logistic方程是什么？",
+        "Logistic映射的定义",
+        "介绍一下洛伦兹方程",
+        "它的参数r范围是多少？",
+        "什么是混沌理论中的蝴蝶效应？",
+        "解释非线性动力学中吸引子的概念",
+        "什么是Lyapunov指数？它有什么意义？",
+        "描述Lorenz系统方程及其各参数的物理意义",
+        "什么是相空间重构？",
+        "奇怪吸引子与平庸吸引子的区别",
+        "两个混沌系统之间如何实现同步",
+        "解释分岔现象并列举常见的分岔类型",
+        "Poincaré截面如何用于分析混沌系统？",
+        "混沌加密的基本原理是什么",
+        "Gierer-Meinhardt模型是什么",
+        "Feigenbaum常数是怎么来的",
+        "what is a strange attractor",
+        "OGY混沌控制方法的思想",
+    ],
+    "CHAT": [
+        "你好",
+        "你是谁",
+        "介绍一下你自己",
+        "谢谢你的帮助",
+        "今天天气怎么样",
+        "早上好",
+        "你能做什么",
+        "给我讲个笑话",
+        "再见",
+        "你叫什么名字",
+        "好的，明白了",
+        "你真厉害",
+        "hello",
+        "how are you",
+        "thanks a lot",
+        "我有点累了，陪我聊聊天",
+    ],
+}
+
+def _softmax(x):
+    x = x - x.max(axis=-1, keepdims=True)
+    e = np.exp(x)
+    return e / e.sum(axis=-1, keepdims=True)
+
+class EmbeddingRouter:
+    def __init__(self, embeddings, exemplars=EXEMPLARS, knn: int = ROUTER_KNN):
+        self.embeddings = embeddings
+        self.knn = knn
+        self.texts, self.labels = [], []
+        for label in LABELS:
+            for text in exemplars.get(label, []):
+                self.texts.append(text)
+                self.labels.append(LABELS.index(label))
+        self.labels = np.array(self.labels)
+        # 示例与用户问题一样按查询编码 (BGE 的查询指令前缀保持一致)
+        vectors = np.asarray([embeddings.embed_query(t) for t in self.texts], dtype=np.float32)
+        self.vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        self.temperature = self._calibrate()
+        self.centroids = self._centroids(np.ones(len(self.texts), dtype=bool))
+
+    def _centroids(self, mask):
+        centroids = np.stack([self.vectors[mask & (self.labels == i)].mean(axis=0) for i in range(len(LABELS))])
+        return centroids / np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+
+    def _class_scores(self, vec, mask=None):
+        """每个类别的相似度 = 0.5 * 质心余弦 + 0.5 * 该类最近 knn 个示例的平均余弦"""
+        if mask is None:
+            mask = np.ones(len(self.texts), dtype=bool)
+            centroids = self.centroids
+        else:
+            centroids = self._centroids(mask)
+        sims = self.vectors @ vec
+        scores = []
+        for i in range(len(LABELS)):
+            class_sims = np.sort(sims[mask & (self.labels == i)])[::-1][:self.knn]
+            scores.append(0.5 * float(centroids[i] @ vec) + 0.5 * float(class_sims.mean()))
+        return np.array(scores)
+
+    def _calibrate(self) -> float:
+        """留一法：每个示例用其余示例打分，选使真实类别负对数似然最小的温度"""
+        loo_scores = []
+        for idx in range(len(self.texts)):
+            mask = np.ones(len(self.texts), dtype=bool)
+            mask[idx] = False
+            loo_scores.append(self._class_scores(self.vectors[idx], mask))
+        loo_scores = np.stack(loo_scores)
+        best_t, best_nll = TEMPERATURE_GRID[0], float("inf")
+        for t in TEMPERATURE_GRID:
+            probs = _softmax(loo_scores / t)
+            nll = -np.mean(np.log(probs[np.arange(len(self.labels)), self.labels] + 1e-12))
+            if nll < best_nll:
+                best_t, best_nll = t, nll
+        accuracy = float(np.mean(loo_scores.argmax(axis=1) == self.labels))
+        logger.info(f"🧭 [Router] 示例 {len(self.texts)} 条，留一法准确率 {accuracy:.2%}，温度 {best_t:.3f}")
+        return float(best_t)
+
+    def classify(self, query: str):
+        """返回 (类别, 置信度, {类别: 概率})"""
+        vec = np.asarray(self.embeddings.embed_query(query), dtype=np.float32)
+        vec /= max(float(np.linalg.norm(vec)), 1e-12)
+        probs = _softmax(self._class_scores(vec) / self.temperature)
+        best = int(probs.argmax())
+        return LABELS[best], float(probs[best]), {label: float(p) for label, p in zip(LABELS, probs)}
+
+# ==========================================
+# 离线评估：以 LLM 路由 (关键词规则 + Llama3.1) 的结果为参考标签
+#   python embedding_router.py --questions question.txt
+# LLM 标签缓存在 bench_results/router_llm_labels.json，重复评估不需要再调用 Ollama
+# ==========================================
+def _char_bigrams(text: str):
+    text = re.sub(r"[\s\W_]+", "", text.lower())
+    return {text[i:i + 2] for i in range(len(text) - 1)} or {text}
+
+def split_exemplar_overlap(questions, exemplars=EXEMPLARS, threshold: float = EVAL_EXEMPLAR_OVERLAP):
+    """把与示例问句相同或近似改写的问题挑出来：它们参与了质心与温度校准，留在评估集里会虚高准确率"""
+    exemplar_grams = [_char_bigrams(t) for texts in exemplars.values() for t in texts]
+    kept, excluded = [], []
+    for q in questions:
+        grams = _char_bigrams(q)
+        overlap = max((len(grams & e) / len(grams | e) for e in exemplar_grams), default=0.0)
+        (excluded if overlap >= threshold else kept).append(q)
+    return kept, excluded
+
+def evaluate(questions, reference, router, thresholds=(0.5, 0.6, 0.7, 0.8, 0.9)):
+    """
+    reference: {问题: (LLM 路由类别, 命中方式)}；命中方式为 "keyword" 的问题规则已处理，不计入 LLM 调用
+    返回每个阈值下的 高置信一致率 (只统计向量路由直接采用的问题) 与 省掉的 LLM 调用占比；
+    混合一致率把回退 LLM 的问题按参考标签计为一致，只是上界，不能单独当作准确率看
+    """
+    rows = []
+    predictions = {q: router.classify(q) for q in questions if reference[q][1] != "keyword"}
+    needs_llm = len(predictions)
+    embedding_only = sum(predictions[q][0] == reference[q][0] for q in predictions)
+    for threshold in thresholds:
+        confident = [q for q in predictions if predictions[q][1] >= threshold]
+        agreed = sum(predictions[q][0] == reference[q][0] for q in confident)
+        rows.append({
+            "threshold": threshold,
+            "confident": len(confident),
+            "confident_agreement": agreed / len(confident) if confident else 0.0,
+            "llm_calls_avoided": len(confident) / needs_llm if needs_llm else 0.0,
+            # 置信度不够的问题回退 LLM，结果即参考标签
+            "hybrid_agreement": (agreed + len(questions) - len(confident)) / len(questions) if questions else 0.0,
+        })
+    return {
+        "questions": len(questions),
+        "keyword_routed": len(questions) - needs_llm,
+        "embedding_only_accuracy": embedding_only / needs_llm if needs_llm else 0.0,
+        "thresholds": rows,
+    }
+
+def main():
+    import argparse
+    import time
+    from router import init_router_chain, _classify
+
+    parser = argparse.ArgumentParser(description="向量意图路由离线评估")
+    parser.add_argument("--questions", default="question.txt")
+    parser.add_argument("--limit", type=int, default=0)
+    parser.add_argument("--labels", default="bench_results/router_llm_labels.json", help="LLM 参考标签缓存")
+    args = parser.parse_args()
+
+    with open(args.questions, "r", encoding="utf-8") as f:
+        questions = [line.strip() for line in f if line.strip()]
+    questions, excluded = split_exemplar_overlap(questions)
+    if excluded:
+        print(f"🧹 剔除 {len(excluded)} 个与示例问句相同或近似的问题 (字符二元组 Jaccard ≥ {EVAL_EXEMPLAR_OVERLAP})")
+    if args.limit:
+        questions = questions[:args.limit]
+
+    reference = {}
+    if os.path.exists(args.labels):
+        with open(args.labels, "r", encoding="utf-8") as f:
+            reference = {q: tuple(v) for q, v in json.load(f).items()}
+    missing = [q for q in questions if q not in reference]
+    if missing:
+        from langchain_ollama import ChatOllama
+        chain = init_router_chain(ChatOllama(model="llama3.1", temperature=0, base_url="http://127.0.0.1:11434"))
+        llm_time = 0.0
+        for i, q in enumerate(missing):
+            started = time.perf_counter()
+            reference[q] = _classify(q, chain)
+            llm_time += time.perf_counter() - started
+            print(f"\r🤖 LLM 参考标签 {i + 1}/{len(missing)}", end="")
+        print(f"\n⏱️ LLM 路由平均耗时 {llm_time / len(missing) * 1000:.0f} ms/问")
+        if os.path.dirname(args.labels):
+            os.makedirs(os.path.dirname(args.labels), exist_ok=True)
+        with open(args.labels, "w", encoding="utf-8") as f:
+            json.dump(reference, f, ensure_ascii=False, indent=2)
+
+    import rag_engine
+    router = rag_engine.get_embedding_router()
+    started = time.perf_counter()
+    report = evaluate(questions, reference, router)
+    per_query_ms = (time.perf_counter() - started) / max(1, len(questions) - report["keyword_routed"]) * 1000
+
+    print(f"\n📊 {report['questions']} 个问题，关键词规则直接处理 {report['keyword_routed']} 个")
+    print(f"   纯向量路由准确率 (对比 LLM 标签): {report['embedding_only_accuracy']:.2%}，平均 {per_query_ms:.1f} ms/问")
+    print(f"{'阈值':>6}{'高置信问题':>10}{'高置信一致率':>14}{'省掉LLM调用':>14}{'混合一致率*':>12}")
+    for row in report["thresholds"]:
+        print(f"{row['threshold']:>6.2f}{row['confident']:>10d}{row['confident_agreement']:>14.2%}"
+              f"{row['llm_calls_avoided']:>14.2%}{row['hybrid_agreement']:>12.2%}")
+    print("   * 回退 LLM 的问题按参考标签计为一致，是上界")
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
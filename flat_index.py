@@ -0,0 +1,337 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+import numpy as np
+from langchain_core.documents import Document
+from tracing import get_logger
+
+logger = get_logger("flat_index")
+
+# ==========================================
+# 内存映射的扁平向量索引 (Chroma 之外的可选检索后端)
+# - build_db.py 把归一化后的 BGE-M3 向量导出成一个连续的 .npy 文件 + SQLite 元数据表
+# - 查询时对 np.load(mmap_mode="r") 得到的矩阵做精确 top-k 内积
+# - 多个 Streamlit 进程共享同一份操作系统页缓存，启动几乎不耗时
+# ==========================================
+
+VECTORS_FILE = "vectors.npy"
+META_FILE = "meta.sqlite"
+SEARCH_BLOCK_ROWS = 65536  # 分块做矩阵-向量乘，float16 转 float32 时内存有上界
+
+def export_flat_index(vectorstore, out_dir: str, dtype: str = "float16", page_size: int = 2000):
+    """
+    从 Chroma 集合分页导出向量与元数据 (不会一次性把整个集合读进内存)
+    返回导出的向量条数
+    旧的压缩码是按上一次导出的行集合生成的，先删掉 (需要时由 quantize_flat_index 重新生成)；
+    集合为空时连旧的 vectors.npy / meta.sqlite 一起删除
+    """
+    collection = vectorstore._collection
+    total = collection.count()
+    os.makedirs(out_dir, exist_ok=True)
+    clear_quantized(out_dir)
+    if total == 0:
+        for name in (VECTORS_FILE, META_FILE):
+            path = os.path.join(out_dir, name)
+            if os.path.exists(path):
+                os.remove(path)
+        return 0
+
+    first = collection.get(limit=1, include=["embeddings"])
+    dim = len(first["embeddings"][0])
+    vectors = np.lib.format.open_memmap(
+        os.path.join(out_dir, VECTORS_FILE), mode="w+", dtype=np.dtype(dtype), shape=(total, dim)
+    )
+
+    meta_path = os.path.join(out_dir, META_FILE)
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    conn = sqlite3.connect(meta_path)
+    conn.execute("CREATE TABLE docs (row INTEGER PRIMARY KEY, id TEXT, content TEXT, metadata TEXT)")
+
+    row = 0
+    for offset in range(0, total, page_size):
+        page = collection.get(limit=page_size, offset=offset, include=["embeddings", "documents", "metadatas"])
+        emb = np.asarray(page["embeddings"], dtype=np.float32)
+        # 保险起见再归一化一次，内积即余弦相似度
+        emb /= np.maximum(np.linalg.norm(emb, axis=1, keepdims=True), 1e-12)
+        n = len(emb)
+        vectors[row:row + n] = emb.astype(vectors.dtype)
+        conn.executemany(
+            "INSERT INTO docs (row, id, content, metadata) VALUES (?, ?, ?, ?)",
+            [
+                (row + i, page["ids"][i], page["documents"][i], json.dumps(page["metadatas"][i] or {}, ensure_ascii=False))
+                for i in range(n)
+            ],
+        )
+        row += n
+
+    vectors.flush()
+    del vectors
+    conn.commit()
+    conn.close()
+    return row
+
+# ==========================================
+# 压缩向量 (int8 标量量化 / PQ 乘积量化)
+# 先在压缩码上做一遍近似打分选出 shortlist，再从磁盘上的全精度向量精确重打分
+# ==========================================
+QUANT_FILE = "quant.json"
+RESCORE_FACTOR = 10  # shortlist 大小 = max(k * RESCORE_FACTOR, RESCORE_MIN)
+RESCORE_MIN = 100
+
+class Int8Codes:
+    """逐维对称标量量化：code = round(v / scale * 127)，scale 为该维绝对值最大值"""
+    method = "int8"
+    files = ("int8_codes.npy", "int8_scale.npy")
+
+    def __init__(self, codes, scale):
+        self.codes = codes
+        self.scale = scale
+
+    @classmethod
+    def build(cls, vectors, block_rows: int = SEARCH_BLOCK_ROWS):
+        n, dim = vectors.shape
+        scale = np.zeros(dim, dtype=np.float32)
+        for start in range(0, n, block_rows):
+            block = np.asarray(vectors[start:start + block_rows], dtype=np.float32)
+            scale = np.maximum(scale, np.abs(block).max(axis=0))
+        scale = np.maximum(scale, 1e-12)
+        codes = np.empty((n, dim), dtype=np.int8)
+        for start in range(0, n, block_rows):
+            block = np.asarray(vectors[start:start + block_rows], dtype=np.float32)
+            codes[start:start + block_rows] = np.clip(np.rint(block / scale * 127), -127, 127)
+        return cls(codes, scale)
+
+    def save(self, out_dir: str):
+        np.save(os.path.join(out_dir, "int8_codes.npy"), self.codes)
+        np.save(os.path.join(out_dir, "int8_scale.npy"), self.scale)
+
+    @classmethod
+    def load(cls, index_dir: str, params: dict):
+        return cls(np.load(os.path.join(index_dir, "int8_codes.npy"), mmap_mode="r"),
+                   np.load(os.path.join(index_dir, "int8_scale.npy")))
+
+    @property
+    def nbytes(self) -> int:
+        return self.codes.nbytes + self.scale.nbytes
+
+    def approx_scores(self, query_vec, start: int, stop: int):
+        # (codes * scale / 127) @ q == codes @ (q * scale / 127)
+        return np.asarray(self.codes[start:stop], dtype=np.float32) @ (query_vec * self.scale / 127)
+
+class PQCodes:
+    """
+    乘积量化：向量切成 m 段，每段用 k-means 训练 256 个码字，每条向量只存 m 个 uint8
+    查询时先算每段到码字的内积查找表，再按码字查表求和
+    """
+    method = "pq"
+    files = ("pq_codes.npy", "pq_centroids.npy")
+
+    def __init__(self, codes, centroids):
+        self.codes = codes          # (n, m) uint8
+        self.centroids = centroids  # (m, 256, dsub) float32
+
+    @staticmethod
+    def _kmeans(data, n_clusters: int, iters: int, rng):
+        centroids = data[rng.choice(len(data), n_clusters, replace=len(data) < n_clusters)].copy()
+        for _ in range(iters):
+            # ||x - c||^2 = ||x||^2 - 2 x·c + ||c||^2，只需要后两项
+            dists = (centroids ** 2).sum(axis=1)[None, :] - 2 * data @ centroids.T
+            assign = dists.argmin(axis=1)
+            for c in range(n_clusters):
+                members = data[assign == c]
+                if len(members):
+                    centroids[c] = members.mean(axis=0)
+        return centroids
+
+    @classmethod
+    def build(cls, vectors, m: int = 64, n_clusters: int = 256, iters: int = 15,
+              train_size: int = 20000, block_rows: int = SEARCH_BLOCK_ROWS, seed: int = 0):
+        n, dim = vectors.shape
+        if dim % m != 0:
+            raise ValueError(f"向量维度 {dim} 不能被 PQ 分段数 m={m} 整除")
+        dsub = dim // m
+        rng = np.random.default_rng(seed)
+        sample_rows = np.sort(rng.choice(n, min(n, train_size), replace=False))
+        sample = np.asarray(vectors[sample_rows], dtype=np.float32)
+
+        centroids = np.stack([
+            cls._kmeans(sample[:, j * dsub:(j + 1) * dsub], n_clusters, iters, rng) for j in range(m)
+        ]).astype(np.float32)
+
+        codes = np.empty((n, m), dtype=np.uint8)
+        c_norms = (centroids ** 2).sum(axis=2)  # (m, 256)
+        for start in range(0, n, block_rows):
+            block = np.asarray(vectors[start:start + block_rows], dtype=np.float32)
+            for j in range(m):
+                sub = block[:, j * dsub:(j + 1) * dsub]
+                codes[start:start + len(block), j] = (c_norms[j][None, :] - 2 * sub @ centroids[j].T).argmin(axis=1)
+        return cls(codes, centroids)
+
+    def save(self, out_dir: str):
+        np.save(os.path.join(out_dir, "pq_codes.npy"), self.codes)
+        np.save(os.path.join(out_dir, "pq_centroids.npy"), self.centroids)
+
+    @classmethod
+    def load(cls, index_dir: str, params: dict):
+        return cls(np.load(os.path.join(index_dir, "pq_codes.npy"), mmap_mode="r"),
+                   np.load(os.path.join(index_dir, "pq_centroids.npy")))
+
+    @property
+    def nbytes(self) -> int:
+        return self.codes.nbytes + self.centroids.nbytes
+
+    def approx_scores(self, query_vec, start: int, stop: int):
+        m, _, dsub = self.centroids.shape
+        lut = np.einsum("mkd,md->mk", self.centroids, query_vec.reshape(m, dsub))  # (m, 256)
+        codes = np.asarray(self.codes[start:stop])
+        return lut[np.arange(m)[None, :], codes].sum(axis=1)
+
+QUANTIZERS = {"int8": Int8Codes, "pq": PQCodes}
+
+def clear_quantized(index_dir: str):
+    """删除 quant.json 与所有压缩码文件"""
+    for name in (QUANT_FILE,) + tuple(f for q in QUANTIZERS.values() for f in q.files):
+        path = os.path.join(index_dir, name)
+        if os.path.exists(path):
+            os.remove(path)
+
+def quantize_flat_index(index_dir: str, method: str, **params):
+    """
+    在已导出的 flat 索引上生成压缩码 (全精度 vectors.npy 保留在磁盘上用于精确重打分)
+    """
+    vectors = np.load(os.path.join(index_dir, VECTORS_FILE), mmap_mode="r")
+    quantizer = QUANTIZERS[method].build(vectors, **params)
+    quantizer.save(index_dir)
+    with open(os.path.join(index_dir, QUANT_FILE), "w", encoding="utf-8") as f:
+        # 记录生成压缩码时的行数与维度，加载时据此识别过期的压缩码
+        json.dump({"method": method, "params": params, "rows": int(vectors.shape[0]), "dim": int(vectors.shape[1])}, f)
+    return quantizer
+
+class FlatVectorIndex:
+    """
+    与 rag_engine 用到的 Chroma 接口保持一致：
+    similarity_search / similarity_search_with_relevance_scores / embeddings
+    目录中有 quant.json 时 (且 use_quantized=True) 先用压缩码近似打分，再对 shortlist 精确重打分
+    """
+    def __init__(self, index_dir: str, embedding_function, use_quantized: bool = True):
+        self.index_dir = index_dir
+        self.embeddings = embedding_function
+        self.vectors = np.load(os.path.join(index_dir, VECTORS_FILE), mmap_mode="r")
+        self.quantizer = None
+        quant_path = os.path.join(index_dir, QUANT_FILE)
+        if use_quantized and os.path.exists(quant_path):
+            with open(quant_path, "r", encoding="utf-8") as f:
+                quant = json.load(f)
+            if (quant.get("rows"), quant.get("dim")) == tuple(self.vectors.shape):
+                self.quantizer = QUANTIZERS[quant["method"]].load(index_dir, quant.get("params", {}))
+            else:
+                logger.warning(f"⚠️ [Flat Index] 压缩码对应 {quant.get('rows')}x{quant.get('dim')} 的向量，"
+                               f"与当前 {self.vectors.shape[0]}x{self.vectors.shape[1]} 不一致，忽略压缩码改为精确扫描")
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(index_dir, META_FILE), check_same_thread=False)
+
+    def __len__(self):
+        return self.vectors.shape[0]
+
+    def _exact_scores(self, query_vec, start: int, stop: int):
+        return np.asarray(self.vectors[start:stop], dtype=np.float32) @ query_vec
+
+    def _top_k(self, query_vec: np.ndarray, k: int, quantizer=None):
+        """
+        top-k 检索，返回 (行号数组, 余弦相似度数组)，按相似度降序
+        quantizer 为空时分块精确计算；否则压缩码近似选 shortlist，再从全精度向量精确重打分
+        """
+        if quantizer is None:
+            return self._scan(query_vec, k, self._exact_scores)
+        shortlist = max(k * RESCORE_FACTOR, RESCORE_MIN)
+        rows, _ = self._scan(query_vec, shortlist, quantizer.approx_scores)
+        rows = np.sort(rows)  # 顺序读磁盘
+        sims = np.asarray(self.vectors[rows], dtype=np.float32) @ query_vec
+        order = np.argsort(-sims)[:k]
+        return rows[order], sims[order]
+
+    def _scan(self, query_vec: np.ndarray, k: int, score_fn):
+        """分块扫描，score_fn(query_vec, start, stop) 返回该块的分数"""
+        best_rows = np.empty(0, dtype=np.int64)
+        best_sims = np.empty(0, dtype=np.float32)
+        for start in range(0, self.vectors.shape[0], SEARCH_BLOCK_ROWS):
+            sims = score_fn(query_vec, start, start + SEARCH_BLOCK_ROWS)
+            if len(sims) > k:
+                idx = np.argpartition(-sims, k)[:k]
+            else:
+                idx = np.arange(len(sims))
+            best_rows = np.concatenate([best_rows, idx + start])
+            best_sims = np.concatenate([best_sims, sims[idx]])
+            if len(best_sims) > k:
+                keep = np.argpartition(-best_sims, k)[:k]
+                best_rows, best_sims = best_rows[keep], best_sims[keep]
+        order = np.argsort(-best_sims)
+        return best_rows[order], best_sims[order]
+
+    def _fetch(self, rows):
+        with self._lock:
+            found = {
+                row: (content, metadata)
+                for row, content, metadata in self._conn.execute(
+                    f"SELECT row, content, metadata FROM docs WHERE row IN ({','.join('?' * len(rows))})",
+                    [int(r) for r in rows],
+                )
+            }
+        return [Document(page_content=found[int(r)][0], metadata=json.loads(found[int(r)][1])) for r in rows]
+
+    def similarity_search_with_relevance_scores(self, query: str, k: int = 4):
+        if len(self) == 0:
+            return []
+        query_vec = np.asarray(self.embeddings.embed_query(query), dtype=np.float32)
+        rows, sims = self._top_k(query_vec, k, self.quantizer)
+        # 换算成与 Chroma 相同尺度的相关度：Chroma 的 L2 距离是平方距离 ||a-b||² = 2 - 2cos，
+        # LangChain 再按 1 - d / √2 换算，即 1 - (2 - 2cos) / √2
+        relevance = 1.0 - (2.0 - 2.0 * sims) / np.sqrt(2.0)
+        return list(zip(self._fetch(rows), relevance.tolist()))
+
+    def similarity_search(self, query: str, k: int = 4):
+        return [doc for doc, _ in self.similarity_search_with_relevance_scores(query, k)]
+
+def evaluate_quantization(index_dir: str, methods=("int8", "pq"), n_queries: int = 200, k: int = 30, seed: int = 0):
+    """
+    离线评估各压缩方案：内存占用、recall@k (以未压缩的精确检索为基准)、单次查询延迟
+    查询向量取自索引中随机抽样的向量并加少量噪声，不需要加载 Embedding 模型
+    """
+    index = FlatVectorIndex(index_dir, embedding_function=None, use_quantized=False)
+    n, dim = index.vectors.shape
+    rng = np.random.default_rng(seed)
+    queries = np.asarray(index.vectors[np.sort(rng.choice(n, min(n, n_queries), replace=False))], dtype=np.float32)
+    queries += rng.normal(scale=0.05, size=queries.shape).astype(np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+
+    def run(quantizer):
+        results, started = [], time.perf_counter()
+        for q in queries:
+            results.append(set(index._top_k(q, k, quantizer)[0].tolist()))
+        return results, (time.perf_counter() - started) / len(queries) * 1000
+
+    exact, exact_ms = run(None)
+    report = [{"method": "exact", "memory_mb": index.vectors.nbytes / 2**20, "recall": 1.0, "latency_ms": exact_ms}]
+    for method in methods:
+        quantizer = QUANTIZERS[method].build(index.vectors)
+        approx, ms = run(quantizer)
+        recall = sum(len(a & e) / len(e) for a, e in zip(approx, exact)) / len(exact)
+        report.append({"method": method, "memory_mb": quantizer.nbytes / 2**20, "recall": recall, "latency_ms": ms})
+
+    print(f"📏 flat 索引: {n} 条 x {dim} 维 ({index.vectors.dtype})，{len(queries)} 个查询，recall@{k}")
+    print(f"{'method':<8}{'内存(MB)':>12}{f'recall@{k}':>12}{'延迟(ms)':>12}")
+    for row in report:
+        print(f"{row['method']:<8}{row['memory_mb']:>12.1f}{row['recall']:>12.3f}{row['latency_ms']:>12.2f}")
+    return report
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="flat 索引压缩方案评估")
+    parser.add_argument("--index-dir", default="./chroma_db/flat_index")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=30)
+    args = parser.parse_args()
+    evaluate_quantization(args.index_dir, n_queries=args.queries, k=args.k)
@@ -0,0 +1,156 @@
+import os
+import re
+import zlib
+import sqlite3
+import threading
+import numpy as np
+
+# ==========================================
+# 近重复片段检测 (MinHash + LSH)
+# - 片段去掉面包屑前缀后做字符 n-gram，MinHash 签名估计 Jaccard 相似度
+# - LSH 分桶 (NUM_BANDS 个 band x ROWS_PER_BAND 行) 只和同桶候选比较，不需要两两比对
+# - 签名与分桶持久化在 SQLite 里，增量构建时新片段也能和历史片段去重
+# ==========================================
+
+NUM_PERM = 128
+NUM_BANDS = 16          # 16 x 8：相似度约 0.7 以上的片段大概率落入同一个桶
+ROWS_PER_BAND = NUM_PERM // NUM_BANDS
+SHINGLE_SIZE = 5        # 字符 5-gram (中英文混排都适用)
+NEAR_DUP_THRESHOLD = 0.85  # 估计 Jaccard 超过该值视为近重复
+MIN_DEDUP_CHARS = 80    # 归一化后短于该长度的片段不参与去重 (短片段里一个数字不同就是不同的内容)
+_MERSENNE_PRIME = (1 << 61) - 1
+
+_rng = np.random.default_rng(20240601)  # 固定种子：签名需要跨进程、跨构建保持一致
+_PERM_A = _rng.integers(1, 1 << 31, size=NUM_PERM, dtype=np.uint64)
+_PERM_B = _rng.integers(0, 1 << 31, size=NUM_PERM, dtype=np.uint64)
+
+def normalize_text(text: str) -> str:
+    """忽略大小写、空白与常见标点差异"""
+    return re.sub(r"[\s，。！？、；：,.!?;:\"'“”‘’()（）\[\]【】]+", "", text.lower())
+
+def minhash_signature(text: str) -> np.ndarray:
+    """text 需已经过 normalize_text"""
+    if len(text) <= SHINGLE_SIZE:
+        shingles = {text}
+    else:
+        shingles = {text[i:i + SHINGLE_SIZE] for i in range(len(text) - SHINGLE_SIZE + 1)}
+    hashes = np.fromiter((zlib.crc32(s.encode("utf-8")) for s in shingles), dtype=np.uint64, count=len(shingles))
+    # (a * x + b) mod p，a/b < 2^31、x < 2^32，乘积不会溢出 uint64
+    permuted = (hashes[:, None] * _PERM_A[None, :] + _PERM_B[None, :]) % _MERSENNE_PRIME
+    return (permuted.min(axis=0) & 0xFFFFFFFF).astype(np.uint32)
+
+def band_keys(signature: np.ndarray):
+    return [
+        zlib.crc32(signature[b * ROWS_PER_BAND:(b + 1) * ROWS_PER_BAND].tobytes())
+        for b in range(NUM_BANDS)
+    ]
+
+def estimate_similarity(sig_a: np.ndarray, sig_b: np.ndarray) -> float:
+    return float(np.mean(sig_a == sig_b))
+
+class NearDupIndex:
+    """
+    规范片段 (canonical) 的 MinHash 签名 + LSH 桶 + 别名表
+    别名 = 被判为近重复而丢弃的片段所在的源文件，记录在规范片段的 metadata["alias_sources"] 中
+    """
+    def __init__(self, db_path: str, threshold: float = NEAR_DUP_THRESHOLD):
+        self.threshold = threshold
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self._conn.executescript(
+            "CREATE TABLE IF NOT EXISTS signatures (chunk_id TEXT PRIMARY KEY, source TEXT, sig BLOB NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS bands (band INTEGER, bucket INTEGER, chunk_id TEXT);"
+            "CREATE INDEX IF NOT EXISTS idx_bands ON bands (band, bucket);"
+            "CREATE INDEX IF NOT EXISTS idx_bands_chunk ON bands (chunk_id);"
+            "CREATE INDEX IF NOT EXISTS idx_sig_source ON signatures (source);"
+            "CREATE TABLE IF NOT EXISTS aliases (chunk_id TEXT, alias_source TEXT, PRIMARY KEY (chunk_id, alias_source));"
+            "CREATE INDEX IF NOT EXISTS idx_alias_source ON aliases (alias_source);"
+        )
+        self._conn.commit()
+
+    def find_or_add(self, chunk_id: str, source: str, text: str):
+        """
+        有近重复的规范片段时记录别名并返回其 chunk_id (调用方应丢弃当前片段)；
+        否则把当前片段登记为规范片段并返回 None
+        """
+        text = normalize_text(text)
+        if len(text) < MIN_DEDUP_CHARS:
+            return None
+        signature = minhash_signature(text)
+        keys = band_keys(signature)
+        with self._lock:
+            candidates = set()
+            for band, bucket in enumerate(keys):
+                candidates.update(
+                    row[0] for row in self._conn.execute(
+                        "SELECT chunk_id FROM bands WHERE band = ? AND bucket = ?", (band, bucket)
+                    )
+                )
+            candidates.discard(chunk_id)
+            best_id, best_source, best_sim = None, None, self.threshold
+            for cand in candidates:
+                row = self._conn.execute("SELECT sig, source FROM signatures WHERE chunk_id = ?", (cand,)).fetchone()
+                if row is None:
+                    continue
+                sim = estimate_similarity(signature, np.frombuffer(row[0], dtype=np.uint32))
+                if sim >= best_sim:
+                    best_id, best_source, best_sim = cand, row[1], sim
+            if best_id is not None:
+                # 同一文件内的近重复直接丢弃，不记别名
+                if best_source != source:
+                    self._conn.execute("INSERT OR IGNORE INTO aliases (chunk_id, alias_source) VALUES (?, ?)", (best_id, source))
+                return best_id
+
+            self._conn.execute(
+                "INSERT OR REPLACE INTO signatures (chunk_id, source, sig) VALUES (?, ?, ?)",
+                (chunk_id, source, signature.tobytes()),
+            )
+            self._conn.executemany(
+                "INSERT INTO bands (band, bucket, chunk_id) VALUES (?, ?, ?)",
+                [(band, bucket, chunk_id) for band, bucket in enumerate(keys)],
+            )
+            return None
+
+    def commit(self):
+        with self._lock:
+            self._conn.commit()
+
+    def aliases_of(self, chunk_ids):
+        """{chunk_id: [别名源文件, ...]}，没有别名的 chunk_id 对应空列表"""
+        result = {cid: [] for cid in chunk_ids}
+        with self._lock:
+            for cid in chunk_ids:
+                result[cid] = [
+                    row[0] for row in self._conn.execute(
+                        "SELECT alias_source FROM aliases WHERE chunk_id = ? ORDER BY alias_source", (cid,)
+                    )
+                ]
+        return result
+
+    def remove_sources(self, sources):
+        """
+        移除这些源文件的规范片段与别名记录 (文件被修改/删除前调用)
+        返回 (依赖文件集合, 别名发生变化的规范片段集合)：
+        - 依赖文件：它们的片段曾被判为这些文件中某个规范片段的别名，规范片段消失后需要重新处理
+        - 别名变化的规范片段：需要刷新 metadata["alias_sources"]
+        """
+        dependents, touched = set(), set()
+        with self._lock:
+            for source in sources:
+                owned = [row[0] for row in self._conn.execute("SELECT chunk_id FROM signatures WHERE source = ?", (source,))]
+                for cid in owned:
+                    dependents.update(
+                        row[0] for row in self._conn.execute("SELECT alias_source FROM aliases WHERE chunk_id = ?", (cid,))
+                    )
+                    self._conn.execute("DELETE FROM aliases WHERE chunk_id = ?", (cid,))
+                    self._conn.execute("DELETE FROM bands WHERE chunk_id = ?", (cid,))
+                self._conn.execute("DELETE FROM signatures WHERE source = ?", (source,))
+                touched.update(
+                    row[0] for row in self._conn.execute("SELECT chunk_id FROM aliases WHERE alias_source = ?", (source,))
+                )
+                self._conn.execute("DELETE FROM aliases WHERE alias_source = ?", (source,))
+            self._conn.commit()
+        return dependents - set(sources), touched
@@ -0,0 +1,53 @@
+import os
+import sqlite3
+import hashlib
+import threading
+
+# ==========================================
+# 父段落存储 (Parent Docstore)
+# 向量库只存小的子片段，检索命中后通过 parent_id 取回完整的父段落 (标题 + 内容)
+# ==========================================
+
+def make_parent_id(source: str, breadcrumb: str, content: str) -> str:
+    """由 源文件 + 标题路径 + 内容 生成稳定的父段落 ID (重建知识库后保持不变)"""
+    return hashlib.md5(f"{source}\n{breadcrumb}\n{content}".encode("utf-8")).hexdigest()
+
+class ParentStore:
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS parents ("
+            "parent_id TEXT PRIMARY KEY, source TEXT, content TEXT NOT NULL)"
+        )
+        self._conn.commit()
+
+    def put_many(self, parents):
+        """parents: [(parent_id, source, content), ...]"""
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO parents (parent_id, source, content) VALUES (?, ?, ?)",
+                parents,
+            )
+            self._conn.commit()
+
+    def delete_sources(self, sources):
+        """删除指定源文件的所有父段落 (增量构建时文件被修改或删除)"""
+        with self._lock:
+            self._conn.executemany("DELETE FROM parents WHERE source = ?", [(s,) for s in sources])
+            self._conn.commit()
+
+    def get(self, parent_id: str):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT content FROM parents WHERE parent_id = ?", (parent_id,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM parents").fetchone()[0]
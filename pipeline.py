@@ -0,0 +1,147 @@
+import re
+import time
+from langchain_core.prompts import ChatPromptTemplate
+from tracing import span
+import tools
+
+# ==========================================
+# 问答流水线的公共部分 (app.py / benchmark.py 共用)
+# 保证压测走的是和 Streamlit 界面完全相同的提示词与计算分发逻辑
+# ==========================================
+
+RAG_PROMPT = ChatPromptTemplate.from_template(
+    "你是一个严谨的研究助手。请仅基于以下文献回答问题：\n\n文献内容:\n{context}\n\n用户问题: {question}"
+    "在回答用户问题时，如果涉及到输出内容有公式，请严格按照Latex进行公式输出"
+    "在回答用户问题时，如果段落过长需要分点回答，请分点回答，并按照一级标题-内容进行输出"
+    "文献内容中的 [编号] 对应来源文件，引用时可以用 [编号] 标注出处"
+)
+
+FALLBACK_PROMPT = ChatPromptTemplate.from_template(
+    "用户问题: {question}\n请利用你的通用知识回答。如果不知道就直说。"
+)
+
+CHAT_PROMPT = ChatPromptTemplate.from_template(
+    "用户说: {question}\n请用简练、友好的语气回复。"
+    "在回答数值计算问题时，严格根据工具返回的结果进行判断，自己别乱说"
+)
+
+RAG_ANSWER_PREFIX = "📚 **基于本地文献的回答：**\n\n"
+FALLBACK_ANSWER_SUFFIX = "\n\n*(注: 此回答基于通用知识，非本地文献)*"
+
+def is_rag_fallback(rag_result: str) -> bool:
+    """rag_engine 在没搜到时会返回包含"资料不足"/"未找到相关文档"的字符串"""
+    return "资料不足" in rag_result or "未找到相关文档" in rag_result
+
+def build_answer_chain(llm, mode: str):
+    """mode: "rag" / "fallback" / "chat" """
+    prompt = {"rag": RAG_PROMPT, "fallback": FALLBACK_PROMPT, "chat": CHAT_PROMPT}[mode]
+    return prompt | llm
+
+class AnswerStream:
+    """
+    流式生成回答：迭代时逐段产出文本 (可直接交给 st.write_stream)，迭代结束后
+    .text 为完整回答，.metrics 为首字延迟 (TTFT)、总耗时、输出 token 数与解码速度，
+    同时记录到 generate span 上
+    """
+    def __init__(self, chain, inputs: dict, mode: str):
+        self.chain = chain
+        self.inputs = inputs
+        self.mode = mode
+        self.text = ""
+        self.metrics = {}
+
+    def __iter__(self):
+        parts = []
+        usage = {}
+        pieces = 0
+        first_token_s = None
+        with span("generate", mode=self.mode, streaming=True) as s:
+            started = time.perf_counter()
+            for chunk in self.chain.stream(self.inputs):
+                # Ollama 在最后一个 chunk 上附带 token 统计
+                usage = getattr(chunk, "usage_metadata", None) or usage
+                text = chunk.content if hasattr(chunk, "content") else str(chunk)
+                if not text:
+                    continue
+                if first_token_s is None:
+                    first_token_s = time.perf_counter() - started
+                parts.append(text)
+                pieces += 1
+                yield text
+            total_s = time.perf_counter() - started
+            # 没有 usage 统计时 (桩模型等) 用流式片段数近似输出 token 数
+            output_tokens = usage.get("output_tokens") or pieces
+            decode_s = total_s - (first_token_s or 0.0)
+            self.metrics = {
+                "ttft_ms": (first_token_s if first_token_s is not None else total_s) * 1000,
+                "total_ms": total_s * 1000,
+                "input_tokens": usage.get("input_tokens"),
+                "output_tokens": output_tokens,
+                "tokens_per_s": output_tokens / decode_s if decode_s > 0 else 0.0,
+            }
+            s["attrs"].update(self.metrics)
+        self.text = "".join(parts)
+
+def generate(chain, inputs: dict, mode: str) -> str:
+    """非流式调用 (benchmark 等场景)：消费完整个流后返回完整回答"""
+    stream = AnswerStream(chain, inputs, mode)
+    for _ in stream:
+        pass
+    return stream.text
+
+def parse_r_range(user_input: str):
+    """提取 "r从2.8到4" / "r在3.7到3.9之间" / "r∈[2.5, 4.0]" / "(2.0-4.0)" 这类参数区间，没有时返回 None"""
+    match = re.search(r"(\d+\.?\d*)\s*(?:到|至|~|～|-|—|,|，)\s*(\d+\.?\d*)", user_input)
+    if not match:
+        return None
+    return float(match.group(1)), float(match.group(2))
+
+LORENZ_ENSEMBLE_KEYWORDS = ["初始条件", "初值", "发散", "敏感", "系综", "蝴蝶效应", "李雅普诺夫",
+                            "ensemble", "divergence", "sensitiv", "lyapunov"]
+
+def parse_lorenz_params(user_input: str) -> dict:
+    """提取 σ/ρ/β (也接受 sigma/rho/beta 与 8/3 这类分数) 与积分时长，没给出的参数不出现在结果里"""
+    params = {}
+    for name, pattern in (("sigma", r"(?:σ|sigma)"), ("rho", r"(?:ρ|rho)"), ("beta", r"(?:β|beta)")):
+        match = re.search(pattern + r"\s*[=:：]\s*(\d+\.?\d*)(?:\s*/\s*(\d+\.?\d*))?", user_input, re.IGNORECASE)
+        if match:
+            value = float(match.group(1))
+            params[name] = round(value / float(match.group(2)), 4) if match.group(2) else value
+    match = re.search(r"(?:duration|时长|积分时间)\s*[=:：]?\s*(\d+\.?\d*)", user_input, re.IGNORECASE)
+    if match:
+        params["duration"] = float(match.group(1))
+    return params
+
+def run_compute(user_input: str):
+    """
+    COMPUTE 分支：从用户输入中提取参数并分发到 tools.py，返回 (状态描述文本, PNG 字节)
+    结果与图像经 tools.run_tool 缓存，相同参数的重复提问不再计算和绘图
+    """
+    # 正则提取 r 值
+    match = re.search(r"r\s*[=:]\s*(\d+\.?\d*)", user_input)
+    r_val = float(match.group(1)) if match else 3.5 # 默认值
+
+    lowered = user_input.lower()
+    is_lorenz = "lorenz" in lowered or "洛伦兹" in user_input
+    if is_lorenz and any(k in lowered for k in LORENZ_ENSEMBLE_KEYWORDS):
+        return tools.run_tool("lorenz_ensemble", **parse_lorenz_params(user_input))
+    if ("lyapunov" in lowered or "李雅普诺夫" in user_input) and not is_lorenz:
+        x0_match = re.search(r"x\s*[0₀]\s*[=:]\s*(\d+\.?\d*)", user_input)
+        kwargs = {"x0": float(x0_match.group(1))} if x0_match else {}
+        r_range = parse_r_range(user_input)
+        if r_range:
+            kwargs["r_min"], kwargs["r_max"] = r_range
+        return tools.run_tool("lyapunov", r=r_val if match else None, **kwargs)
+    if ("分岔" in user_input or "bifurcation" in lowered) and not is_lorenz:
+        r_range = parse_r_range(user_input)
+        if r_range:
+            return tools.run_tool("bifurcation", r_min=r_range[0], r_max=r_range[1])
+        return tools.run_tool("bifurcation")
+    if "logistic" in user_input.lower() or "映射" in user_input or "方程" in user_input:
+        return tools.run_tool("logistic_map", r=r_val)
+    if "lorenz" in user_input.lower() or "洛伦兹" in user_input:
+        return tools.run_tool("lorenz", **parse_lorenz_params(user_input))
+
+    response_text = "⚠️ 未识别具体计算模型，默认计算 Logistic 映射..."
+    response_text_extra, image = tools.run_tool("logistic_map", r=r_val)
+    return response_text + "\n" + response_text_extra, image
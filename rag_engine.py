@@ -1,38 +1,93 @@
 import os
-import glob
-import streamlit as st
-from langchain_community.document_loaders import DirectoryLoader
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_chroma import Chroma
-from langchain_ollama import OllamaEmbeddings, ChatOllama
-from langchain_core.tools import Tool
-from sentence_transformers import CrossEncoder
-from langchain_community.document_loaders import TextLoader
-from langchain_community.document_loaders import PDFPlumberLoader,PyPDFLoader
+import re
 import time
-from tqdm import tqdm # 如果没有安装 tqdm，可以把下面的 tqdm(range(...)) 改为 range(...)
+_MODULE_IMPORT_START = time.perf_counter()
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from langchain_core.tools import Tool
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_community.embeddings import HuggingFaceBgeEmbeddings
+from bm25_index import BM25Index
+from parent_store import ParentStore
+from context_packer import pack_context, CONTEXT_TOKEN_BUDGET
+from tracing import get_logger, span, bind_context
+from cache_utils import LRUCache, CachedEmbeddings, SemanticAnswerCache, normalize_query, content_hash, read_kb_version
+# 注意：sentence_transformers / HuggingFaceBgeEmbeddings / Chroma / ChatOllama 都是重量级依赖，
+# 统一放到各自的加载函数里按需导入，import rag_engine 本身不再加载任何模型
+
+logger = get_logger("rag_engine")
+
+# =================配置区域=================
+RERANK_CACHE_SIZE = 20000   # 重排分数缓存条目上限 (query, chunk) 对
+DEDUP_JACCARD = 0.8         # 同一章节内子片段相似度超过该值视为重复
+PERSIST_DIRECTORY = "./chroma_db"
+BM25_INDEX_PATH = os.path.join(PERSIST_DIRECTORY, "bm25_index.json")  # 由 build_db.py 生成
+PARENT_STORE_PATH = os.path.join(PERSIST_DIRECTORY, "parents.sqlite")  # 由 build_db.py 生成
+FLAT_INDEX_DIR = os.path.join(PERSIST_DIRECTORY, "flat_index")       # 由 build_db.py 导出
+VECTOR_BACKEND = os.getenv("CHAOS_VECTOR_BACKEND", "chroma")          # "chroma" 或 "flat" (内存映射精确检索)
+TOP_N = 5                   # 最终最多返回的片段数
+SCORE_THRESHOLD = 0.3       # reranker 接受阈值
+DENSE_K = 20                # 稠密召回条数
+LEXICAL_K = 20              # BM25 召回条数
+RECALL_K = 20               # RRF 融合后送进 reranker 的候选数 (原先为 30)
+RRF_K = 60                  # RRF 平滑常数
+ADAPTIVE_RERANK = True      # 自适应召回：小 k 起步 + 分批打分 + 提前退出
+ADAPTIVE_START_K = 10       # 自适应模式的初始召回深度
+ADAPTIVE_MAX_K = 30         # 自适应模式的最大召回深度
+ADAPTIVE_BATCH = 5          # 每批送进 reranker 的候选数
+ADAPTIVE_DENSE_GAP = 0.15   # 剩余候选的稠密相关度比最佳候选低这么多时，认为已无法进入 top5
+SPECULATIVE_REWRITE = True  # 原始查询召回与 LLM 改写并行执行，改写结果到达后合并候选
+REWRITE_DEADLINE = 3.0      # 改写的截止时间 (秒)，超时则只用原始查询的召回结果
+CONTEXT_PACKING = True      # 按 token 预算 (CHAOS_CONTEXT_BUDGET) 选句压缩上下文，见 context_packer.py
+# 投机检索：消息一到就在后台开始检索，与意图路由重叠执行；路由不是 RAG 时取消/丢弃
+# "off" 关闭 / "recall" 只提前做混合召回 / "full" 提前做完整的 召回 + 改写 + 重排
+SPECULATIVE_RETRIEVAL = os.getenv("CHAOS_SPECULATIVE_RETRIEVAL", "full")
+EMBEDDING_ROUTER = os.getenv("CHAOS_EMBEDDING_ROUTER", "1") != "0"  # 向量意图路由，见 embedding_router.py
+EMBEDDING_CACHE_PATH = "./cache/embedding_cache.sqlite"  # 查询向量磁盘缓存 (app.py 与 auto_data_factory.py 共用)
+ANSWER_CACHE_PATH = "./cache/answer_cache.sqlite"        # 语义答案缓存
+ANSWER_CACHE_THRESHOLD = 0.92  # 查询向量余弦相似度超过该值才视为同一问题
+ANSWER_CACHE_TTL = 7 * 24 * 3600  # 缓存答案有效期 (秒)
+ANSWER_CACHE_SIZE = 2000       # 缓存答案条目上限
+# =========================================
 
 # ==========================================
-# 1. 资源初始化 (单例模式)
+# 1. 资源初始化 (懒加载单例)
+# 第一次调用 get_xxx() 时才加载对应模型，CHAT / COMPUTE 轮次不再为 RAG 模型买单
 # ==========================================
-@st.cache_resource(show_spinner=False)
+STARTUP_TIMINGS = {}  # 阶段名 -> 耗时 (秒)，用于启动耗时报告
+_resources = {}
+_resource_locks = {}  # 每个资源一把锁：loader 内部可以再获取其他资源 (如 vectorstore 依赖 query_embeddings)
+_resource_locks_guard = threading.Lock()
+
+def record_timing(name: str, seconds: float):
+    STARTUP_TIMINGS[name] = seconds
+
+def _get_resource(name: str, loader):
+    """线程安全的懒加载：同一资源只加载一次，并记录加载耗时"""
+    if name in _resources:
+        return _resources[name]
+    with _resource_locks_guard:
+        lock = _resource_locks.setdefault(name, threading.Lock())
+    with lock:
+        if name not in _resources:
+            started = time.perf_counter()
+            _resources[name] = loader()
+            record_timing(f"load {name}", time.perf_counter() - started)
+    return _resources[name]
+
 def load_reranker():
     """
     加载重排模型，BGE-Reranker
     """
-    print("加载BGE-Rerank模型...")
+    logger.info("加载BGE-Rerank模型...")
+    from sentence_transformers import CrossEncoder
     return CrossEncoder('BAAI/bge-reranker-base', device='cpu')
 
-@st.cache_resource(show_spinner=False)
-def setup_knwoledge_base():
+def load_query_embeddings():
     """
-    【轻量版】仅负责加载已存在的知识库，不负责构建。
-    构建工作交由 build_db.py 独立完成。
+    加载 BGE-M3 查询向量模型 (Chroma 与 flat 两种后端共用)
     """
-    persist_directory = "./chroma_db"
-    print("正在加载 BGE-M3 Embedding 模型 (CPU模式)...")
+    logger.info("正在加载 BGE-M3 Embedding 模型 (CPU模式)...")
+    from langchain_community.embeddings import HuggingFaceBgeEmbeddings
     
     model_name = "BAAI/bge-m3"
     # 🔥 关键点 1: 强制指定 device 为 cpu，把显存全留给 Llama
@@ -40,40 +95,166 @@ def setup_knwoledge_base():
     # 关键点 2: 开启归一化 (BGE 推荐设置)
     encode_kwargs = {'normalize_embeddings': True}
     
-    embeddings = HuggingFaceBgeEmbeddings(
+    base_embeddings = HuggingFaceBgeEmbeddings(
         model_name=model_name,
         model_kwargs=model_kwargs,
         encode_kwargs=encode_kwargs
     )
+    # 关键点 3: 查询向量走 LRU + SQLite 缓存，重复提问不再重新编码
+    return CachedEmbeddings(base_embeddings, model_name=model_name, db_path=EMBEDDING_CACHE_PATH)
 
-    # 1. 检查数据库是否存在
-    if os.path.exists(persist_directory) and len(os.listdir(persist_directory)) > 0:
-        print("📖 [App] 成功加载现有 Chroma 知识库...")
-        return Chroma(
-            persist_directory=persist_directory, 
-            embedding_function=embeddings, 
-            collection_name="chaos_science_db"
-        )
-    
-    # 2. 如果不存在，直接报错 (不再尝试现场构建，防止显存爆炸)
-    else:
-        print("❌ [App] 严重错误：未找到本地知识库！")
-        print("   -> 请先运行 'python build_db.py' 生成数据库。")
+def setup_knwoledge_base():
+    """
+    【轻量版】仅负责加载已存在的知识库，不负责构建。
+    构建工作交由 build_db.py 独立完成。
+    VECTOR_BACKEND 决定用 Chroma 还是内存映射的 flat 索引，flat 索引缺失时回退到 Chroma
+    """
+    persist_directory = PERSIST_DIRECTORY
+
+    # 1. 检查数据库是否存在 (不存在时连 Embedding 模型都不用加载)
+    if not (os.path.exists(persist_directory) and len(os.listdir(persist_directory)) > 0):
+        # 2. 如果不存在，直接报错 (不再尝试现场构建，防止显存爆炸)
+        logger.error("❌ [App] 严重错误：未找到本地知识库！")
+        logger.error("   -> 请先运行 'python build_db.py' 生成数据库。")
         return None
-    
-#初始化全局资源 
-reranker_model = load_reranker()
-vectorstore = setup_knwoledge_base()
+
+    embeddings = _get_resource("query_embeddings", load_query_embeddings)
+
+    if VECTOR_BACKEND == "flat":
+        if os.path.exists(os.path.join(FLAT_INDEX_DIR, "vectors.npy")):
+            from flat_index import FlatVectorIndex
+            index = FlatVectorIndex(FLAT_INDEX_DIR, embeddings)
+            logger.info(f"📖 [App] 使用内存映射 flat 索引 ({len(index)} 条向量)")
+            return index
+        logger.warning("⚠️ [App] 未找到 flat 索引，回退到 Chroma (重新运行 build_db.py 可生成)")
+
+    from langchain_chroma import Chroma
+    logger.info("📖 [App] 成功加载现有 Chroma 知识库...")
+    return Chroma(
+        persist_directory=persist_directory, 
+        embedding_function=embeddings, 
+        collection_name="chaos_science_db"
+    )
+
+def load_bm25_index():
+    """
+    加载 build_db.py 生成的 BM25 词法索引；旧版知识库没有该文件时退化为纯稠密检索
+    """
+    if not os.path.exists(BM25_INDEX_PATH):
+        logger.warning("⚠️ [App] 未找到 BM25 索引，仅使用稠密检索 (重新运行 build_db.py 可生成)")
+        return None
+    logger.info("📇 [App] 加载 BM25 词法索引...")
+    return BM25Index.load(BM25_INDEX_PATH)
+
+def load_parent_store():
+    """
+    加载父段落存储；旧版知识库没有该文件时直接返回子片段
+    """
+    if not os.path.exists(PARENT_STORE_PATH):
+        logger.warning("⚠️ [App] 未找到父段落存储，检索结果将返回子片段 (重新运行 build_db.py 可生成)")
+        return None
+    return ParentStore(PARENT_STORE_PATH)
+
+def load_answer_cache():
+    return SemanticAnswerCache(
+        ANSWER_CACHE_PATH,
+        threshold=ANSWER_CACHE_THRESHOLD,
+        ttl=ANSWER_CACHE_TTL,
+        max_entries=ANSWER_CACHE_SIZE,
+    )
+
+def load_llm_rewriter():
+    from langchain_ollama import ChatOllama
+    return ChatOllama(
+        model="llama3.1", 
+        temperature=0.1, # 重写需要精确，温度调低
+        # base_url="http://127.0.0.1:11434"
+    )
+
+def load_embedding_router():
+    """加载失败时返回 None，路由退回 关键词 + LLM"""
+    try:
+        from embedding_router import EmbeddingRouter
+        return EmbeddingRouter(_get_resource("query_embeddings", load_query_embeddings))
+    except Exception as e:
+        logger.warning(f"⚠️ [App] 向量路由加载失败，路由全部交给 LLM: {e}")
+        return None
+
+def get_reranker():
+    return _get_resource("reranker", load_reranker)
+
+def get_vectorstore():
+    return _get_resource("vectorstore", setup_knwoledge_base)
+
+def get_bm25_index():
+    return _get_resource("bm25_index", load_bm25_index)
+
+def get_parent_store():
+    return _get_resource("parent_store", load_parent_store)
+
+def get_answer_cache():
+    return _get_resource("answer_cache", load_answer_cache)
+
+def get_llm_rewriter():
+    return _get_resource("llm_rewriter", load_llm_rewriter)
+
+def get_embedding_router():
+    if not EMBEDDING_ROUTER:
+        return None
+    return _get_resource("embedding_router", load_embedding_router)
+
+def peek_embedding_router():
+    """
+    只返回已经加载好的向量路由 (后台预热完成后)，不触发加载；
+    还没加载时返回 None，本轮路由交给 关键词 + LLM，CHAT / COMPUTE 轮次不会在主线程加载 BGE-M3
+    """
+    if not EMBEDDING_ROUTER:
+        return None
+    return _resources.get("embedding_router")
+
+_warmup_thread = None
+
+def start_background_warmup(dummy_query: str = "Logistic映射"):
+    """
+    后台预热线程：UI 已经可以响应时，在后台把所有模型加载好并跑一次 dummy 查询，
+    第一个 RAG 问题就不用再等模型加载。重复调用是安全的 (每个进程只启动一次)
+    """
+    global _warmup_thread
+    if _warmup_thread is not None:
+        return _warmup_thread
+
+    def _warmup():
+        started = time.perf_counter()
+        try:
+            get_reranker()
+            get_vectorstore()
+            get_bm25_index()
+            get_parent_store()
+            get_answer_cache()
+            get_embedding_router()
+            if get_vectorstore() is not None and dummy_query:
+                query_started = time.perf_counter()
+                rerank_search(dummy_query, adaptive=False)
+                record_timing("warmup dummy query", time.perf_counter() - query_started)
+            record_timing("warmup total", time.perf_counter() - started)
+            logger.info(f"🔥 [Warmup] 后台预热完成，耗时 {time.perf_counter() - started:.2f}s")
+        except Exception as e:
+            logger.warning(f"⚠️ [Warmup] 后台预热失败: {e}")
+
+    _warmup_thread = threading.Thread(target=_warmup, name="rag-warmup", daemon=True)
+    _warmup_thread.start()
+    return _warmup_thread
+
+def startup_report() -> str:
+    """启动耗时报告：各个 import / 模型加载阶段的耗时"""
+    lines = ["⏱️ 启动耗时报告"]
+    for name, seconds in STARTUP_TIMINGS.items():
+        lines.append(f"  - {name}: {seconds:.2f}s")
+    return "\n".join(lines)
 
 # ===========================================
 #2.核心检索逻辑（Advance RAG）
 # ===========================================
-llm_rewriter = ChatOllama(
-    model="llama3.1", 
-    temperature=0.1, # 重写需要精确，温度调低
-    # base_url="http://127.0.0.1:11434"
-)
-
 def rewrite_query(user_input: str) -> str:
     """
     Day 7.5 新增：利用 LLM 将用户的模糊提问改写为适合检索的独立句子
@@ -104,77 +285,490 @@ def rewrite_query(user_input: str) -> str:
         )
         
         # 执行链
-        chain = prompt | llm_rewriter
+        chain = prompt | get_llm_rewriter()
         rewritten_query = chain.invoke({"input": user_input}).content.strip()
         
         # 简单清洗，防止 LLM 废话
         if ":" in rewritten_query:
             rewritten_query = rewritten_query.split(":")[-1].strip()
             
-        print(f"🔄 [Rewrite] 原始: '{user_input}' -> 重写: '{rewritten_query}'")
+        logger.debug(f"🔄 [Rewrite] 原始: '{user_input}' -> 重写: '{rewritten_query}'")
         return rewritten_query
         
     except Exception as e:
-        print(f"⚠️ [Rewrite Error] 重写失败，使用原句: {e}")
+        logger.warning(f"⚠️ [Rewrite Error] 重写失败，使用原句: {e}")
         return user_input
 
 
-def advanced_rerank_search(query: str):
+def reciprocal_rank_fusion(rankings, k: int = RRF_K):
     """
-    DAY3核心逻辑:Retrieve(recall)-> Rerank(Precision)
+    RRF 融合多路召回：score(d) = Σ 1 / (k + rank)
+    以内容哈希作为同一 chunk 的判定依据，返回按融合分数降序的 Document 列表
     """
-    if not vectorstore:
-        return "错误：知识库未初始化，请检查data文件夹。"
-    
-    # ★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★
-    # 核心修复：在这里调用重写函数！
-    # ★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★
-    print(f"\n🚀 [RAG Start] 用户原始输入: {query}")
-    # effective_query = rewrite_query(query) 
-    effective_query = query
-    # 1.[Recall]粗筛
+    fused_scores = {}
+    docs_by_key = {}
+    for ranking in rankings:
+        for rank, doc in enumerate(ranking, start=1):
+            key = content_hash(doc.page_content)
+            docs_by_key.setdefault(key, doc)
+            fused_scores[key] = fused_scores.get(key, 0.0) + 1.0 / (k + rank)
+    ordered = sorted(fused_scores, key=fused_scores.get, reverse=True)
+    return [docs_by_key[key] for key in ordered]
+
+def hybrid_recall(query: str, k: int = RECALL_K):
+    """
+    稠密召回 + BM25 召回，RRF 融合后截取前 k 条
+    返回 [(doc, dense_score), ...]；dense_score 为稠密相关度 (0~1)，仅由 BM25 召回的为 None
+    """
+    dense_k = max(DENSE_K, k)
+    dense_pairs = get_vectorstore().similarity_search_with_relevance_scores(query, k=dense_k)
+    dense_scores = {content_hash(doc.page_content): score for doc, score in dense_pairs}
+    dense_docs = [doc for doc, _ in dense_pairs]
+    bm25_index = get_bm25_index()
+    if bm25_index is None:
+        fused = dense_docs[:k]
+    else:
+        lexical_docs = [doc for doc, _ in bm25_index.search(query, k=max(LEXICAL_K, k))]
+        logger.debug(f"🔀 [Hybrid] 稠密 {len(dense_docs)} 条 + BM25 {len(lexical_docs)} 条 -> RRF 融合")
+        fused = reciprocal_rank_fusion([dense_docs, lexical_docs])[:k]
+    return [(doc, dense_scores.get(content_hash(doc.page_content))) for doc in fused]
+
+def merge_candidates(candidate_lists, k: int = None):
+    """
+    合并多路查询 (原始查询 / 改写查询) 的召回结果：RRF 排序，稠密相关度取最大值
+    """
+    dense_scores = {}
+    for candidates in candidate_lists:
+        for doc, dense in candidates:
+            key = content_hash(doc.page_content)
+            if dense is not None:
+                dense_scores[key] = max(dense, dense_scores.get(key, dense))
+    fused = reciprocal_rank_fusion([[doc for doc, _ in candidates] for candidates in candidate_lists])
+    if k is not None:
+        fused = fused[:k]
+    return [(doc, dense_scores.get(content_hash(doc.page_content))) for doc in fused]
+
+def multi_query_recall(queries, k: int = RECALL_K):
+    """对每个查询分别做混合召回，再合并"""
+    if len(queries) == 1:
+        return hybrid_recall(queries[0], k=k)
+    return merge_candidates([hybrid_recall(q, k=k) for q in queries], k=k)
+
+# 改写线程池：LLM 改写在后台执行，不阻塞原始查询的召回
+rewrite_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="rewrite")
+
+def _traced_rewrite(query: str) -> str:
+    with span("rewrite") as s:
+        rewritten = rewrite_query(query)
+        s["attrs"]["changed"] = normalize_query(rewritten) != normalize_query(query)
+    return rewritten
+
+def start_speculative_rewrite(query: str):
+    """提交后台改写任务，返回 (future, 开始时间)；改写 span 会挂在提交时的 trace 上"""
+    return rewrite_executor.submit(bind_context(_traced_rewrite), query), time.perf_counter()
+
+def wait_rewrite(rewrite_job, deadline: float = None):
+    """
+    在截止时间内等待改写结果；超时返回 None (后台任务继续跑完，结果直接丢弃)
+    """
+    if deadline is None:
+        deadline = REWRITE_DEADLINE
+    future, started = rewrite_job
+    remaining = max(0.0, deadline - (time.perf_counter() - started))
     try:
-        # 注意：这里我们要用 effective_query (重写后的) 去查库
-        initial_docs = vectorstore.similarity_search(effective_query, k=30)
-        
-        print(f"\n🔍 [Recall Debug] 检索词: '{effective_query}' | 召回: {len(initial_docs)} 条文档。")
+        return future.result(timeout=remaining)
+    except FutureTimeoutError:
+        logger.info(f"⏱️ [Rewrite] 超过 {deadline}s 截止时间，仅使用原始查询的召回结果")
+        return None
+
+class RetrievalCancelled(Exception):
+    """投机检索被取消 (路由结果不是 RAG)"""
+
+# 投机检索线程池：与路由并行的检索任务
+speculative_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="speculative")
+
+def start_speculative_retrieval(query: str, mode: str = None):
+    """
+    消息到达后立即提交后台检索，返回任务句柄；mode 为 None 时取 SPECULATIVE_RETRIEVAL，"off" 时返回 None
+    路由为 RAG 时用 consume_speculative_retrieval 取结果，否则调用 cancel_speculative_retrieval
+    后台只做 稠密 + BM25 召回 (full 模式再加重排)，不调用 LLM 改写：CHAT / COMPUTE 轮次不会向 Ollama
+    多发请求，LLM 改写等路由确定为 RAG 后才在 consume_speculative_retrieval 中开始
+    """
+    mode = mode or SPECULATIVE_RETRIEVAL
+    if mode == "off":
+        return None
+    job = {"query": query, "mode": mode, "cancel": threading.Event(), "duration": None}
+
+    def _run():
+        started = time.perf_counter()
+        try:
+            with span("speculative_retrieval", mode=mode):
+                if not get_vectorstore():
+                    return None
+                candidates = hybrid_recall(query, k=ADAPTIVE_START_K if ADAPTIVE_RERANK else RECALL_K)
+                result = None
+                if mode == "full":
+                    result = advanced_rerank_search(query, return_stats=True, speculative_rewrite=False,
+                                                    initial_candidates=candidates, cancel_event=job["cancel"])
+                return {"candidates": candidates, "result": result}
+        finally:
+            job["duration"] = time.perf_counter() - started
+
+    job["future"] = speculative_executor.submit(bind_context(_run))
+    return job
+
+def cancel_speculative_retrieval(job):
+    """路由不是 RAG：还没开始的任务直接取消，已经在跑的在召回结束后停止 (不再重排)"""
+    if job is None:
+        return
+    job["cancel"].set()
+    job["future"].cancel()
+
+def consume_speculative_retrieval(job):
+    """
+    取投机检索结果，返回值与 advanced_rerank_search(return_stats=True) 相同；
+    stats["speculative"] 中的 saved_s = 后台已完成的检索耗时 - 路由结束后实际等待的时间
+    LLM 改写 (SPECULATIVE_REWRITE) 在这里才开始：改写查询与原查询一致或超时时直接用后台重排结果，
+    否则用后台召回的候选 + 改写查询的召回合并后重排一次
+    """
+    query = job["query"]
+    wait_started = time.perf_counter()
+    rewrite_job = start_speculative_rewrite(query) if SPECULATIVE_REWRITE else None
+    try:
+        prepared = job["future"].result()
     except Exception as e:
-        return f"错误：检索失败，{e}"
-    
-    if not initial_docs:
-        print("❌ [Recall Debug] 第一步检索结果为空！")
-        return "错误：未找到相关文档。"
-    
+        logger.warning(f"⚠️ [Speculative] 投机检索失败，改为同步检索: {e}")
+        prepared = None
+    waited = time.perf_counter() - wait_started
+    if prepared is None:
+        return advanced_rerank_search(query, return_stats=True, rewrite_job=rewrite_job)
+
+    result = prepared["result"]
+    rewrite_state = "off"
+    if rewrite_job is not None:
+        rewritten = wait_rewrite(rewrite_job)
+        if rewritten and normalize_query(rewritten) != normalize_query(query):
+            result = None  # 改写带来了新的召回词，需要合并候选后重新重排
+        rewrite_state = "unchanged" if rewritten else "timeout"
+    if result is None:
+        rag_result, stats = advanced_rerank_search(query, return_stats=True, rewrite_job=rewrite_job,
+                                                   initial_candidates=prepared["candidates"])
+    else:
+        rag_result, stats = result
+        stats["rewrite"] = rewrite_state
+    background = job["duration"] or 0.0
+    stats["speculative"] = {
+        "mode": job["mode"],
+        "background_s": background,
+        "waited_s": waited,
+        "saved_s": max(0.0, background - waited),
+    }
+    logger.debug(f"⚡ [Speculative] 后台检索 {background:.3f}s，路由后等待 {waited:.3f}s，节省 {stats['speculative']['saved_s']:.3f}s")
+    return rag_result, stats
+
+# 重排分数缓存：key = (归一化查询, chunk内容哈希) -> cross-encoder 分数
+rerank_score_cache = LRUCache(max_size=RERANK_CACHE_SIZE)
+
+def _shingles(text: str, n: int = 3) -> set:
+    """字符 n-gram 集合，用于判断两个片段是否高度重叠"""
+    text = re.sub(r"\s+", "", text)
+    return {text[i:i + n] for i in range(max(len(text) - n + 1, 1))}
+
+def collapse_candidates(candidates):
+    """
+    重排前折叠候选 (输入/输出均为 [(doc, dense_score)]，保持召回顺序)：
+    1. 内容完全相同的片段只保留一个
+    2. 同一父段落 (parent_id) 的兄弟子片段只保留召回排名最高的那个，作为父段落的代表参与重排
+    3. 旧版知识库没有 parent_id 时，同一源文件、同一章节下高度重叠的子片段 (Jaccard >= DEDUP_JACCARD) 只保留一个
+    """
+    seen_hashes = set()
+    seen_parents = set()
+    kept = []  # [((doc, dense_score), section_key, shingles)]
+    for doc, dense in candidates:
+        h = content_hash(doc.page_content)
+        if h in seen_hashes:
+            continue
+        seen_hashes.add(h)
+
+        parent_id = (doc.metadata or {}).get("parent_id")
+        if parent_id:
+            if parent_id in seen_parents:
+                continue
+            seen_parents.add(parent_id)
+            kept.append(((doc, dense), None, None))
+            continue
+
+        meta = doc.metadata or {}
+        section_key = (meta.get("source"), meta.get("Title"), meta.get("Section"), meta.get("Subsection"))
+        sh = _shingles(doc.page_content)
+        is_dup = False
+        for _, other_key, other_sh in kept:
+            if other_sh is None or other_key != section_key:
+                continue
+            inter = len(sh & other_sh)
+            if inter and inter / len(sh | other_sh) >= DEDUP_JACCARD:
+                is_dup = True
+                break
+        if not is_dup:
+            kept.append(((doc, dense), section_key, sh))
+    return [candidate for candidate, _, _ in kept]
+
+def cached_rerank_scores(query: str, docs):
+    """
+    带缓存的 cross-encoder 打分：只把缓存未命中的 (query, chunk) 对送进 reranker
+    """
+    norm_query = normalize_query(query)
+    keys = [(norm_query, content_hash(doc.page_content)) for doc in docs]
+    scores = [rerank_score_cache.get(key) for key in keys]
+
+    missing = [i for i, score in enumerate(scores) if score is None]
+    if missing:
+        pairs = [[query, docs[i].page_content] for i in missing]
+        new_scores = get_reranker().predict(pairs)
+        for i, score in zip(missing, new_scores):
+            scores[i] = float(score)
+            rerank_score_cache.put(keys[i], scores[i])
+
+    logger.debug(f"⚡ [Rerank Cache] 命中 {len(docs) - len(missing)}/{len(docs)}，实际打分 {len(missing)} 条")
+    return scores
+
+def _rerank_all(query: str, candidates):
+    """固定深度模式：召回的候选一次性全部打分"""
+    docs = [doc for doc, _ in candidates]
+    scores = cached_rerank_scores(query, docs)
+    return list(zip(docs, scores)), len(docs), RECALL_K
+
+def _rerank_adaptive(query: str, candidates, recall_queries):
+    """
+    自适应模式：按稠密相关度从高到低分批打分，满足以下任一条件即提前退出
+    1. 已有 TOP_N 个候选超过 SCORE_THRESHOLD
+    2. 已有候选通过阈值，且剩余候选的稠密相关度与最佳候选差距超过 ADAPTIVE_DENSE_GAP
+    候选本身按 RRF 排序，稠密相关度并不单调，因此先重新排序，差距判断对后续批次才成立；
+    仅由 BM25 召回的候选 (dense=None) 排在最前，保证专有名词命中不被跳过
+    若打完所有候选仍不足 TOP_N 个通过，则加倍召回深度 (不超过 ADAPTIVE_MAX_K) 继续打分
+    """
+    scored = {}  # 内容哈希 -> (doc, score)
+    k = ADAPTIVE_START_K
+    while True:
+        pending = [(doc, dense) for doc, dense in candidates if content_hash(doc.page_content) not in scored]
+        known_dense = [dense for _, dense in candidates if dense is not None]
+        best_dense = max(known_dense) if known_dense else None
+        # 稳定排序：同分时保留 RRF 顺序
+        pending.sort(key=lambda item: -item[1] if item[1] is not None else float("-inf"))
+
+        stop = False
+        for i in range(0, len(pending), ADAPTIVE_BATCH):
+            batch = pending[i:i + ADAPTIVE_BATCH]
+            batch_dense = [dense for _, dense in batch]
+            accepted = sum(1 for _, score in scored.values() if score > SCORE_THRESHOLD)
+            # pending 已按稠密相关度降序，这一批差距过大则其后所有批次同样过大
+            if (accepted > 0 and best_dense is not None and None not in batch_dense
+                    and best_dense - max(batch_dense) > ADAPTIVE_DENSE_GAP):
+                logger.debug(f"⏹️ [Adaptive] 稠密相关度差距 > {ADAPTIVE_DENSE_GAP}，剩余候选跳过")
+                stop = True
+                break
+
+            docs = [doc for doc, _ in batch]
+            for doc, score in zip(docs, cached_rerank_scores(query, docs)):
+                scored[content_hash(doc.page_content)] = (doc, score)
+
+            if sum(1 for _, score in scored.values() if score > SCORE_THRESHOLD) >= TOP_N:
+                logger.debug(f"⏹️ [Adaptive] 已有 {TOP_N} 个候选通过阈值，提前结束打分")
+                stop = True
+                break
+
+        if stop or k >= ADAPTIVE_MAX_K:
+            break
+        # 通过阈值的候选太少：扩大召回深度
+        k = min(k * 2, ADAPTIVE_MAX_K)
+        logger.debug(f"↗️ [Adaptive] 通过候选不足，召回深度扩大到 k={k}")
+        candidates = collapse_candidates(multi_query_recall(recall_queries, k=k))
+
+    return list(scored.values()), len(scored), k
+
+def rerank_search(query: str, adaptive: bool = None, rewrite_job=None, initial_candidates=None, cancel_event=None):
+    """
+    检索核心：Recall -> Rerank，返回 (接受的 [(doc, score)], 统计信息)
+    统计信息包含召回深度 recall_k 与实际送进 reranker 的候选数 scored，便于观察自适应模式节省的开销
+    rewrite_job 为 start_speculative_rewrite 返回的后台改写任务：原始查询召回完成后再等待它，
+    改写在截止时间内到达则用改写查询再召回一次，两路候选合并后只做一次 rerank
+    initial_candidates 为投机检索提前算好的原始查询召回结果；cancel_event 被设置时在召回后抛出 RetrievalCancelled
+    """
+    if adaptive is None:
+        adaptive = ADAPTIVE_RERANK
+    stats = {"mode": "adaptive" if adaptive else "fixed", "recall_k": 0, "scored": 0, "accepted": 0,
+             "rewrite": "off" if rewrite_job is None else "timeout"}
+
+    # 1.[Recall]粗筛
+    # 稠密 + BM25 混合召回，RRF 排序更准，因此召回深度可以从 30 降到 RECALL_K
+    recall_k = ADAPTIVE_START_K if adaptive else RECALL_K
+    with span("recall", k=recall_k) as recall_span:
+        if initial_candidates is not None:
+            candidates = initial_candidates
+        else:
+            candidates = hybrid_recall(query, k=recall_k)
+        logger.debug(f"🔍 [Recall Debug] 检索词: '{query}' | 召回: {len(candidates)} 条文档。")
+
+        recall_queries = [query]
+        rerank_query = query
+        if cancel_event is not None and cancel_event.is_set():
+            raise RetrievalCancelled()
+        if rewrite_job is not None:
+            rewritten = wait_rewrite(rewrite_job)
+            if rewritten and normalize_query(rewritten) != normalize_query(query):
+                rewritten_candidates = hybrid_recall(rewritten, k=recall_k)
+                logger.debug(f"🔄 [Rewrite] 改写查询 '{rewritten}' 追加召回 {len(rewritten_candidates)} 条，合并后统一重排")
+                candidates = merge_candidates([candidates, rewritten_candidates], k=recall_k)
+                recall_queries.append(rewritten)
+                # 通常用重写后的查询去 rerank 更准，因为它包含了全称和英文
+                rerank_query = rewritten
+                stats["rewrite"] = "merged"
+            elif rewritten:
+                stats["rewrite"] = "unchanged"
+        recall_span["attrs"].update(candidates=len(candidates), rewrite=stats["rewrite"])
+
+    stats["timings"] = {"recall": recall_span["duration_ms"] / 1000}
+    if not candidates:
+        return [], stats
+    if cancel_event is not None and cancel_event.is_set():
+        raise RetrievalCancelled()
+
     # 2.[Rerank]打分
-    # 技巧：Rerank 的时候，是用“重写后的查询”还是“原始查询”去和文档比对？
-    # 通常用重写后的更准，因为它包含了全称和英文。
-    pairs = [[effective_query, doc.page_content] for doc in initial_docs]
-    scores = reranker_model.predict(pairs)
+    # (自适应模式扩大召回深度时的二次召回也计入 rerank 耗时)
+    with span("rerank", mode=stats["mode"]) as rerank_span:
+        # 先折叠重复/重叠候选，再走分数缓存，只对真正没见过的 (query, chunk) 调用 cross-encoder
+        candidates = collapse_candidates(candidates)
+        if adaptive:
+            doc_score_pairs, scored, recall_k = _rerank_adaptive(rerank_query, candidates, recall_queries)
+        else:
+            doc_score_pairs, scored, recall_k = _rerank_all(rerank_query, candidates)
+        rerank_span["attrs"].update(k=recall_k, scored=scored)
+    stats["recall_k"] = recall_k
+    stats["scored"] = scored
+    stats["timings"]["rerank"] = rerank_span["duration_ms"] / 1000
 
     # 3.排序与过滤
-    doc_score_pairs = list(zip(initial_docs, scores))
     doc_score_pairs = sorted(doc_score_pairs, key=lambda x: x[1], reverse=True)
+    accepted = []
 
-    final_results = []
-
-    print(f"\n====== Rerank Debug (Query: {effective_query}) ======")
     #仅仅取top5
-    for doc, score in doc_score_pairs[:5]:
-        if score > 0.3: 
-            print(f"✅ [Accepted] Score: {score:.4f} | Content: {doc.page_content[:30]}...")
-            final_results.append(doc.page_content)
+    for doc, score in doc_score_pairs[:TOP_N]:
+        if score > SCORE_THRESHOLD:
+            logger.debug(f"✅ [Accepted] Score: {score:.4f} | Content: {doc.page_content[:30]}...")
+            accepted.append((doc, score))
         else:
-            print(f"❌ [Rejected] Score: {score:.4f} | Content: {doc.page_content[:30]}...")
+            logger.debug(f"❌ [Rejected] Score: {score:.4f} | Content: {doc.page_content[:30]}...")
+    logger.debug(f"📊 [Rerank Stats] 模式: {stats['mode']} | 召回深度: {recall_k} | 实际打分: {scored} 条")
+
+    stats["accepted"] = len(accepted)
+    rerank_span["attrs"]["accepted"] = len(accepted)
+    # 近重复片段在构建时被合并，被合并片段的来源记录在 alias_sources ("a.md|b.md") 中
+    sources = []
+    for doc, _ in accepted:
+        meta = doc.metadata or {}
+        sources.append(meta.get("source", "unknown"))
+        sources.extend(s for s in meta.get("alias_sources", "").split("|") if s)
+    stats["sources"] = list(dict.fromkeys(sources))
+    return accepted, stats
+
+def expand_to_parent(doc):
+    """子片段 -> 完整父段落 (标题 + 内容)；找不到父段落时返回子片段本身"""
+    parent_id = (doc.metadata or {}).get("parent_id")
+    parent_store = get_parent_store()
+    if parent_store is not None and parent_id:
+        parent_content = parent_store.get(parent_id)
+        if parent_content:
+            return parent_content
+    return doc.page_content
+
+def advanced_rerank_search(query: str, adaptive: bool = None, return_stats: bool = False, speculative_rewrite: bool = None,
+                           initial_candidates=None, cancel_event=None, rewrite_job=None):
+    """
+    DAY3核心逻辑:Retrieve(recall)-> Rerank(Precision)
+    return_stats=True 时返回 (文本, 统计信息)，统计信息中的 scored 即本次实际打分的候选数
+    speculative_rewrite=True 时 LLM 改写与原始查询召回并行，不再占用关键路径
+    initial_candidates / cancel_event / rewrite_job (已经提交的改写任务) 供投机检索使用，见 start_speculative_retrieval
+    """
+    if speculative_rewrite is None:
+        speculative_rewrite = SPECULATIVE_REWRITE
+
+    def _result(text, stats=None):
+        return (text, stats or {}) if return_stats else text
+
+    if not get_vectorstore():
+        return _result("错误：知识库未初始化，请检查data文件夹。")
+    
+    # ★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★
+    # 核心修复：在这里调用重写函数！
+    # 串行改写会在检索前多等几秒，所以改为投机执行：改写在后台线程跑，
+    # 原始查询先去召回，改写结果在截止时间内到达才参与合并
+    # ★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★
+    logger.debug(f"🚀 [RAG Start] 用户原始输入: {query}")
+    if rewrite_job is None and speculative_rewrite:
+        rewrite_job = start_speculative_rewrite(query)
+    try:
+        accepted, stats = rerank_search(query, adaptive=adaptive, rewrite_job=rewrite_job,
+                                        initial_candidates=initial_candidates, cancel_event=cancel_event)
+    except RetrievalCancelled:
+        if rewrite_job is not None:
+            rewrite_job[0].cancel()
+        logger.debug("🛑 [Speculative] 路由不是 RAG，投机检索已取消")
+        return _result("错误：检索已取消。")
+    except Exception as e:
+        return _result(f"错误：检索失败，{e}")
 
-    print("==========================================\n")
+    if stats["recall_k"] == 0:
+        logger.warning("❌ [Recall Debug] 第一步检索结果为空！")
+        return _result("错误：未找到相关文档。", stats)
 
-    if not final_results:
-        return "资料不足，相关评分过低"
+    if not accepted:
+        return _result("资料不足，相关评分过低", stats)
     
-    return "\n\n".join(final_results)
+    # 小片段负责精准命中，返回给 LLM 的是它所属的完整父段落
+    passages = [(expand_to_parent(doc), score, (doc.metadata or {}).get("source", "unknown")) for doc, score in accepted]
+    if not CONTEXT_PACKING:
+        return _result("\n\n".join(text for text, _, _ in passages), stats)
+
+    with span("pack", budget=CONTEXT_TOKEN_BUDGET) as pack_span:
+        context, packing = pack_context(query, passages, CONTEXT_TOKEN_BUDGET)
+        pack_span["attrs"].update(packing)
+    stats["packing"] = packing
+    logger.debug(f"📦 [Pack] {packing['original_tokens']} -> {packing['packed_tokens']} tokens (节省 {packing['saved_tokens']})")
+    return _result(context, stats)
+
+# ===========================================
+#3.语义答案缓存
+# ===========================================
+def lookup_cached_answer(query: str):
+    """
+    路由为 RAG 后、检索/生成之前查询语义缓存，命中返回 {"answer", "sources", "similarity", "query"}
+    """
+    vectorstore = get_vectorstore()
+    if not vectorstore:
+        return None
+    try:
+        embedding = vectorstore.embeddings.embed_query(query)
+        hit = get_answer_cache().lookup(embedding, read_kb_version(PERSIST_DIRECTORY))
+    except Exception as e:
+        logger.warning(f"⚠️ [Answer Cache] 查询失败: {e}")
+        return None
+    if hit:
+        logger.debug(f"⚡ [Answer Cache] 命中 (相似度 {hit['similarity']:.3f})：'{hit['query']}'")
+    return hit
+
+def store_cached_answer(query: str, answer: str, sources):
+    """只缓存基于本地文献的 RAG 回答 (回退到通用知识的回答不缓存)"""
+    vectorstore = get_vectorstore()
+    if not vectorstore:
+        return
+    try:
+        embedding = vectorstore.embeddings.embed_query(query)
+        get_answer_cache().store(query, embedding, answer, sources, read_kb_version(PERSIST_DIRECTORY))
+    except Exception as e:
+        logger.warning(f"⚠️ [Answer Cache] 写入失败: {e}")
 
 # ===========================================
-#3.工具封装导出
+#4.工具封装导出
 # ===========================================
 def get_retriever_tool():
     """
@@ -185,3 +779,5 @@ def get_retriever_tool():
         func=advanced_rerank_search,
         description="Search for scientific definitions, theories, and formulas. Use this for questions about Chaos Theory, Meteorology, and specific terms like 'ODGY method'."
     )
+
+record_timing("import rag_engine", time.perf_counter() - _MODULE_IMPORT_START)
@@ -1,6 +1,9 @@
-import streamlit as st
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
+from tracing import get_logger, span
+from embedding_router import ROUTER_CONFIDENCE
+
+logger = get_logger("router")
 
 def init_router_chain(llm_model):
     """
@@ -51,14 +54,21 @@ def init_router_chain(llm_model):
 
     return route_prompt | llm_model | StrOutputParser()
 
-def get_route_category(query, router_chain):
+def get_route_category(query, router_chain, embedding_router=None):
     """
-    执行分类 (关键词规则 + LLM 智能分类)
+    执行分类 (关键词规则 + 向量路由 + LLM 智能分类)
+    embedding_router 为 embedding_router.EmbeddingRouter，置信度不够时才调用 LLM
     """
+    with span("route") as s:
+        category, method = _classify(query, router_chain, embedding_router, s["attrs"])
+        s["attrs"].update(category=category, method=method)
+    return category
+
+def _classify(query, router_chain, embedding_router=None, attrs=None):
+    """返回 (分类, 命中方式)；调试输出走 logger，CHAOS_LOG_LEVEL=DEBUG 时可见"""
     # --- [Debug] ---
-    print(f"\n{'='*20} 🚦 ROUTER DEBUG {'='*20}")
     display_query = query[:100] + "..." if len(query) > 100 else query
-    print(f"📥 [Input]: {display_query}")
+    logger.debug(f"🚦 ROUTER 📥 [Input]: {display_query}")
 
     # =====================================================
     # 1. 规则优先 (Rule-Based Override)
@@ -67,29 +77,40 @@ def get_route_category(query, router_chain):
     # 规则 A: 计算题 (硬核关键词)
     compute_keywords = ["计算指标"]
     if any(k in query for k in compute_keywords):
-        print(f"⚡ [Fast Track]: 命中计算关键词")
-        print(f"🎯 [Decision]: COMPUTE (强制)")
-        print(f"{'='*54}\n")
-        return "COMPUTE"
+        logger.debug("⚡ [Fast Track]: 命中计算关键词 -> COMPUTE (强制)")
+        return "COMPUTE", "keyword"
 
     # 规则 B: 闲聊/自我介绍 (★★★ 新增修复 ★★★)
     # 如果包含这些词，大概率不需要查论文
     chat_keywords = ["你好", "你是谁", "介绍一下你自己", "介绍一下自己", "你是?", "hi", "hello"]
     # 注意：不能光查"介绍"，因为"介绍一下混沌"是RAG。必须查"介绍"+"自己/你"。
     if any(k in query.lower() for k in chat_keywords):
-        print(f"⚡ [Fast Track]: 命中闲聊关键词")
-        print(f"🎯 [Decision]: CHAT (强制)")
-        print(f"{'='*54}\n")
-        return "CHAT"
+        logger.debug("⚡ [Fast Track]: 命中闲聊关键词 -> CHAT (强制)")
+        return "CHAT", "keyword"
+
+    # =====================================================
+    # 2. 向量路由 (与示例问句的相似度，几十毫秒)
+    # =====================================================
+    if embedding_router is not None:
+        try:
+            category, confidence, _ = embedding_router.classify(query)
+            if attrs is not None:
+                attrs.update(embedding_category=category, confidence=round(confidence, 4))
+            if confidence >= ROUTER_CONFIDENCE:
+                logger.debug(f"🧭 [Embedding]: {category} (置信度 {confidence:.2f})")
+                return category, "embedding"
+            logger.debug(f"🧭 [Embedding]: {category} 置信度 {confidence:.2f} 过低，交给 LLM")
+        except Exception as e:
+            logger.warning(f"⚠️ [Embedding Router Error]: {e}，交给 LLM")
 
     # =====================================================
-    # 2. LLM 智能判断 (如果规则没命中)
+    # 3. LLM 智能判断 (如果规则没命中且向量路由没把握)
     # =====================================================
     try:
-        print("🤖 [LLM Analysis]: 正在思考分类...")
+        logger.debug("🤖 [LLM Analysis]: 正在思考分类...")
         
         raw_output = router_chain.invoke({"question": query})
-        print(f"📝 [Raw Output]: '{raw_output}'")
+        logger.debug(f"📝 [Raw Output]: '{raw_output}'")
         
         category = raw_output.strip().upper()
         
@@ -99,10 +120,9 @@ def get_route_category(query, router_chain):
         elif "RAG" in category: final_category = "RAG"
         else: final_category = "CHAT"
             
-        print(f"✅ [Final Decision]: {final_category}")
-        print(f"{'='*54}\n")
-        return final_category
+        logger.debug(f"🚦 [Route] {final_category} | {display_query}")
+        return final_category, "llm"
 
     except Exception as e:
-        print(f"❌ [Error]: {e}")
-        return "CHAT"
\ No newline at end of file
+        logger.error(f"❌ [Router Error]: {e}")
+        return "CHAT", "error"
\ No newline at end of file
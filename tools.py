@@ -1,15 +1,92 @@
+import io
+import os
+import json
+import time
+import hashlib
+import inspect
+import threading
+import sqlite3
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import numpy as np
 import matplotlib.pyplot as plt
 from scipy.integrate import odeint
+from cache_utils import LRUCache, FigureCache
+from tracing import span, get_logger
+
+logger = get_logger("tools")
 
 # 设置 Matplotlib 风格，防止中文乱码 (可选，根据你的系统环境)
 plt.rcParams['axes.unicode_minus'] = False 
 # 如果图表中中文显示方块，可以尝试解开下面这行的注释并设置合适的字体
 # plt.rcParams['font.sans-serif'] = ['SimHei'] 
 
-def simulate_logistic_map(r: float, steps: int = 100, x0: float = 0.5):
+# ==========================================
+# 绘图前的轨迹降采样 (只影响绘图，不影响数值结果与状态描述)
+# - LTTB (Largest-Triangle-Three-Buckets)：每个桶保留与 前一桶均值、后一桶均值 构成三角形面积最大的点，
+#   按 D 维三角形面积计算，3D 相空间轨迹的尖角与转折都能保留；
+#   锚点用前一桶均值代替"上一个保留点"，各桶互不依赖，整个过程是一次数组运算 (逐桶 Python 循环 10 万点要 ~90 ms)
+# - min/max 分箱：每个箱保留最小值和最大值两个点，时间序列的包络与尖峰不丢
+# dpi=100 的 8~10 英寸宽图只有 800~1000 个像素列，点数再多画出来也看不出区别，只会拖慢 Matplotlib
+# ==========================================
+# 3D 轨迹保留的点数 (LTTB)。Agg 画密集重叠的轨迹时耗时接近饱和 (实测 10 万点与 40 万点相差不到 3 倍)，
+# 只有降到 1 万点量级才明显变快；duration ≤ 100 (默认 40) 的轨迹不会被降采样
+PLOT_MAX_POINTS = 10000
+SERIES_MAX_POINTS = 2000   # 时间序列/扫描曲线保留的点数上限 (min/max 分箱)
+
+def lttb_indices(points, n_out: int):
+    """points: (N,) 或 (N, D)；返回保留点的下标 (升序，首尾点总是保留)"""
+    points = np.asarray(points, dtype=np.float64)
+    if points.ndim == 1:
+        points = np.column_stack([np.arange(len(points)), points])
+    n = len(points)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    # 首尾点单独保留，中间的点按等宽分桶 (最后一桶不足时用 NaN 补齐)
+    inner = points[1:n - 1]
+    width = -(-len(inner) // (n_out - 2))
+    n_buckets = -(-len(inner) // width)
+    padded = np.full((n_buckets * width, points.shape[1]), np.nan)
+    padded[:len(inner)] = inner
+    buckets = padded.reshape(n_buckets, width, -1)
+    means = np.nanmean(buckets, axis=1)
+    prev = np.vstack([points[:1], means[:-1]])
+    nxt = np.vstack([means[1:], points[-1:]])
+    a = buckets - prev[:, None, :]
+    c = nxt - prev
+    # D 维三角形面积的平方 ∝ |a|^2 |c|^2 - (a·c)^2
+    area2 = (a * a).sum(axis=2) * (c * c).sum(axis=1)[:, None] - np.einsum("bwd,bd->bw", a, c) ** 2
+    area2 = np.where(np.isnan(area2), -np.inf, area2)
+    selected = 1 + np.arange(n_buckets) * width + np.argmax(area2, axis=1)
+    return np.concatenate([[0], selected, [n - 1]])
+
+def minmax_indices(values, n_out: int):
+    """values: (N,)；每个箱保留最小值与最大值的下标，另加首尾点，返回升序下标 (个数约为 n_out)"""
+    values = np.asarray(values)
+    n = len(values)
+    if n <= n_out:
+        return np.arange(n)
+    width = -(-n // max(1, n_out // 2))
+    n_bins = -(-n // width)
+    padded = np.full(n_bins * width, np.nan)
+    padded[:n] = values
+    bins = padded.reshape(n_bins, width)
+    offsets = np.arange(n_bins) * width
+    lows = offsets + np.nanargmin(bins, axis=1)
+    highs = offsets + np.nanargmax(bins, axis=1)
+    return np.unique(np.concatenate([lows, highs, [0, n - 1]]))
+
+# ==========================================
+# 每个工具拆成两步 (结果缓存与图像缓存见文件末尾 run_tool)：
+#   compute_xxx(参数) -> 结果字典 (数值数组 + "text" 状态描述)
+#   render_xxx(结果)  -> Matplotlib 图像对象
+# simulate_xxx 保持原来的接口，依次调用两步返回 (状态描述文本, 图像对象)
+# ==========================================
+
+def compute_logistic_map(r: float, steps: int = 100, x0: float = 0.5):
     """
-    计算 Logistic 映射并返回：(状态描述文本, 图像对象)
+    计算 Logistic 映射，返回结果字典
     """
     # 1. 数值计算
     data = []
@@ -35,29 +112,37 @@ def simulate_logistic_map(r: float, steps: int = 100, x0: float = 0.5):
         status = "混沌状态 (Chaos)"
         
     result_text = f"✅ **计算完成**\n\n检测到参数 $r={r}$，系统处于 **{status}**。\n(分析基于最后20次迭代的数值特征)"
+    return {"r": r, "t": np.array(t_vals), "data": np.array(data), "text": result_text}
 
+def render_logistic_map(result):
     # 3. 核心修改：生成图像对象
     # 使用面向对象方式绘图，避免多线程冲突
     fig, ax = plt.subplots(figsize=(8, 4))
     
     # 绘制时序图
-    ax.plot(t_vals, data, 'b.-', linewidth=1, markersize=8, alpha=0.7)
+    ax.plot(result["t"], result["data"], 'b.-', linewidth=1, markersize=8, alpha=0.7)
     
     # 设置标题和标签
-    ax.set_title(f"Logistic Map Time Series (r={r})")
+    ax.set_title(f"Logistic Map Time Series (r={result['r']})")
     ax.set_xlabel("Iteration (t)")
     ax.set_ylabel("Value (x)")
     ax.grid(True, linestyle='--', alpha=0.5)
     
     # 设定Y轴范围，让图更好看
     ax.set_ylim(-0.05, 1.05)
+    return fig
 
+def simulate_logistic_map(r: float, steps: int = 100, x0: float = 0.5):
+    """
+    计算 Logistic 映射并返回：(状态描述文本, 图像对象)
+    """
+    result = compute_logistic_map(r, steps, x0)
     # 4. 返回：(文本结果, 图片对象)
-    return result_text, fig
+    return result["text"], render_logistic_map(result)
 
-def simulate_lorenz(sigma=10.0, rho=28.0, beta=2.667, duration=40.0):
+def compute_lorenz(sigma=10.0, rho=28.0, beta=2.667, duration=40.0):
     """
-    计算洛伦兹吸引子并返回：(状态描述文本, 图像对象)
+    计算洛伦兹吸引子，返回结果字典
     """
     # 1. 定义方程
     def lorenz_deriv(state, t):
@@ -72,6 +157,12 @@ def simulate_lorenz(sigma=10.0, rho=28.0, beta=2.667, duration=40.0):
     states = odeint(lorenz_deriv, [1.0, 1.0, 1.0], t)
     
     result_text = f"🦋 **洛伦兹吸引子生成完毕**\n\n参数设置：$\\sigma={sigma}, \\rho={rho}, \\beta={beta}$"
+    return {"states": states, "text": result_text}
+
+def render_lorenz(result, max_points: int = PLOT_MAX_POINTS):
+    states = result["states"]
+    if max_points:
+        states = states[lttb_indices(states, max_points)]
     # 3. 核心修改：生成 3D 图像对象
     fig = plt.figure(figsize=(8, 6))
     ax = fig.add_subplot(111, projection='3d')
@@ -85,4 +176,528 @@ def simulate_lorenz(sigma=10.0, rho=28.0, beta=2.667, duration=40.0):
     ax.set_ylabel("Y Axis")
     ax.set_zlabel("Z Axis")
     
-    return result_text, fig
\ No newline at end of file
+    return fig
+
+def simulate_lorenz(sigma=10.0, rho=28.0, beta=2.667, duration=40.0):
+    """
+    计算洛伦兹吸引子并返回：(状态描述文本, 图像对象)
+    """
+    result = compute_lorenz(sigma, rho, beta, duration)
+    return result["text"], render_lorenz(result)
+
+# ==========================================
+# Logistic 映射分岔图 (向量化)
+# - 几千个 r 值组成一个 NumPy 数组同时迭代，每一步是一次数组运算而不是 Python 循环
+# - 丢弃前 transient 步暂态后采样吸引子，按 (x 像素行, r 列) 用 bincount 累加成密度图，
+#   不再把几百万个散点交给 Matplotlib，绘图成本只和图像分辨率有关
+# ==========================================
+BIFURCATION_R_RANGE = (2.5, 4.0)
+BIFURCATION_NUM_R = 4000       # r 方向采样数 (即密度图列数)
+BIFURCATION_SAMPLES = 1000     # 每个 r 在暂态之后采样的迭代次数
+BIFURCATION_TRANSIENT = 1000   # 丢弃的暂态迭代次数
+BIFURCATION_HEIGHT = 1000      # x 方向像素行数
+BIFURCATION_CHUNK = 250        # 每累积这么多步做一次 bincount，限制中间数组大小
+CHAOS_ONSET_BINS = 64          # 一列占据的像素行数超过该值视为进入混沌带
+FEIGENBAUM_ONSET = 3.5699      # 倍周期级联的累积点
+
+def bifurcation_density(r_min: float, r_max: float, num_r: int = BIFURCATION_NUM_R,
+                        samples: int = BIFURCATION_SAMPLES, transient: int = BIFURCATION_TRANSIENT,
+                        height: int = BIFURCATION_HEIGHT, x0: float = 0.5):
+    """
+    返回 (r 数组, 密度图)，密度图形状为 (height, num_r)，第 i 行对应 x ∈ [i/height, (i+1)/height)
+    """
+    r = np.linspace(r_min, r_max, num_r)
+    x = np.full(num_r, x0)
+    for _ in range(transient):
+        x = r * x * (1 - x)
+
+    cols = np.arange(num_r)
+    density = np.zeros(height * num_r, dtype=np.int64)
+    block = np.empty((min(BIFURCATION_CHUNK, samples), num_r))
+    for start in range(0, samples, BIFURCATION_CHUNK):
+        n = min(BIFURCATION_CHUNK, samples - start)
+        for i in range(n):
+            x = r * x * (1 - x)
+            block[i] = x
+        rows = np.clip((block[:n] * height).astype(np.int64), 0, height - 1)
+        density += np.bincount((rows * num_r + cols).ravel(), minlength=height * num_r)
+    return r, density.reshape(height, num_r)
+
+def compute_bifurcation(r_min: float = BIFURCATION_R_RANGE[0], r_max: float = BIFURCATION_R_RANGE[1],
+                        num_r: int = BIFURCATION_NUM_R, samples: int = BIFURCATION_SAMPLES,
+                        transient: int = BIFURCATION_TRANSIENT):
+    """
+    计算 Logistic 映射分岔图，返回结果字典
+    区间与 [0, 4] 没有交集时返回只含 text / error 的字典，不绘图
+    """
+    # 1. 参数整理：r > 4 时迭代会逃逸出 [0, 1]，区间截断到 [0, 4] 并在文本中说明
+    requested = sorted((float(r_min), float(r_max)))
+    r_min, r_max = max(requested[0], 0.0), min(requested[1], 4.0)
+    if r_max - r_min < 1e-6:
+        return {"text": f"❌ 参数区间 $r \\in [{requested[0]}, {requested[1]}]$ 在 Logistic 映射的有效范围 [0, 4] 内"
+                        f"没有宽度，请给出位于 [0, 4] 内且 r_min < r_max 的区间。", "error": True}
+    clamp_text = "" if (r_min, r_max) == tuple(requested) else f" (请求的区间 [{requested[0]}, {requested[1]}] 超出 [0, 4]，已截断)"
+
+    # 2. 向量化计算密度图
+    started = time.perf_counter()
+    r, density = bifurcation_density(r_min, r_max, num_r, samples, transient)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+
+    # 3. 状态分析：每列占据的像素行数近似反映周期数，第一次超过阈值处近似为混沌起点
+    occupied = (density > 0).sum(axis=0)
+    chaotic = np.nonzero(occupied > CHAOS_ONSET_BINS)[0]
+    if len(chaotic):
+        onset_text = f"混沌带大约从 $r \\approx {r[chaotic[0]]:.4f}$ 开始"
+        if r_min < FEIGENBAUM_ONSET:
+            onset_text += f" (理论值 {FEIGENBAUM_ONSET})"
+    else:
+        onset_text = "该区间内未出现混沌带"
+    result_text = (
+        f"✅ **分岔图计算完成**\n\n参数区间 $r \\in [{r_min}, {r_max}]${clamp_text}，{num_r} 个 r 值 × {samples} 个采样点"
+        f"(丢弃前 {transient} 步暂态)。\n{onset_text}。"
+    )
+    # 每格计数不超过 samples，缩成 uint16 存放 (4000x1000 的密度图 8 MB)，减少结果缓存的内存占用
+    density = density.astype(np.uint16 if samples < 65536 else np.uint32)
+    return {"r_min": r_min, "r_max": r_max, "density": density, "text": result_text, "elapsed_ms": elapsed_ms}
+
+def render_bifurcation(result):
+    # 4. 绘图：密度取对数后作为图像显示，避免稀疏的周期轨道被混沌区淹没
+    r_min, r_max = result["r_min"], result["r_max"]
+    fig, ax = plt.subplots(figsize=(10, 5))
+    ax.imshow(np.log1p(result["density"].astype(np.float32)), origin='lower', aspect='auto', cmap='Greys',
+              extent=[r_min, r_max, 0.0, 1.0], interpolation='nearest')
+    ax.set_title(f"Logistic Map Bifurcation Diagram (r={r_min}~{r_max})")
+    ax.set_xlabel("Parameter (r)")
+    ax.set_ylabel("Value (x)")
+    return fig
+
+def simulate_bifurcation(r_min: float = BIFURCATION_R_RANGE[0], r_max: float = BIFURCATION_R_RANGE[1],
+                         num_r: int = BIFURCATION_NUM_R, samples: int = BIFURCATION_SAMPLES,
+                         transient: int = BIFURCATION_TRANSIENT):
+    """
+    计算 Logistic 映射分岔图并返回：(状态描述文本, 图像对象)
+    """
+    result = compute_bifurcation(r_min, r_max, num_r, samples, transient)
+    if result.get("error"):
+        return result["text"], None
+    return describe_result(result), render_bifurcation(result)
+
+# ==========================================
+# Logistic 映射 Lyapunov 指数 (向量化参数扫描)
+# λ(r) = lim 1/N Σ log|r(1 - 2x_n)|，整张 r 网格作为数组一起迭代、一起累加对数导数
+# 网格按 LYAPUNOV_CHUNK 分块处理，极细的网格内存占用也有上界 (且每块能放进 CPU 缓存)
+# ==========================================
+LYAPUNOV_R_RANGE = (2.5, 4.0)
+LYAPUNOV_NUM_R = 2000          # 扫描曲线的 r 采样数
+LYAPUNOV_STEPS = 2000          # 累加对数导数的迭代次数
+LYAPUNOV_TRANSIENT = 500       # 丢弃的暂态迭代次数
+LYAPUNOV_CHUNK = 65536         # 每块同时迭代的 r 值个数
+LYAPUNOV_LOG_EVERY = 8         # 连乘这么多步的导数再取一次对数，log 调用减少 8 倍 (8 个导数的乘积在 float64 范围内)
+LYAPUNOV_X0 = 0.4              # 不用 0.5：x0=0.5 在 r=4 时一步落到不动点 0，在 r=2 时就是超稳定点
+_MIN_DERIVATIVE = 1e-16        # 超稳定点 x=0.5 处导数为 0，截断避免 log(0)
+
+def lyapunov_exponents(r_values, steps: int = LYAPUNOV_STEPS, transient: int = LYAPUNOV_TRANSIENT,
+                       x0: float = LYAPUNOV_X0, chunk: int = LYAPUNOV_CHUNK):
+    """返回与 r_values 等长的 Lyapunov 指数数组"""
+    r_values = np.atleast_1d(np.asarray(r_values, dtype=np.float64))
+    result = np.empty_like(r_values)
+    for start in range(0, len(r_values), chunk):
+        r = r_values[start:start + chunk]
+        x = np.full(len(r), x0)
+        for _ in range(transient):
+            x = r * x * (1 - x)
+        total = np.zeros(len(r))
+        product = np.ones(len(r))
+        derivative = np.empty(len(r))
+        for step in range(1, steps + 1):
+            # 原地运算，避免每步分配临时数组
+            np.subtract(1.0, x, out=derivative)
+            x *= derivative
+            x *= r
+            np.multiply(x, -2.0, out=derivative)
+            derivative += 1.0
+            derivative *= r
+            np.abs(derivative, out=derivative)
+            np.maximum(derivative, _MIN_DERIVATIVE, out=derivative)
+            product *= derivative
+            if step % LYAPUNOV_LOG_EVERY == 0 or step == steps:
+                total += np.log(product)
+                product.fill(1.0)
+        result[start:start + chunk] = total / steps
+    return result
+
+def compute_lyapunov(r: float = None, r_min: float = LYAPUNOV_R_RANGE[0], r_max: float = LYAPUNOV_R_RANGE[1],
+                     x0: float = LYAPUNOV_X0, num_r: int = LYAPUNOV_NUM_R):
+    """
+    计算 Logistic 映射的 Lyapunov 指数，返回结果字典
+    给定 r 时报告该点的 λ，同时计算整个区间的 λ(r) 曲线
+    """
+    # 1. 参数整理
+    r_min, r_max = sorted((float(r_min), float(r_max)))
+    r_min, r_max = max(r_min, 0.0), min(r_max, 4.0)
+    if r is not None:
+        r = min(max(float(r), 0.0), 4.0)
+        r_min, r_max = min(r_min, r), max(r_max, r)
+
+    # 2. 整条曲线与单点在同一次向量化计算中完成
+    started = time.perf_counter()
+    r_grid = np.linspace(r_min, r_max, num_r)
+    lambdas = lyapunov_exponents(np.append(r_grid, r if r is not None else []), x0=x0)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    curve = lambdas[:num_r]
+
+    # 3. 状态分析
+    chaotic_ratio = float(np.mean(curve > 0))
+    sweep_text = (
+        f"在 $r \\in [{r_min}, {r_max}]$ 上扫描 {num_r} 个点，"
+        f"其中 {chaotic_ratio:.1%} 的参数 $\\lambda > 0$ (混沌)。"
+    )
+    if r is not None:
+        value = float(lambdas[-1])
+        if value > 1e-3:
+            status = "混沌状态 (Chaos)"
+        elif value < -1e-3:
+            status = "周期/稳定状态 (Periodic)"
+        else:
+            status = "临界状态 (分岔点附近)"
+        result_text = (
+            f"✅ **计算完成**\n\n参数 $r={r}$ 时 Lyapunov 指数 $\\lambda \\approx {value:.4f}$，系统处于 **{status}**。\n"
+            f"(丢弃前 {LYAPUNOV_TRANSIENT} 步暂态，基于 {LYAPUNOV_STEPS} 次迭代的平均对数导数)\n\n" + sweep_text
+        )
+    else:
+        result_text = "✅ **Lyapunov 指数扫描完成**\n\n" + sweep_text
+
+    return {"r": r, "value": float(lambdas[-1]) if r is not None else None,
+            "r_grid": r_grid, "curve": curve, "text": result_text, "elapsed_ms": elapsed_ms}
+
+def render_lyapunov(result, max_points: int = SERIES_MAX_POINTS):
+    r, curve, r_grid = result["r"], result["curve"], result["r_grid"]
+    if max_points:
+        # 周期窗口是向下的尖峰，min/max 分箱能保证它们不被抽掉
+        keep = minmax_indices(curve, max_points)
+        r_grid, curve = r_grid[keep], curve[keep]
+    # 4. 绘图
+    fig, ax = plt.subplots(figsize=(10, 4))
+    ax.plot(r_grid, curve, color='darkblue', linewidth=0.6)
+    ax.axhline(0.0, color='red', linestyle='--', linewidth=0.8)
+    if r is not None:
+        ax.plot([r], [result["value"]], 'ro', markersize=6)
+    ax.set_title("Lyapunov Exponent of the Logistic Map")
+    ax.set_xlabel("Parameter (r)")
+    ax.set_ylabel("Lyapunov exponent (λ)")
+    ax.grid(True, linestyle='--', alpha=0.5)
+    ax.set_ylim(max(float(curve.min()), -3.0) - 0.1, max(float(curve.max()), 0.0) + 0.1)
+
+    return fig
+
+def simulate_lyapunov(r: float = None, r_min: float = LYAPUNOV_R_RANGE[0], r_max: float = LYAPUNOV_R_RANGE[1],
+                      x0: float = LYAPUNOV_X0, num_r: int = LYAPUNOV_NUM_R):
+    """
+    计算 Logistic 映射的 Lyapunov 指数并返回：(状态描述文本, 图像对象)
+    给定 r 时报告该点的 λ，同时画出整个区间的 λ(r) 曲线并标出该点
+    """
+    result = compute_lyapunov(r, r_min, r_max, x0, num_r)
+    return describe_result(result), render_lyapunov(result)
+
+# ==========================================
+# Lorenz 系综积分 (向量化定步长 RK4)
+# - N 个初始条件排成 (3, N) 数组，每个 RK4 子步对整个系综做一次数组运算，
+#   不再为每条轨迹调用一次 odeint + Python 导数回调
+# - 参考轨迹先积分 LORENZ_SPINUP 时间单位落到吸引子上，其余成员是它的微小扰动
+# - 记录各成员与参考轨迹的距离，对数距离在饱和前近似线性增长，斜率即最大 Lyapunov 指数
+# ==========================================
+LORENZ_DT = 0.01               # RK4 步长 (与 simulate_lorenz 每时间单位 100 个采样点一致)
+LORENZ_SPINUP = 10.0           # 参考轨迹的预热时长
+ENSEMBLE_MEMBERS = 1000
+ENSEMBLE_PERTURBATION = 1e-8   # 初始扰动幅度
+ENSEMBLE_DURATION = 30.0
+ENSEMBLE_PLOT_MEMBERS = 3      # 时间序列图中画出的成员数 (含参考轨迹)
+SEPARATION_SATURATION = 1.0    # 平均距离超过该值后 (吸引子尺度约 40) 增长不再是指数的，不参与拟合
+SEPARATION_FIT_START = 1.0     # 前 1 个时间单位扰动还在向最不稳定方向对齐，不参与拟合
+
+def _lorenz_rhs(s, sigma, rho, beta, out):
+    """s, out 形状为 (3, N)"""
+    out[0] = sigma * (s[1] - s[0])
+    out[1] = s[0] * (rho - s[2]) - s[1]
+    out[2] = s[0] * s[1] - beta * s[2]
+    return out
+
+def lorenz_ensemble(initial_states, sigma=10.0, rho=28.0, beta=2.667, duration=ENSEMBLE_DURATION,
+                    dt: float = LORENZ_DT, record_members: int = ENSEMBLE_PLOT_MEMBERS):
+    """
+    initial_states: (N, 3)；返回 (t, 前 record_members 个成员的轨迹 (steps+1, record_members, 3),
+    每步各成员到成员 0 的距离 (steps+1, N))
+    """
+    s = np.ascontiguousarray(np.asarray(initial_states, dtype=np.float64).T)
+    n_steps = int(round(duration / dt))
+    record_members = min(record_members, s.shape[1])
+    tracks = np.empty((n_steps + 1, record_members, 3))
+    distances = np.empty((n_steps + 1, s.shape[1]))
+    k1, k2, k3, k4, tmp = (np.empty_like(s) for _ in range(5))
+
+    def record(i):
+        tracks[i] = s[:, :record_members].T
+        distances[i] = np.sqrt(((s - s[:, :1]) ** 2).sum(axis=0))
+
+    record(0)
+    for i in range(1, n_steps + 1):
+        _lorenz_rhs(s, sigma, rho, beta, k1)
+        np.multiply(k1, dt / 2, out=tmp); tmp += s
+        _lorenz_rhs(tmp, sigma, rho, beta, k2)
+        np.multiply(k2, dt / 2, out=tmp); tmp += s
+        _lorenz_rhs(tmp, sigma, rho, beta, k3)
+        np.multiply(k3, dt, out=tmp); tmp += s
+        _lorenz_rhs(tmp, sigma, rho, beta, k4)
+        k2 += k3
+        k2 *= 2
+        k1 += k2
+        k1 += k4
+        k1 *= dt / 6
+        s += k1
+        record(i)
+    return np.linspace(0.0, n_steps * dt, n_steps + 1), tracks, distances
+
+def estimate_max_lyapunov(t, distances):
+    """对成员平均的 ln(距离) 在 [SEPARATION_FIT_START, 饱和时刻) 内做线性拟合，返回 (斜率, 平均对数距离, 拟合区间)"""
+    mean_log = np.log(np.maximum(distances[:, 1:], 1e-300)).mean(axis=1)
+    saturated = np.nonzero(np.exp(mean_log) > SEPARATION_SATURATION)[0]
+    end = saturated[0] if len(saturated) else len(t)
+    start = min(int(np.searchsorted(t, SEPARATION_FIT_START)), max(end - 2, 0))
+    if end - start < 2:
+        return float("nan"), mean_log, (t[0], t[-1])
+    slope = np.polyfit(t[start:end], mean_log[start:end], 1)[0]
+    return float(slope), mean_log, (t[start], t[end - 1])
+
+def compute_lorenz_ensemble(sigma=10.0, rho=28.0, beta=2.667, duration=ENSEMBLE_DURATION,
+                            members: int = ENSEMBLE_MEMBERS, perturbation: float = ENSEMBLE_PERTURBATION):
+    """
+    Lorenz 系统初值敏感性实验，返回结果字典 (只保留平均对数距离，不保留每个成员的距离)
+    参数不合法时返回只含 text / error 的字典，不绘图
+    """
+    # 0. 参数检查：至少要有参考轨迹 + 1 个扰动成员才有距离可言
+    members = int(members)
+    if members < 2:
+        return {"text": f"❌ 系综成员数至少为 2 (参考轨迹 + 扰动轨迹)，当前为 {members}。", "error": True}
+
+    # 1. 参考轨迹预热到吸引子上，再加随机方向、固定幅度的扰动生成系综
+    started = time.perf_counter()
+    _, spinup, _ = lorenz_ensemble([[1.0, 1.0, 1.0]], sigma, rho, beta, LORENZ_SPINUP, record_members=1)
+    reference = spinup[-1, 0]
+    directions = np.random.default_rng(0).normal(size=(members - 1, 3))
+    directions /= np.linalg.norm(directions, axis=1, keepdims=True)
+    initial_states = np.vstack([reference, reference + perturbation * directions])
+
+    # 2. 系综积分与最大 Lyapunov 指数估计
+    t, tracks, distances = lorenz_ensemble(initial_states, sigma, rho, beta, duration)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    lyapunov, mean_log, (fit_start, fit_end) = estimate_max_lyapunov(t, distances)
+    final_separation = float(np.exp(mean_log[-1]))
+
+    if np.isnan(lyapunov):
+        estimate_text = "轨迹间距离没有明显的指数增长区间，无法估计最大 Lyapunov 指数"
+    else:
+        estimate_text = (
+            f"在 $t \\in [{fit_start:.1f}, {fit_end:.1f}]$ 内平均对数距离线性增长，"
+            f"估计最大 Lyapunov 指数 $\\lambda_{{max}} \\approx {lyapunov:.3f}$"
+            + (" (标准参数下文献值约 0.906)" if (sigma, rho) == (10.0, 28.0) else "")
+        )
+    result_text = (
+        f"🦋 **Lorenz 初值敏感性实验完成**\n\n参数设置：$\\sigma={sigma}, \\rho={rho}, \\beta={beta}$，"
+        f"{members} 个初始条件 (扰动幅度 {perturbation:g})，RK4 步长 {LORENZ_DT}，积分 {duration} 个时间单位。\n"
+        f"{estimate_text}；$t={duration}$ 时平均距离为 {final_separation:.3g}。"
+    )
+
+    return {"t": t, "tracks": tracks, "mean_log": mean_log, "lyapunov": lyapunov,
+            "fit": (fit_start, fit_end), "text": result_text, "elapsed_ms": elapsed_ms}
+
+def render_lorenz_ensemble(result, max_points: int = SERIES_MAX_POINTS):
+    t, tracks, mean_log, lyapunov = result["t"], result["tracks"], result["mean_log"], result["lyapunov"]
+    fit_start, fit_end = result["fit"]
+    # 3. 绘图：上图为几条相邻轨迹的 x 分量，下图为平均对数距离随时间的增长
+    fig, (ax_x, ax_sep) = plt.subplots(2, 1, figsize=(9, 7), sharex=True)
+    for m in range(tracks.shape[1]):
+        keep = minmax_indices(tracks[:, m, 0], max_points) if max_points else slice(None)
+        ax_x.plot(t[keep], tracks[keep, m, 0], lw=0.8, alpha=0.8, label="reference" if m == 0 else f"perturbed #{m}")
+    ax_x.set_title("Lorenz Ensemble: Sensitivity to Initial Conditions")
+    ax_x.set_ylabel("X")
+    ax_x.legend(loc="upper right", fontsize=8)
+
+    keep = minmax_indices(mean_log, max_points) if max_points else slice(None)
+    ax_sep.plot(t[keep], mean_log[keep] / np.log(10), color='purple', lw=1.0, label="mean log10 separation")
+    if not np.isnan(lyapunov):
+        fit_t = np.array([fit_start, fit_end])
+        fit_mask = (t >= fit_start) & (t <= fit_end)
+        offset = float(np.mean(mean_log[fit_mask] - lyapunov * t[fit_mask]))
+        ax_sep.plot(fit_t, (offset + lyapunov * fit_t) / np.log(10), 'r--', lw=1.0, label=f"slope λ≈{lyapunov:.3f}")
+    ax_sep.set_xlabel("Time (t)")
+    ax_sep.set_ylabel("log10 |δ(t)|")
+    ax_sep.grid(True, linestyle='--', alpha=0.5)
+    ax_sep.legend(loc="lower right", fontsize=8)
+
+    return fig
+
+def simulate_lorenz_ensemble(sigma=10.0, rho=28.0, beta=2.667, duration=ENSEMBLE_DURATION,
+                             members: int = ENSEMBLE_MEMBERS, perturbation: float = ENSEMBLE_PERTURBATION):
+    """
+    Lorenz 系统初值敏感性实验并返回：(状态描述文本, 图像对象)
+    """
+    result = compute_lorenz_ensemble(sigma, rho, beta, duration, members, perturbation)
+    if result.get("error"):
+        return result["text"], None
+    return describe_result(result), render_lorenz_ensemble(result)
+
+# ==========================================
+# 计算结果与图像缓存
+# - 键 = md5(工具名 + 补全默认值后的参数 + 本文件代码版本)，修改 tools.py 后旧缓存自动失效
+# - 内存 LRU 保存 compute_xxx 的数值结果；磁盘 SQLite 保存编码好的 PNG 与状态描述 (按总字节数淘汰)
+# - 重复提问直接返回 PNG 字节，既不积分也不调用 Matplotlib (绘图 + savefig 是 COMPUTE 轮次最慢的部分)
+# ==========================================
+TOOLS = {
+    "logistic_map": (compute_logistic_map, render_logistic_map),
+    "lorenz": (compute_lorenz, render_lorenz),
+    "bifurcation": (compute_bifurcation, render_bifurcation),
+    "lyapunov": (compute_lyapunov, render_lyapunov),
+    "lorenz_ensemble": (compute_lorenz_ensemble, render_lorenz_ensemble),
+}
+FIGURE_CACHE_ENABLED = os.getenv("CHAOS_FIGURE_CACHE", "1") != "0"
+FIGURE_CACHE_PATH = "./cache/figure_cache.sqlite"
+FIGURE_CACHE_MAX_BYTES = 200 * 1024 * 1024
+RESULT_CACHE_SIZE = 16     # 分岔图密度图单条约 8 MB，条目数不宜太多
+FIGURE_DPI = 100
+RENDER_WORKERS = int(os.getenv("CHAOS_RENDER_WORKERS", "1"))  # 渲染进程数，0 表示在调用线程里渲染
+
+with open(__file__, "rb") as _source:
+    CODE_VERSION = hashlib.md5(_source.read()).hexdigest()[:12]
+
+result_cache = LRUCache(max_size=RESULT_CACHE_SIZE)
+_figure_cache = None
+_figure_cache_lock = threading.Lock()
+
+def get_figure_cache():
+    global _figure_cache
+    if _figure_cache is None:
+        with _figure_cache_lock:
+            if _figure_cache is None:
+                _figure_cache = FigureCache(FIGURE_CACHE_PATH, max_bytes=FIGURE_CACHE_MAX_BYTES)
+    return _figure_cache
+
+def tool_cache_key(name: str, params: dict) -> str:
+    """参数先补全默认值，数值统一成 float，这样 simulate_lorenz() 与 sigma=10 命中同一个键"""
+    bound = inspect.signature(TOOLS[name][0]).bind(**params)
+    bound.apply_defaults()
+    normalized = {
+        k: float(v) if isinstance(v, (int, float, np.number)) and not isinstance(v, bool) else v
+        for k, v in bound.arguments.items()
+    }
+    payload = json.dumps({"tool": name, "params": normalized, "version": CODE_VERSION}, sort_keys=True)
+    return hashlib.md5(payload.encode("utf-8")).hexdigest()
+
+def encode_figure(fig) -> bytes:
+    """PNG 编码后立即关闭图表释放内存"""
+    buf = io.BytesIO()
+    try:
+        fig.savefig(buf, format="png", bbox_inches='tight', dpi=FIGURE_DPI)
+    finally:
+        plt.close(fig)
+    return buf.getvalue()
+
+# ==========================================
+# 渲染进程池
+# pyplot 的全局状态不是线程安全的，Streamlit 多会话同时绘图会互相干扰；
+# 渲染放到独立进程 (Agg 后端) 里完成，只把 PNG 字节传回来，Streamlit 进程里不再创建任何 Figure
+# ==========================================
+_render_pool = None
+_render_pool_lock = threading.Lock()
+_render_pool_broken = False  # 进程池崩溃过一次后永久改为本线程渲染，不再反复拉起注定失败的进程池
+_render_pool_warmed = False  # Streamlit 每次 rerun 都会执行 app.py，预热任务每个进程只提交一次
+
+def _init_render_worker():
+    plt.switch_backend("Agg")
+
+def _render_in_worker(name: str, result):
+    return encode_figure(TOOLS[name][1](result))
+
+def get_render_pool():
+    global _render_pool
+    if _render_pool is None:
+        with _render_pool_lock:
+            if _render_pool is None:
+                # spawn：不 fork Streamlit / torch 所在的进程
+                _render_pool = ProcessPoolExecutor(
+                    max_workers=RENDER_WORKERS,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_render_worker,
+                )
+    return _render_pool
+
+def warm_render_pool():
+    """提前拉起渲染进程 (子进程 import 本模块约需 1~2 秒)，不阻塞调用方；重复调用是安全的 (每个进程只预热一次)"""
+    global _render_pool_warmed
+    if RENDER_WORKERS <= 0 or _render_pool_broken:
+        return
+    with _render_pool_lock:
+        if _render_pool_warmed:
+            return
+        _render_pool_warmed = True
+    get_render_pool().submit(int)
+
+def render_png(name: str, result) -> bytes:
+    """渲染并编码成 PNG；进程池不可用时退回到当前线程渲染，之后的调用也不再使用进程池"""
+    global _render_pool, _render_pool_broken
+    if RENDER_WORKERS > 0 and not _render_pool_broken:
+        try:
+            return get_render_pool().submit(_render_in_worker, name, result).result()
+        except (BrokenProcessPool, OSError) as e:
+            logger.warning(f"⚠️ [Render] 渲染进程不可用，之后改为本线程渲染: {e}")
+            with _render_pool_lock:
+                _render_pool_broken = True
+                if _render_pool is not None:
+                    _render_pool.shutdown(wait=False)
+                    _render_pool = None
+    return encode_figure(TOOLS[name][1](result))
+
+def describe_result(result, computed: bool = True) -> str:
+    """
+    状态描述文本 + 本次数值计算耗时
+    耗时不写进 result["text"]：结果与图像缓存里存的文本不带耗时，命中缓存时不会显示上一次的耗时
+    """
+    elapsed_ms = result.get("elapsed_ms")
+    if not computed or elapsed_ms is None:
+        return result["text"]
+    return result["text"] + f"\n\n⏱️ 数值计算耗时 {elapsed_ms:.0f} ms。"
+
+def run_tool(name: str, **params):
+    """
+    带缓存地运行工具，返回 (状态描述文本, PNG 字节)
+    命中情况记录在 tool span 的 cache 属性上：figure (磁盘图像) / result (内存数值结果) / miss
+    只有本次真正计算时文本才带计算耗时
+    """
+    key = tool_cache_key(name, params)
+    compute = TOOLS[name][0]
+    with span("tool", tool=name) as s:
+        if FIGURE_CACHE_ENABLED:
+            cached = get_figure_cache().get(key)
+            if cached is not None:
+                s["attrs"]["cache"] = "figure"
+                return cached
+
+        result = result_cache.get(key)
+        computed = result is None
+        s["attrs"]["cache"] = "miss" if computed else "result"
+        if computed:
+            with span("tool_compute", tool=name):
+                result = compute(**params)
+            result_cache.put(key, result)
+        if result.get("error"):
+            # 参数不合法：只返回说明文本，不渲染也不写磁盘缓存
+            return result["text"], None
+        with span("tool_render", tool=name, workers=RENDER_WORKERS):
+            png = render_png(name, result)
+
+        if FIGURE_CACHE_ENABLED:
+            try:
+                get_figure_cache().put(key, result["text"], png)
+            except sqlite3.Error as e:
+                # 磁盘缓存写失败不影响本次计算结果
+                logger.warning(f"⚠️ [Figure Cache] 写入失败: {e}")
+        return describe_result(result, computed), png
@@ -0,0 +1,156 @@
+import os
+import json
+import time
+import uuid
+import bisect
+import logging
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+
+# ==========================================
+# 轻量级链路追踪 (替代热路径上的 print 调试)
+# - 每轮对话一个 trace，内含 route / rewrite / recall / rerank / generate / save 等 span
+# - trace 写入按大小轮转的 JSONL 文件，并按 span 名累计延迟直方图
+# - 日志级别由环境变量 CHAOS_LOG_LEVEL 控制 (DEBUG / INFO / WARNING)，生产环境设为 WARNING 即可保持安静
+# ==========================================
+
+TRACE_ENABLED = os.getenv("CHAOS_TRACING", "1") != "0"
+TRACE_PATH = os.getenv("CHAOS_TRACE_PATH", "./logs/traces.jsonl")
+TRACE_MAX_BYTES = 5 * 1024 * 1024  # 单个 JSONL 文件上限，超过后轮转
+TRACE_BACKUPS = 3                  # 保留的历史文件个数 traces.jsonl.1 ~ .3
+RECENT_TRACES = 50                 # 内存中保留最近 N 条 trace 供诊断面板展示
+HISTOGRAM_BUCKETS_MS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000]
+
+logging.basicConfig(format="%(asctime)s %(levelname)s [%(name)s] %(message)s")
+
+def get_logger(name: str) -> logging.Logger:
+    logger = logging.getLogger(name)
+    logger.setLevel(os.getenv("CHAOS_LOG_LEVEL", "INFO").upper())
+    return logger
+
+class RotatingJsonlSink:
+    """按大小轮转的 JSONL 写入器 (线程安全)"""
+    def __init__(self, path: str, max_bytes: int = TRACE_MAX_BYTES, backups: int = TRACE_BACKUPS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def _rotate(self):
+        for i in range(self.backups - 1, 0, -1):
+            src = f"{self.path}.{i}"
+            if os.path.exists(src):
+                os.replace(src, f"{self.path}.{i + 1}")
+        os.replace(self.path, f"{self.path}.1")
+
+    def write(self, record: dict):
+        line = json.dumps(record, ensure_ascii=False, default=str) + "\n"
+        with self._lock:
+            if os.path.exists(self.path) and os.path.getsize(self.path) + len(line) > self.max_bytes:
+                self._rotate()
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line)
+
+class LatencyHistogram:
+    """固定桶的延迟直方图 (毫秒)"""
+    def __init__(self, buckets_ms=HISTOGRAM_BUCKETS_MS):
+        self.buckets_ms = list(buckets_ms)
+        self.counts = [0] * (len(self.buckets_ms) + 1)  # 最后一个桶为 +inf
+        self.total_ms = 0.0
+        self.count = 0
+
+    def observe(self, ms: float):
+        self.counts[bisect.bisect_left(self.buckets_ms, ms)] += 1
+        self.total_ms += ms
+        self.count += 1
+
+    def snapshot(self) -> dict:
+        labels = [f"<={b}ms" for b in self.buckets_ms] + [f">{self.buckets_ms[-1]}ms"]
+        return {
+            "count": self.count,
+            "mean_ms": self.total_ms / self.count if self.count else 0.0,
+            "buckets": dict(zip(labels, self.counts)),
+        }
+
+_sink = RotatingJsonlSink(TRACE_PATH) if TRACE_ENABLED else None
+_recent = deque(maxlen=RECENT_TRACES)
+_histograms = {}
+_hist_lock = threading.Lock()
+_current_trace = contextvars.ContextVar("chaos_trace", default=None)
+_logger = get_logger("tracing")
+
+def _observe(name: str, ms: float):
+    with _hist_lock:
+        if name not in _histograms:
+            _histograms[name] = LatencyHistogram()
+        _histograms[name].observe(ms)
+
+@contextmanager
+def start_trace(name: str, **attrs):
+    """
+    开启一个 trace (一轮对话)。with 块内的 span 都会挂到这个 trace 上，
+    结束时写入 JSONL 并进入最近 N 条缓存
+    """
+    trace = {
+        "trace_id": uuid.uuid4().hex[:12],
+        "name": name,
+        "start": time.time(),
+        "attrs": dict(attrs),
+        "spans": [],
+    }
+    token = _current_trace.set(trace)
+    started = time.perf_counter()
+    try:
+        yield trace
+    finally:
+        trace["duration_ms"] = (time.perf_counter() - started) * 1000
+        _current_trace.reset(token)
+        _observe(name, trace["duration_ms"])
+        _recent.append(trace)
+        if _sink is not None:
+            try:
+                _sink.write(trace)
+            except OSError as e:
+                _logger.warning(f"trace 写入失败: {e}")
+
+@contextmanager
+def span(name: str, **attrs):
+    """
+    记录一个阶段的耗时与属性：
+        with span("recall", k=20) as s:
+            ...
+            s["attrs"]["candidates"] = len(docs)
+    没有活动 trace 时只记直方图，不会报错
+    """
+    record = {"name": name, "attrs": dict(attrs), "start_offset_ms": 0.0}
+    trace = _current_trace.get()
+    if trace is not None:
+        record["start_offset_ms"] = (time.time() - trace["start"]) * 1000
+    started = time.perf_counter()
+    try:
+        yield record
+    except Exception as e:
+        record["error"] = repr(e)
+        raise
+    finally:
+        record["duration_ms"] = (time.perf_counter() - started) * 1000
+        _observe(name, record["duration_ms"])
+        if trace is not None:
+            trace["spans"].append(record)
+
+def bind_context(fn):
+    """把当前 trace 上下文带进线程池任务 (contextvars 默认不会跨线程传递)"""
+    ctx = contextvars.copy_context()
+    return lambda *args, **kwargs: ctx.run(fn, *args, **kwargs)
+
+def recent_traces(n: int = 20):
+    """最近 n 条 trace，最新的在前"""
+    return list(_recent)[-n:][::-1]
+
+def histogram_snapshot() -> dict:
+    with _hist_lock:
+        return {name: hist.snapshot() for name, hist in _histograms.items()}